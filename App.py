@@ -1,58 +1,172 @@
 import streamlit as st
-import ollama
-from PIL import Image
-import io
-import json
+import functools
+from contextlib import closing
 from datetime import datetime, timedelta
 import os
-import shutil
+import queue
+import threading
+import time
+import uuid
+from backends import BackendPool, configured_hosts
+from blob_store import (
+    blob_path, conversation_blobs, conversation_image_hashes, migrate_images, put_blob, release_blob,
+    remove_conversation_with_image
+)
+from catalog import (
+    count_catalog, list_catalog, refresh_catalog, remove_catalog_entry, search_catalog, update_catalog_entry
+)
+from locking import conversation_lock_path, file_lock
+from maintenance import StorageMaintenance, remove_all_conversations
+from metrics import Metrics, ollama_counters
+from model_manager import ModelManager
+from ollama_client import create_client
+from response_cache import ResponseCache, response_cache_key
+from routing import DESCRIPTION_PROMPT, DescriptionStore, needs_vision, select_images, split_force_vision
+from scheduler import BATCH, INTERACTIVE, PARALLEL_PER_HOST, Cancelled, RequestScheduler
+from storage import (
+    SESSION_ID_PATTERN, append_to_conversation, atomic_write_bytes, clear_recovery, conversation_id_from_filename,
+    conversation_state, create_conversation, read_conversation, read_recovery, snapshot_path, write_recovery
+)
+from history import RollingSummarizer, estimate_tokens, split_history, split_history_stable
+from image_utils import (
+    ImagePayloadCache, ImageSource, ThumbnailCache, encode_image, image_list, map_images, model_input_size,
+    prepare_payloads
+)
+
+IMAGE_PAYLOAD_CACHE_BYTES = 256 * 1024 * 1024
+
+@st.cache_resource
+def get_image_payload_cache():
+    # One cache per process, shared by every rerun and every session
+    return ImagePayloadCache(IMAGE_PAYLOAD_CACHE_BYTES)
+
+@st.cache_resource
+def get_thumbnail_cache():
+    # Display-sized copies of uploaded and stored images, made once per image
+    return ThumbnailCache(os.path.join('conversations', 'thumbnails'))
+
+@st.cache_resource
+def get_ollama_client():
+    # One pooled client per process; every session reuses its connections.
+    # With OLLAMA_HOSTS set, requests are spread over those servers instead,
+    # at most PARALLEL_PER_HOST at a time on each.
+    hosts = configured_hosts()
+    if hosts:
+        return BackendPool(hosts, max_in_flight=PARALLEL_PER_HOST).start()
+    return create_client()
+
+@st.cache_resource
+def get_scheduler():
+    # Every generation in this process takes one of these slots, so sessions
+    # queue here by priority instead of piling up on Ollama; with several
+    # hosts, the pool also keeps each one to PARALLEL_PER_HOST
+    return RequestScheduler(PARALLEL_PER_HOST * max(1, len(configured_hosts())))
+
+# Optional exports for the per-turn metrics: a JSONL log of every turn, and a
+# Prometheus text file (e.g. for the node_exporter textfile collector)
+METRICS_LOG = os.environ.get('METRICS_LOG')
+METRICS_PROM_FILE = os.environ.get('METRICS_PROM_FILE')
+
+@st.cache_resource
+def get_metrics():
+    return Metrics(METRICS_LOG)
+
+def timed(stage):
+    # Records how long each call of the decorated function takes
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                get_metrics().observe(stage, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache(os.path.join('conversations', 'response_cache'))
+
+@st.cache_resource
+def migrate_conversation_images():
+    # Runs once per process: moves images saved by older versions into the blob store
+    return migrate_images('conversations')
+
+@st.cache_resource
+def get_storage_maintenance():
+    # One background thread per process; it waits whenever requests are running
+    return StorageMaintenance('conversations', busy=lambda: get_scheduler().running > 0).start()
+
+def get_session_id():
+    # Identifies this browser tab's recovery state. It is kept in the page URL
+    # so a reload finds the same state, while other users and tabs get their own.
+    session_id = st.query_params.get('session')
+    if not session_id or not SESSION_ID_PATTERN.fullmatch(session_id):
+        session_id = st.session_state.get('session_id') or uuid.uuid4().hex
+        st.query_params['session'] = session_id
+    st.session_state.session_id = session_id
+    return session_id
 
 def delete_conversation(filename):
-    json_path = os.path.join('conversations', filename)
-    if os.path.exists(json_path):
-        os.remove(json_path)
-        
     # Extract timestamp from filename
     base_filename = os.path.basename(filename)
-    timestamp = base_filename.replace('conversation_', '').replace('.json', '')
-    
-    # Delete associated image files
-    image_extensions = ['png', 'jpg', 'jpeg']
-    for ext in image_extensions:
-        image_filename = f'image_{timestamp}.{ext}'
-        image_path = os.path.join('conversations', image_filename)
-        if os.path.exists(image_path):
-            os.remove(image_path)
-            
-    # Handle current_conversation.json
-    current_conv_path = 'conversations/current_conversation.json'
-    if os.path.exists(current_conv_path):
-        try:
-            with open(current_conv_path, 'r') as f:
-                current_data = json.load(f)
-            f.close()  # Explicitly close the file
-            
-            if current_data.get('timestamp') == timestamp:
-                try:
-                    os.remove(current_conv_path)
-                except PermissionError:
-                    import time
-                    time.sleep(0.1)  # Add small delay
-                    os.remove(current_conv_path)
-        except Exception as e:
-            print(f"Error handling current_conversation.json: {e}")
+    timestamp = conversation_id_from_filename(base_filename)
 
-def save_conversation(messages, context, image=None, filename=None, title=None):
+    # Release the conversation's images; a blob is only removed once no other
+    # conversation refers to it
+    remove_conversation_with_image('conversations', timestamp)
+    remove_catalog_entry('conversations', base_filename)
+
+    # Forget it as this session's open conversation; other sessions notice the
+    # conversation is gone when they next recover
+    clear_recovery('conversations', get_session_id(), timestamp)
+
+def image_blob_key(image):
+    if not isinstance(image, ImageSource):
+        encode_image(image, get_image_payload_cache())  # Make sure the content hash is set
+    image_format = image.format.lower() if image.format else 'png'
+    ext = 'jpg' if image_format == 'jpeg' else image_format
+    return f"{image.content_hash}.{ext}"
+
+def save_image(image):
+    # Store the image in the blob store from its original or cached payload
+    # bytes; identical images share one blob
+    if isinstance(image, ImageSource):
+        image_bytes = image.read()
+    else:
+        image_bytes = encode_image(image, get_image_payload_cache())
+    key = image_blob_key(image)
+    return put_blob('conversations', image_bytes, os.path.splitext(key)[1][1:], key=key)
+
+def image_fields(images, previous=()):
+    # Metadata naming the conversation's images, storing those not already
+    # among its previous blobs; an image uploaded twice is kept once
+    keys, hashes = [], []
+    for image in images:
+        key = image_blob_key(image)
+        if key in keys:
+            continue
+        if key not in previous:
+            save_image(image)
+        keys.append(key)
+        hashes.append(image.content_hash)
+    # Written by versions that kept a single image
+    return {'image_blobs': keys, 'image_hashes': hashes, 'image_blob': None, 'image_hash': None}
+
+@timed('save_conversation')
+def save_conversation(messages, context, images=None, filename=None, title=None, base_count=None):
+    # `images` is the conversation's list of images (or a single image).
+    # `base_count` is how many of `messages` were already saved when this
+    # session loaded or last saved the conversation; if another session has
+    # added messages since, this copy is saved as a new conversation instead.
+    images = image_list(images)
     if not messages:
         return None
         
     if not os.path.exists('conversations'):
         os.makedirs('conversations')
     
-    # Generate a new timestamp
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    new_filename = os.path.join('conversations', f'conversation_{timestamp}.json')
-    
     # Generate a default title using the first user message or timestamp
     first_user_message = next((msg['content'] for msg in messages if msg['role'] == 'user'), None)
     default_title = first_user_message if first_user_message else f"Conversation on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
@@ -60,77 +174,90 @@ def save_conversation(messages, context, image=None, filename=None, title=None):
     # Use the provided title or default title
     conversation_title = title or default_title
 
-    conversation_data = {
-        'timestamp': timestamp,
-        'messages': messages,
-        'context': context,
-        'title': conversation_title
-    }
-    
-    # Save the conversation JSON
-    with open(new_filename, 'w') as f:
-        json.dump(conversation_data, f, indent=4)
-    
-    # Also save as 'current_conversation.json' for auto-recovery
-    with open('conversations/current_conversation.json', 'w') as f:
-        json.dump(conversation_data, f, indent=4)
-    
-    if image:
-        # Get image format extension
-        image_format = image.format.lower() if image.format else 'png'
-        ext = 'jpg' if image_format == 'jpeg' else image_format
-        image_filename = f'image_{timestamp}.{ext}'
-        image.save(os.path.join('conversations', image_filename))
-    
-    # If updating an existing conversation, delete the old files
+    timestamp = None
     if filename and os.path.exists(filename):
-        delete_conversation(os.path.basename(filename))
-    
+        # Existing conversation: only the new turn goes to disk
+        timestamp = conversation_id_from_filename(filename)
+        fields = {'context': context, 'title': conversation_title}
+        # Held across the image swap and the append, so another session saving
+        # the same conversation can't release a previous image twice
+        with file_lock(conversation_lock_path('conversations', timestamp)):
+            state = conversation_state('conversations', timestamp)
+            if base_count is not None and state['message_count'] != base_count:
+                # Another session continued the conversation meanwhile; keep
+                # both histories by forking this one
+                timestamp = None
+            else:
+                if images:
+                    previous = conversation_blobs(state)
+                    image_changes = image_fields(images, previous)
+                    if image_changes['image_blobs'] != previous:
+                        fields.update(image_changes)
+                        for key in set(previous) - set(image_changes['image_blobs']):
+                            release_blob('conversations', key)
+                append_to_conversation('conversations', timestamp, messages, base_count, **fields)
+    if timestamp is None:
+        fields = image_fields(images) if images else {}
+        timestamp = create_conversation('conversations', messages, context, conversation_title, **fields)
+
+    # Point this session's auto-recovery at the conversation instead of keeping a full copy of it
+    write_recovery('conversations', get_session_id(), timestamp)
+
+    new_filename = snapshot_path('conversations', timestamp)
+    update_catalog_entry('conversations', os.path.basename(new_filename), messages)
     return new_filename
 
 def load_conversation(filename):
-    # Load conversation data
-    with open(filename, 'r') as f:
-        conv_data = json.load(f)
-    
-    # Extract timestamp from filename
-    base_filename = os.path.basename(filename)
-    timestamp = base_filename.replace('conversation_', '').replace('.json', '')
-    
-    # Update the timestamp in conv_data to match the filename
-    conv_data['timestamp'] = timestamp
+    # Load conversation data, replaying any turns appended since the last snapshot
+    timestamp = conversation_id_from_filename(filename)
+    conv_data = read_conversation('conversations', timestamp)
     
-    # Try to load associated image
-    image_extensions = ['png', 'jpg', 'jpeg']
-    image = None
-    for ext in image_extensions:
-        image_filename = f'image_{timestamp}.{ext}'
-        image_path = os.path.join('conversations', image_filename)
+    # Refer to the images in the blob store; their pixels are only read when a
+    # request is sent, and the UI shows thumbnails
+    images = []
+    for key, image_hash in zip(conversation_blobs(conv_data), conversation_image_hashes(conv_data)):
+        image_path = blob_path('conversations', key)
         if os.path.exists(image_path):
-            try:
-                image = Image.open(image_path)
-                break  # Exit loop if image is found
-            except Exception as e:
-                print(f"Error loading image {image_filename}: {e}")
-    return conv_data, image
+            ext = os.path.splitext(key)[1]
+            image_format = 'JPEG' if ext.lower() in ('.jpg', '.jpeg') else ext[1:].upper()
+            images.append(ImageSource(image_hash, image_format, path=image_path))
+        else:
+            print(f"Error loading image {key}: blob not found")
+    return conv_data, images
+
+def rename_conversation(filename, title):
+    timestamp = conversation_id_from_filename(filename)
+    append_to_conversation('conversations', timestamp, [], title=title)
+    update_catalog_entry('conversations', os.path.basename(filename))
+
+# Conversations shown per sidebar page
+SIDEBAR_PAGE_SIZE = 20
 
-def get_saved_conversations():
+@timed('get_saved_conversations')
+def get_saved_conversations(query='', page=0, page_size=SIDEBAR_PAGE_SIZE):
+    # One page of conversations (or of search results for `query`), grouped by
+    # date, and the total number of conversations or matches
     if not os.path.exists('conversations'):
-        return {}
-    files = [f for f in os.listdir('conversations') if f.startswith('conversation_') and f.endswith('.json')]
+        return {}, 0
+    refresh_catalog('conversations')
+    if query.strip():
+        entries, total = search_catalog('conversations', query, page_size, page * page_size)
+    else:
+        entries = list_catalog('conversations', page_size, page * page_size)
+        total = count_catalog('conversations')
     conversations = []
-    for file in files:
-        with open(os.path.join('conversations', file), 'r') as f:
-            data = json.load(f)
-            # Extract timestamp from filename
-            timestamp_str = file.replace('conversation_', '').replace('.json', '')
-            timestamp = datetime.strptime(timestamp_str, "%Y%m%d_%H%M%S")
-            conversations.append({
-                'filename': file,
-                'timestamp': timestamp,
-                'title': data.get('title', f"Conversation on {timestamp.strftime('%Y-%m-%d %H:%M:%S')}"),
-                'preview': data['messages'][0]['content'] if data['messages'] else 'Empty conversation'
-            })
+    for entry in entries:
+        timestamp = datetime.strptime(entry['timestamp'], "%Y%m%d_%H%M%S")
+        conversations.append({
+            'filename': entry['filename'],
+            'timestamp': timestamp,
+            'title': entry['title'] or f"Conversation on {timestamp.strftime('%Y-%m-%d %H:%M:%S')}",
+            'preview': entry['preview'],
+            'message_count': entry['message_count']
+        })
+    if query.strip():
+        # Search results stay in order of relevance
+        return {'Search results': conversations}, total
     # Now categorize conversations by date ranges
     categorized_conversations = {}
     now = datetime.now()
@@ -153,57 +280,560 @@ def get_saved_conversations():
         if key not in categorized_conversations:
             categorized_conversations[key] = []
         categorized_conversations[key].append(conv)
-    return categorized_conversations
-
-def process_image_and_text(image, text_prompt, messages_history, context):
-    if image is not None:
-        img_byte_arr = io.BytesIO()
-        # Ensure the image format is set
-        image_format = image.format if image.format else 'PNG'
-        image.save(img_byte_arr, format=image_format)
-        img_byte_arr = img_byte_arr.getvalue()
-        
-        system_prompt = {
-            "role": "system",
-            "content": """You are an AI assistant that provides accurate image analysis. 
-            Follow these guidelines:
-            1. Only make statements that you can verify from the image
-            2. If you are unsure about something, explicitly state your uncertainty
-            3. Consider the provided context for better understanding
-            4. Maintain consistency with previous responses
-            5. Focus on factual observations rather than assumptions"""
-        }
-        
-        max_history = 5
-        recent_messages = messages_history[-max_history:] if len(messages_history) > max_history else messages_history
-        
+    return categorized_conversations, total
+
+VISION_MODEL = 'llama3.2-vision'
+
+SYSTEM_PROMPT = {
+    "role": "system",
+    "content": """You are an AI assistant that provides accurate image analysis. 
+    Follow these guidelines:
+    1. Only make statements that you can verify from the image
+    2. If you are unsure about something, explicitly state your uncertainty
+    3. Consider the provided context for better understanding
+    4. Maintain consistency with previous responses
+    5. Focus on factual observations rather than assumptions"""
+}
+
+# Budget for earlier messages sent with each request, in estimated tokens
+HISTORY_TOKEN_BUDGET = 2048
+# Smaller text-only model for follow-ups that don't need the image (see routing.py)
+TEXT_MODEL = os.environ.get('TEXT_MODEL', 'llama3.2')
+# Model that maintains the rolling summary of older turns; the vision model
+# takes over if it isn't available
+SUMMARY_MODEL = os.environ.get('SUMMARY_MODEL', TEXT_MODEL)
+
+# Prompt layouts:
+#   'window'  history window first and the images the prompt is about on the
+#             newest question
+#   'prefix'  system prompt, then the first question with all images, then the
+#             history in order; each request extends the previous one, so
+#             Ollama can reuse the already evaluated prefix (including the
+#             images) instead of running the vision encoder again
+# How long Ollama keeps the model (and its prompt cache) loaded after a request.
+# None leaves it to the server; the prefix layout defaults to a longer time,
+# since its benefit depends on the cache still being there on the next turn.
+OLLAMA_KEEP_ALIVE = os.environ.get('OLLAMA_KEEP_ALIVE')
+PREFIX_LAYOUT_KEEP_ALIVE = OLLAMA_KEEP_ALIVE or '30m'
+# In the prefix layout older messages are dropped in steps of this many
+# messages, so the prefix only changes once per step
+PREFIX_HISTORY_STEP = 8
+
+def keep_alive_for(layout):
+    return PREFIX_LAYOUT_KEEP_ALIVE if layout == 'prefix' else OLLAMA_KEEP_ALIVE
+
+# Set OLLAMA_PRELOAD=0 to leave loading and unloading the model to Ollama
+OLLAMA_PRELOAD = os.environ.get('OLLAMA_PRELOAD', '1') != '0'
+
+@st.cache_resource
+def get_model_manager():
+    # One per process: loads the model on start and keeps it loaded while
+    # any session is active
+    client = get_ollama_client()
+    if isinstance(client, BackendPool):
+        clients = {backend.host: backend.client for backend in client.backends}
+    else:
+        clients = {os.environ.get('OLLAMA_HOST') or 'localhost:11434': client}
+    return ModelManager(clients, VISION_MODEL).start()
+
+def render_model_status():
+    status = get_model_manager().status()
+    icons = {'loaded': "🟢", 'loading': "⏳", 'unloaded': "⚪", 'error': "🔴"}
+    for host in status['hosts']:
+        detail = host['state']
+        if host['state'] == 'loaded' and host['expires_at']:
+            detail += f", unloads in {max(0, host['expires_at'] - time.time()) / 60:.0f} min"
+        elif host['state'] == 'error':
+            detail += f": {host['error']}"
+        label = status['model'] if len(status['hosts']) == 1 else f"{status['model']} on {host['host']}"
+        st.caption(f"{icons.get(host['state'], '⚪')} {label} ({detail})")
+
+@st.cache_resource
+def get_history_summarizer():
+    def summarize(prompt):
+        # Runs on a background thread (see history_messages), queued behind
+        # interactive turns; each prompt covers at most one budget-sized chunk
+        # of messages
+        messages = [{'role': 'user', 'content': prompt}]
+        with get_scheduler().slot(BATCH):
+            try:
+                response = get_ollama_client().chat(
+                    model=SUMMARY_MODEL, messages=messages, keep_alive=OLLAMA_KEEP_ALIVE
+                )
+            except Exception as e:
+                if SUMMARY_MODEL == VISION_MODEL:
+                    raise
+                print(f"Error summarizing with {SUMMARY_MODEL}, using {VISION_MODEL}: {e}")
+                response = get_ollama_client().chat(
+                    model=VISION_MODEL, messages=messages, keep_alive=OLLAMA_KEEP_ALIVE
+                )
+        return response['message']['content']
+    return RollingSummarizer(summarize, chunk_tokens=HISTORY_TOKEN_BUDGET)
+
+def history_messages(messages_history, stats=None, stable=False):
+    # Recent turns up to the token budget; anything older is folded into a summary
+    if stable:
+        older_messages, recent_messages = split_history_stable(
+            messages_history, HISTORY_TOKEN_BUDGET, PREFIX_HISTORY_STEP
+        )
+    else:
+        older_messages, recent_messages = split_history(messages_history, HISTORY_TOKEN_BUDGET)
+    stale = 0
+    if older_messages:
+        # The request doesn't wait for the model: it takes the newest summary
+        # made so far, which may not cover the last few messages that left the
+        # window yet, and the rest is summarized in the background for the
+        # next turn
+        summarizer = get_history_summarizer()
+        covered, summary = summarizer.cached_summary(older_messages)
+        stale = len(older_messages) - covered
+        if stale:
+            summarizer.refresh(older_messages)
+        if summary:
+            recent_messages = [
+                {'role': 'system', 'content': f"Summary of the earlier conversation:\n{summary}"},
+                *recent_messages
+            ]
+    if stats is not None:
+        stats['history_tokens'] = sum(estimate_tokens(m) for m in recent_messages)
+        stats['summarized_messages'] = len(older_messages) - stale
+        stats['summary_pending_messages'] = stale
+    return recent_messages
+
+def encode_images(images, preprocess=None, stats=None):
+    # The payload of every image, decoded and preprocessed side by side
+    encode_start = time.perf_counter()
+    if preprocess:
+        payloads = prepare_payloads(
+            images,
+            max_side=preprocess.get('max_side', model_input_size(VISION_MODEL)),
+            quality=preprocess.get('quality'),
+            cache=get_image_payload_cache()
+        )
+    else:
+        payloads = prepare_payloads(images, cache=get_image_payload_cache())
+    if stats is not None:
+        stats['encode_time'] = time.perf_counter() - encode_start
+        stats['images'] = [
+            {
+                'encode_ms': report['encode_time'] * 1000,
+                'sent_bytes': report['sent_bytes'],
+                'cache_hit': report['cache_hit'],
+            }
+            for _, report in payloads
+        ]
+        if preprocess and len(payloads) == 1:
+            stats['preprocess'] = payloads[0][1]
+        elif preprocess:
+            stats['preprocess'] = {
+                name: sum(report[name] for _, report in payloads)
+                for name in ('original_bytes', 'sent_bytes', 'bytes_saved', 'latency_saved_ms')
+            }
+    return [data for data, _ in payloads]
+
+def build_chat_messages(images, text_prompt, messages_history, context, preprocess=None, stats=None,
+                        layout='window', labels=None):
+    # `images` is one image or a list of them; `labels` are their numbers in
+    # the conversation, named in the prompt when there are several
+    images = image_list(images)
+    payloads = encode_images(images, preprocess, stats)
+    
+    # In the prefix layout the first question keeps the images and stays at the
+    # front of every request
+    anchor = None
+    if layout == 'prefix' and messages_history and messages_history[0]['role'] == 'user':
+        anchor, messages_history = messages_history[0], messages_history[1:]
+
+    recent_messages = history_messages(messages_history, stats, stable=layout == 'prefix')
+    
+    system_prompt = SYSTEM_PROMPT
+    if layout == 'prefix':
+        # Questions are sent exactly as they are stored in the history, so
+        # each one reads the same in later requests; the context goes into
+        # the system prompt instead
+        if context:
+            system_prompt = {'role': 'system', 'content': f"{SYSTEM_PROMPT['content']}\n\nContext: {context}"}
+        contextualized_prompt = text_prompt
+    else:
         contextualized_prompt = (
             f"Context: {context}\nQuestion: {text_prompt}" 
             if context 
             else text_prompt
         )
-        
+    # Tells the model which of the conversation's images it is looking at
+    attached = ''
+    if len(images) > 1:
+        numbers = labels or range(1, len(images) + 1)
+        attached = f"Attached: {', '.join(f'image {number}' for number in numbers)}\n"
+
+    if anchor is not None:
+        return [
+            system_prompt,
+            {'role': 'user', 'content': attached + anchor['content'], 'images': payloads},
+            *recent_messages,
+            {'role': 'user', 'content': contextualized_prompt}
+        ]
+    
+    return [
+        system_prompt,
+        *recent_messages,
+        {
+            'role': 'user',
+            'content': attached + contextualized_prompt,
+            'images': payloads
+        }
+    ]
+
+def build_text_messages(descriptions, text_prompt, messages_history, context, stats=None):
+    # Request for the text model: the images are replaced by their
+    # descriptions, given as (image number, description) pairs
+    recent_messages = history_messages(messages_history, stats)
+    contextualized_prompt = (
+        f"Context: {context}\nQuestion: {text_prompt}"
+        if context
+        else text_prompt
+    )
+    if len(descriptions) == 1:
+        described = f"You cannot see the image yourself. Here is a detailed description of it:\n{descriptions[0][1]}"
+    else:
+        described = "You cannot see the images yourself. Here are detailed descriptions of them:\n" + "\n\n".join(
+            f"Image {number}: {description}" for number, description in descriptions
+        )
+    return [
+        {
+            'role': 'system',
+            'content': f"{SYSTEM_PROMPT['content']}\n\n{described}"
+        },
+        *recent_messages,
+        {'role': 'user', 'content': contextualized_prompt}
+    ]
+
+@st.cache_resource
+def get_description_store():
+    return DescriptionStore(os.path.join('conversations', 'descriptions'))
+
+def describe_image(image):
+    [(img_byte_arr, _)] = prepare_payloads([image], model_input_size(VISION_MODEL), cache=get_image_payload_cache())
+    # Background work: interactive turns go first
+    with get_scheduler().slot(BATCH):
+        response = get_ollama_client().chat(
+            model=VISION_MODEL,
+            messages=[{'role': 'user', 'content': DESCRIPTION_PROMPT, 'images': [img_byte_arr]}],
+            keep_alive=OLLAMA_KEEP_ALIVE
+        )
+    return response['message']['content']
+
+def warm_text_model():
+    # Loads the text model, so the first routed follow-up doesn't wait for it
+    get_ollama_client().chat(model=TEXT_MODEL, messages=[], keep_alive=OLLAMA_KEEP_ALIVE)
+
+def prefetch_image_description(image):
+    # Writes the description used by routed follow-ups in the background, once
+    # per image; the text model is warmed only after it is stored
+    get_description_store().prefetch(image.content_hash, lambda: describe_image(image),
+                                     after=warm_text_model)
+
+def prepare_request(images, text_prompt, messages_history, context, preprocess=None, stats=None,
+                    layout='window', routing=False):
+    # Picks the model and the images for this prompt and builds its messages;
+    # returns (model, messages, images sent). A prompt naming some of the
+    # images ("compare image 1 and 3") is sent with only those, except in the
+    # prefix layout, whose first question always carries all of them. With
+    # routing on, follow-ups that don't need the pixels go to TEXT_MODEL as
+    # soon as the descriptions of those images are ready; everything else
+    # goes to the vision model.
+    images = image_list(images)
+    if layout == 'prefix':
+        numbers = list(range(1, len(images) + 1))
+    else:
+        numbers = [index + 1 for index in select_images(text_prompt, len(images))]
+    selected = [images[number - 1] for number in numbers]
+    descriptions = None
+    if routing and messages_history and not needs_vision(text_prompt):
+        descriptions = [(number, get_description_store().get(image.content_hash))
+                        for number, image in zip(numbers, selected)]
+        if not all(description for _, description in descriptions):
+            descriptions = None
+    if descriptions:
+        model = TEXT_MODEL
+        messages = build_text_messages(descriptions, text_prompt, messages_history, context, stats)
+    else:
+        model = VISION_MODEL
+        messages = build_chat_messages(
+            selected, text_prompt, messages_history, context, preprocess, stats, layout, labels=numbers
+        )
+    if stats is not None:
+        stats['model'] = model
+        stats['route'] = 'text' if descriptions else 'vision'
+        stats['images_sent'] = numbers
+        stats['image_count'] = len(images)
+    return model, messages, selected
+
+def request_keep_alive(model, layout):
+    return keep_alive_for(layout) if model == VISION_MODEL else OLLAMA_KEEP_ALIVE
+
+def cached_response_key(images, messages, preprocess, model=VISION_MODEL):
+    # The preprocessing settings change the bytes the model sees, so they are
+    # part of the key alongside the hashes of the images sent
+    image_hashes = ','.join(image.content_hash for image in image_list(images))
+    return response_cache_key(model, messages, image_hashes, {'preprocess': preprocess})
+
+def process_image_and_text(images, text_prompt, messages_history, context, preprocess=None, stats=None,
+                           response_cache=None, layout='window', routing=False, cancel=None):
+    # `images` is one image or a list of them (opened or ImageSource).
+    # Pass a ResponseCache to reuse the answer of an identical earlier request;
+    # leave it out to always ask the model. Setting the `cancel` event stops
+    # the generation, whether it is still queued or already running.
+    if cancel is not None:
+        # Streamed internally so it can stop between chunks
+        return ''.join(stream_image_and_text(
+            images, text_prompt, messages_history, context, preprocess, stats, response_cache, layout, routing, cancel
+        )).strip()
+    if image_list(images):
+        start = time.perf_counter()
         try:
-            response = ollama.chat(
-                model='llama3.2-vision',
-                messages=[
-                    system_prompt,
-                    *recent_messages,
-                    {
-                        'role': 'user',
-                        'content': contextualized_prompt,
-                        'images': [img_byte_arr]
-                    }
-                ]
+            model, messages, selected = prepare_request(
+                images, text_prompt, messages_history, context, preprocess, stats, layout, routing
             )
+            if response_cache is not None:
+                cache_key = cached_response_key(selected, messages, preprocess, model)
+                cached = response_cache.get(cache_key)
+                if cached is not None:
+                    if stats is not None:
+                        stats['cache_hit'] = True
+                    return cached
+            with get_scheduler().slot(INTERACTIVE) as queue_wait:
+                response = get_ollama_client().chat(
+                    model=model,
+                    messages=messages,
+                    keep_alive=request_keep_alive(model, layout)
+                )
+            if stats is not None:
+                stats['queue_wait'] = queue_wait
+                stats['total_time'] = time.perf_counter() - start
+                stats['ollama'] = ollama_counters(response)
+            if response_cache is not None:
+                response_cache.put(cache_key, response['message']['content'])
             return response['message']['content']
         except Exception as e:
             return f"Error processing request: {str(e)}"
     return "Please upload an image first"
 
+# How often stream_image_and_text yields an empty chunk while nothing arrives
+HEARTBEAT_INTERVAL = 0.25
+
+def _read_stream(stream, chunks, stop, scheduler):
+    # Runs on its own thread, so the caller can keep yielding heartbeats while
+    # Ollama evaluates the prompt. Holds the scheduler slot until Ollama is
+    # done with the request; closing the stream drops the connection, which
+    # makes Ollama stop generating.
+    try:
+        for chunk in stream:
+            chunks.put(('chunk', chunk))
+            if stop.is_set():
+                break
+        chunks.put(('done', None))
+    except Exception as e:
+        chunks.put(('error', e))
+    finally:
+        stream.close()
+        scheduler.release()
+
+def stream_image_and_text(images, text_prompt, messages_history, context, preprocess=None, stats=None,
+                          response_cache=None, layout='window', routing=False, cancel=None):
+    # Same request as process_image_and_text, but yields the reply chunk by chunk.
+    # Timings are written into `stats` so the caller can keep them with the message.
+    # While the request is queued or Ollama has not sent anything yet, empty
+    # chunks are yielded every HEARTBEAT_INTERVAL, so a caller that updates
+    # the page on each chunk gives Streamlit the chance to abandon the run.
+    # The generation stops when `cancel` is set or the generator is closed
+    # (e.g. when Streamlit abandons the run because the session moved on).
+    if stats is None:
+        stats = {}
+    if not image_list(images):
+        yield "Please upload an image first"
+        return
+    start = time.perf_counter()
+    scheduler = get_scheduler()
+    entry = None
+    scheduled = False
+    stop = None
+    try:
+        model, messages, selected = prepare_request(
+            images, text_prompt, messages_history, context, preprocess, stats, layout, routing
+        )
+        if response_cache is not None:
+            cache_key = cached_response_key(selected, messages, preprocess, model)
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                stats['cache_hit'] = True
+                stats['time_to_first_token'] = time.perf_counter() - start
+                yield cached
+                return
+        entry = scheduler.enqueue(INTERACTIVE)
+        queue_wait = None
+        while queue_wait is None:
+            queue_wait = scheduler.wait(entry, cancel, HEARTBEAT_INTERVAL)
+            if queue_wait is None:
+                yield ''
+        stats['queue_wait'] = queue_wait
+        scheduled = True
+        # The session may have moved on while the slot was being granted
+        if cancel is not None and cancel.is_set():
+            raise Cancelled()
+        # Nothing is sent until the stream is first read, on the reader thread
+        stream = get_ollama_client().chat(
+            model=model,
+            messages=messages,
+            stream=True,
+            keep_alive=request_keep_alive(model, layout)
+        )
+        chunks = queue.Queue()
+        stop = threading.Event()
+        threading.Thread(target=_read_stream, args=(stream, chunks, stop, scheduler),
+                         name='ollama-stream', daemon=True).start()
+        # The reader releases the slot from now on
+        scheduled = False
+        parts = []
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise Cancelled()
+            try:
+                kind, chunk = chunks.get(timeout=HEARTBEAT_INTERVAL)
+            except queue.Empty:
+                yield ''
+                continue
+            if kind == 'error':
+                raise chunk
+            if kind == 'done':
+                break
+            if chunk.get('done'):
+                # The final chunk carries Ollama's own timings and token counts
+                stats['ollama'] = ollama_counters(chunk)
+            content = chunk['message']['content']
+            if content and 'time_to_first_token' not in stats:
+                stats['time_to_first_token'] = time.perf_counter() - start
+            if content:
+                parts.append(content)
+                yield content
+        # Only complete answers are cached
+        if response_cache is not None:
+            response_cache.put(cache_key, ''.join(parts))
+    except (Cancelled, GeneratorExit):
+        # Nothing more is yielded; whatever was streamed so far stays with the caller
+        stats['cancelled'] = True
+        get_metrics().increment('cancelled_generations')
+    except Exception as e:
+        # Keep whatever was already streamed and append the error to it,
+        # so the partial answer is still shown and saved
+        stats['error'] = str(e)
+        yield f"\n\nError processing request: {str(e)}"
+    finally:
+        if entry is not None:
+            scheduler.withdraw(entry)
+        # The reader closes the stream at its next chunk; until Ollama sends
+        # one (while it evaluates the prompt) the request can't be called back
+        if stop is not None:
+            stop.set()
+        if scheduled:
+            scheduler.release()
+        stats['total_time'] = time.perf_counter() - start
+
+def format_bytes(num_bytes):
+    for unit in ['B', 'KB', 'MB']:
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.0f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} GB"
+
+def render_turn_stats(stats):
+    parts = []
+    if 'time_to_first_token' in stats:
+        parts.append(f"First token after {stats['time_to_first_token']:.2f}s, finished after {stats['total_time']:.2f}s")
+    sent = stats.get('images_sent', [])
+    if len(sent) < stats.get('image_count', 0):
+        parts.append(f"Sent image{'s' if len(sent) > 1 else ''} {', '.join(map(str, sent))} of {stats['image_count']}")
+    report = stats.get('preprocess')
+    if report:
+        # The time estimate is the transfer time saved minus the time spent
+        # preparing; when preparing took longer it is shown as a cost
+        details = []
+        if report['bytes_saved'] > 0:
+            details.append(f"saved {format_bytes(report['bytes_saved'])}")
+        if report['latency_saved_ms'] >= 1:
+            details.append(f"~{report['latency_saved_ms']:.0f} ms faster")
+        elif report['latency_saved_ms'] <= -1:
+            details.append(f"preparing cost ~{-report['latency_saved_ms']:.0f} ms")
+        parts.append(
+            f"{'Images' if len(stats.get('images', [])) > 1 else 'Image'} sent as {format_bytes(report['sent_bytes'])}"
+            + (f" ({', '.join(details)})" if details else '')
+        )
+    if len(stats.get('images', [])) > 1:
+        slowest = max(image['encode_ms'] for image in stats['images'])
+        parts.append(
+            f"{len(stats['images'])} images prepared in {stats['encode_time'] * 1000:.0f} ms "
+            f"(slowest {slowest:.0f} ms)"
+        )
+    if stats.get('queue_wait', 0) >= 0.1:
+        parts.append(f"Waited {stats['queue_wait']:.1f}s in queue")
+    if stats.get('cache_hit'):
+        parts.append("Answered from cache")
+    if stats.get('route') == 'text':
+        parts.append(f"Answered by {stats['model']} from the image description")
+    if parts:
+        st.caption(" · ".join(parts))
+
+def render_debug_panel():
+    metrics = get_metrics()
+    with st.expander("Performance", expanded=True):
+        if metrics.recent:
+            last = metrics.recent[-1]
+            counters = last.get('ollama', {})
+            st.markdown("**Last turn**")
+            st.table({
+                'image encode (s)': [round(last.get('encode_time', 0), 3)],
+                'first token (s)': [round(last.get('time_to_first_token', 0), 3)],
+                'generation (s)': [round(last.get('total_time', 0), 3)],
+                'save (s)': [round(last.get('save_time', 0), 3)],
+                'model load (s)': [round(counters.get('load_duration', 0) / 1e9, 3)],
+                'prompt tokens': [counters.get('prompt_eval_count', 0)],
+                'output tokens': [counters.get('eval_count', 0)],
+            })
+        summary = metrics.summary()
+        if summary:
+            st.markdown("**All turns in this process**")
+            st.table({
+                stage: [values['count'], round(values['mean'], 3)]
+                for stage, values in summary.items()
+            })
+            st.caption("Rows: number of samples, mean seconds")
+        last_run = get_storage_maintenance().status()['last_run']
+        if last_run:
+            st.caption(
+                f"Storage: {format_bytes(last_run['usage_bytes'])} after the last cleanup "
+                f"{datetime.fromtimestamp(last_run['finished']).strftime('%Y-%m-%d %H:%M')}: "
+                f"{last_run['removed_files']} files and {last_run['evicted']} conversations removed, "
+                f"{format_bytes(last_run['freed_bytes'])} freed"
+            )
+        st.download_button(
+            "Download Prometheus metrics",
+            metrics.prometheus_text(),
+            file_name="metrics.prom",
+            mime="text/plain"
+        )
+
+def record_turn_metrics(stats):
+    metrics = get_metrics()
+    metrics.record_turn(stats)
+    queue = get_scheduler().stats()
+    metrics.set_gauge('queue_depth', queue['queued'])
+    metrics.set_gauge('running_requests', queue['running'])
+    if METRICS_PROM_FILE:
+        atomic_write_bytes(METRICS_PROM_FILE, metrics.prometheus_text().encode('utf-8'))
+
 def clear_image_state():
-    st.session_state.current_image = None
-    st.session_state.uploaded_file = None
+    st.session_state.current_images = []
+    st.session_state.uploaded_files = {}
     if 'file_uploader_key' not in st.session_state:
         st.session_state.file_uploader_key = 0
     st.session_state.file_uploader_key += 1
@@ -215,10 +845,10 @@ def clear_all_state():
     st.session_state.title = ""  # Reset the title
     st.session_state.is_loading_conversation = False
     st.session_state.current_conversation_filename = None
+    st.session_state.saved_message_count = 0
     clear_image_state()
-    # Remove current_conversation.json
-    if os.path.exists('conversations/current_conversation.json'):
-        os.remove('conversations/current_conversation.json')
+    # Forget this session's open conversation
+    clear_recovery('conversations', get_session_id())
 
 def main():
     st.set_page_config(
@@ -267,14 +897,18 @@ def main():
         st.session_state.title = ''  # Initialize title
     if 'is_loading_conversation' not in st.session_state:
         st.session_state.is_loading_conversation = False
-    if 'current_image' not in st.session_state:
-        st.session_state.current_image = None
-    if 'uploaded_file' not in st.session_state:
-        st.session_state.uploaded_file = None
+    if 'current_images' not in st.session_state:
+        st.session_state.current_images = []
+    if 'uploaded_files' not in st.session_state:
+        # Upload file_id -> hash of the image it added, or None for a duplicate
+        st.session_state.uploaded_files = {}
     if 'file_uploader_key' not in st.session_state:
         st.session_state.file_uploader_key = 0
     if 'current_conversation_filename' not in st.session_state:
         st.session_state.current_conversation_filename = None
+    if 'saved_message_count' not in st.session_state:
+        # Messages of the open conversation already on disk as this session knows it
+        st.session_state.saved_message_count = 0
     if 'delete_all_confirm' not in st.session_state:
         st.session_state.delete_all_confirm = False
     if 'load_conversation_filename' not in st.session_state:
@@ -285,40 +919,56 @@ def main():
         st.session_state.edit_title_target = ''
     if 'new_title' not in st.session_state:
         st.session_state.new_title = ''
-    if 'edit_button_states' not in st.session_state:
-        st.session_state.edit_button_states = {}
-
-    # Attempt to load current conversation if it exists
-    if os.path.exists('conversations/current_conversation.json') and not st.session_state.messages:
-        # Load the conversation data
-        with open('conversations/current_conversation.json', 'r') as f:
-            conversation_data = json.load(f)
-            # Update the timestamp in conversation_data to match the filename
-            timestamp = conversation_data.get('timestamp', '')
-            st.session_state.messages = conversation_data.get('messages', [])
-            st.session_state.context = conversation_data.get('context', '')
-            st.session_state.title = conversation_data.get('title', '')  # Load title
-            st.session_state.is_loading_conversation = False
-            st.session_state.current_conversation_filename = os.path.join(
-                'conversations', f"conversation_{timestamp}.json"
-            )
-            # Load the image if any
-            image = None
-            image_extensions = ['png', 'jpg', 'jpeg']
-            for ext in image_extensions:
-                image_filename = f'image_{timestamp}.{ext}'
-                image_path = os.path.join('conversations', image_filename)
-                if os.path.exists(image_path):
-                    try:
-                        image = Image.open(image_path)
-                        break  # Exit loop if image is found
-                    except Exception as e:
-                        print(f"Error loading image {image_filename}: {e}")
-            if image:
-                st.session_state.current_image = image
-                st.session_state.uploaded_file = None
-            else:
-                clear_image_state()
+    if 'delete_target' not in st.session_state:
+        st.session_state.delete_target = ''
+    if 'conversation_page' not in st.session_state:
+        st.session_state.conversation_page = 0
+    if 'conversation_search_query' not in st.session_state:
+        st.session_state.conversation_search_query = ''
+    if 'stream_responses' not in st.session_state:
+        st.session_state.stream_responses = True
+    if 'preprocess_images' not in st.session_state:
+        st.session_state.preprocess_images = True
+    if 'recompress_images' not in st.session_state:
+        st.session_state.recompress_images = False
+    if 'recompress_quality' not in st.session_state:
+        st.session_state.recompress_quality = 85
+    if 'cache_responses' not in st.session_state:
+        st.session_state.cache_responses = False
+    if 'regenerate_prompt' not in st.session_state:
+        st.session_state.regenerate_prompt = None
+    if 'route_followups' not in st.session_state:
+        st.session_state.route_followups = False
+    if 'prompt_layout' not in st.session_state:
+        st.session_state.prompt_layout = 'window'
+    if 'show_debug_panel' not in st.session_state:
+        st.session_state.show_debug_panel = False
+
+    migrate_conversation_images()
+    get_storage_maintenance()
+    if OLLAMA_PRELOAD:
+        get_model_manager().touch()
+
+    # Attempt to load this session's current conversation if it exists
+    timestamp = read_recovery('conversations', get_session_id()) if not st.session_state.messages else None
+    if timestamp and not os.path.exists(snapshot_path('conversations', timestamp)):
+        # Deleted by another session
+        clear_recovery('conversations', get_session_id(), timestamp)
+        timestamp = None
+    if timestamp:
+        conversation_filename = snapshot_path('conversations', timestamp)
+        conversation_data, images = load_conversation(conversation_filename)
+        st.session_state.messages = conversation_data.get('messages', [])
+        st.session_state.context = conversation_data.get('context', '')
+        st.session_state.title = conversation_data.get('title', '')  # Load title
+        st.session_state.is_loading_conversation = False
+        st.session_state.current_conversation_filename = conversation_filename
+        st.session_state.saved_message_count = len(st.session_state.messages)
+        if images:
+            st.session_state.current_images = images
+            st.session_state.uploaded_files = {}
+        else:
+            clear_image_state()
 
     st.title("Enhanced Image Analysis with Ollama Vision Model")
 
@@ -332,6 +982,50 @@ def main():
                 st.session_state.context,
                 help="Add any relevant context that should be considered during the analysis"
             )
+            st.session_state.stream_responses = st.checkbox(
+                "Stream responses",
+                value=st.session_state.stream_responses,
+                help="Show the reply as it is generated instead of waiting for the full answer"
+            )
+            st.session_state.preprocess_images = st.checkbox(
+                "Optimize image before sending",
+                value=st.session_state.preprocess_images,
+                help="Fix EXIF orientation and downscale the image to the model's input size"
+            )
+            if st.session_state.preprocess_images:
+                st.session_state.recompress_images = st.checkbox(
+                    "Recompress as JPEG",
+                    value=st.session_state.recompress_images
+                )
+                if st.session_state.recompress_images:
+                    st.session_state.recompress_quality = st.slider(
+                        "JPEG quality", 40, 100, st.session_state.recompress_quality
+                    )
+            st.session_state.prompt_layout = 'prefix' if st.checkbox(
+                "Cache-friendly prompt layout",
+                value=st.session_state.prompt_layout == 'prefix',
+                help="Keep the image on the first question and send the history in a stable order, "
+                     "so Ollama can reuse its cached prompt on follow-up questions"
+            ) else 'window'
+            st.session_state.route_followups = st.checkbox(
+                f"Answer text-only follow-ups with {TEXT_MODEL}",
+                value=st.session_state.route_followups,
+                help="Questions that only rework earlier answers (summarize, rephrase, translate...) are "
+                     "answered by a smaller text model from a description of the image. "
+                     "Start a prompt with /vision to always send it to the vision model."
+            )
+            st.session_state.cache_responses = st.checkbox(
+                "Reuse cached answers",
+                value=st.session_state.cache_responses,
+                help="Answer repeated questions about the same image from a cache instead of the model"
+            )
+            if st.session_state.cache_responses:
+                cache_stats = get_response_cache().stats()
+                st.caption(
+                    f"Cache hit rate {cache_stats['hit_rate']:.0%} "
+                    f"({cache_stats['memory_hits']} memory / {cache_stats['disk_hits']} disk hits, "
+                    f"{cache_stats['misses']} misses)"
+                )
             
             if st.button("New Conversation"):
                 if st.session_state.messages and not st.session_state.is_loading_conversation:
@@ -339,33 +1033,41 @@ def main():
                     st.session_state.current_conversation_filename = save_conversation(
                         st.session_state.messages,
                         st.session_state.context,
-                        st.session_state.current_image,
+                        st.session_state.current_images,
                         st.session_state.current_conversation_filename,
-                        title=st.session_state.title  # Pass the title
+                        title=st.session_state.title,  # Pass the title
+                        base_count=st.session_state.saved_message_count
                     )
                 clear_all_state()
                 st.rerun()
             
             st.subheader("Previous Conversations")
-            conversations = get_saved_conversations()
-            for category in ['Today', 'Yesterday', 'Last 7 Days', 'Last 30 Days', 'Older']:
+            query = st.text_input(
+                "Search conversations",
+                key='conversation_search',
+                placeholder="Search titles and messages"
+            )
+            # A new search starts again at the first page
+            if query != st.session_state.conversation_search_query:
+                st.session_state.conversation_search_query = query
+                st.session_state.conversation_page = 0
+            conversations, total = get_saved_conversations(query, st.session_state.conversation_page)
+            page_count = max(1, -(-total // SIDEBAR_PAGE_SIZE))
+            if st.session_state.conversation_page >= page_count:
+                st.session_state.conversation_page = page_count - 1
+                st.rerun()
+            if query.strip():
+                st.caption(f"{total} matching conversation{'s' if total != 1 else ''}")
+            # Only the current page gets widgets; per-conversation state is
+            # limited to the one being renamed or deleted
+            for category in ['Search results', 'Today', 'Yesterday', 'Last 7 Days', 'Last 30 Days', 'Older']:
                 if category in conversations:
                     st.markdown(f"### {category}")
                     for conv in conversations[category]:
-                        timestamp_str = conv['timestamp'].strftime('%Y-%m-%d %H:%M:%S')
-
                         # Create a container for each conversation item
                         with st.container():
                             st.markdown(f"<div class='conversation-item'>", unsafe_allow_html=True)
 
-                            # Unique keys for per-conversation delete confirmation
-                            confirm_key = f"delete_confirm_{conv['filename']}"
-                            target_key = f"delete_target_{conv['filename']}"
-                            if confirm_key not in st.session_state:
-                                st.session_state[confirm_key] = False
-                            if target_key not in st.session_state:
-                                st.session_state[target_key] = ''
-
                             # Display the conversation title
                             st.markdown(f"<div class='conversation-title'>{conv['title']}</div>", unsafe_allow_html=True)
 
@@ -380,10 +1082,7 @@ def main():
                                 with col_save:
                                     if st.button("💾 Save", key=f"save_title_{conv['filename']}"):
                                         # Save the new title
-                                        conv_data, _ = load_conversation(os.path.join('conversations', conv['filename']))
-                                        conv_data['title'] = st.session_state.new_title
-                                        with open(os.path.join('conversations', conv['filename']), 'w') as f:
-                                            json.dump(conv_data, f, indent=4)
+                                        rename_conversation(conv['filename'], st.session_state.new_title)
                                         # Update the title in session state if this is the current conversation
                                         if st.session_state.current_conversation_filename == os.path.join('conversations', conv['filename']):
                                             st.session_state.title = st.session_state.new_title  # Update the title
@@ -407,66 +1106,70 @@ def main():
                                         st.session_state.load_conversation_filename = conv['filename']
                                         st.rerun()
                                 with col_icon2:
-                                    # Initialize button state if not exists
-                                    if f"edit_button_{conv['filename']}" not in st.session_state:
-                                        st.session_state[f"edit_button_{conv['filename']}"] = False
-                                    
-                                    # Edit button
                                     if st.button("✏️", key=f"edit_title_btn_{conv['filename']}", help="Edit Title"):
-                                        st.session_state[f"edit_button_{conv['filename']}"] = True
-
-                                    # Check the button state
-                                    if st.session_state[f"edit_button_{conv['filename']}"]:
                                         st.session_state.edit_title_mode = True
                                         st.session_state.edit_title_target = conv['filename']
                                         st.session_state.new_title = conv['title']
-                                        # Reset the button state
-                                        st.session_state[f"edit_button_{conv['filename']}"] = False
                                         st.rerun()
                                 with col_icon3:
                                     if st.button("🗑️", key=f"delete_{conv['filename']}", help="Delete Conversation"):
-                                        st.session_state[confirm_key] = True
-                                        st.session_state[target_key] = conv['filename']
+                                        st.session_state.delete_target = conv['filename']
                                 st.markdown("</div>", unsafe_allow_html=True)
 
                             # Display the delete confirmation dialog
-                            if st.session_state[confirm_key] and st.session_state[target_key] == conv['filename']:
+                            if st.session_state.delete_target == conv['filename']:
                                 st.error(f"⚠️ Confirm delete **\"{conv['title']}\"**?")
                                 col_confirm, col_cancel = st.columns(2)
                                 with col_confirm:
                                     if st.button("✅ Yes", key=f"confirm_delete_{conv['filename']}"):
-                                        delete_conversation(st.session_state[target_key])
+                                        delete_conversation(conv['filename'])
                                         # Check if the deleted conversation is the current one
-                                        if st.session_state.current_conversation_filename == os.path.join('conversations', st.session_state[target_key]):
+                                        if st.session_state.current_conversation_filename == os.path.join('conversations', conv['filename']):
                                             clear_all_state()
-                                        st.session_state[confirm_key] = False
-                                        st.session_state[target_key] = ''
+                                        st.session_state.delete_target = ''
                                         st.rerun()
                                 with col_cancel:
                                     if st.button("❌ No", key=f"cancel_delete_{conv['filename']}"):
-                                        st.session_state[confirm_key] = False
-                                        st.session_state[target_key] = ''
+                                        st.session_state.delete_target = ''
                                         st.rerun()
 
                             st.markdown("</div>", unsafe_allow_html=True)
 
+            if page_count > 1:
+                col_prev, col_page, col_next = st.columns([1, 2, 1])
+                with col_prev:
+                    if st.button("◀", key='conversation_page_prev', disabled=st.session_state.conversation_page == 0):
+                        st.session_state.conversation_page -= 1
+                        st.rerun()
+                with col_page:
+                    st.caption(f"Page {st.session_state.conversation_page + 1} of {page_count}")
+                with col_next:
+                    if st.button("▶", key='conversation_page_next',
+                                 disabled=st.session_state.conversation_page >= page_count - 1):
+                        st.session_state.conversation_page += 1
+                        st.rerun()
+
             if st.session_state.load_conversation_filename:
                 # Load the conversation
                 filename = st.session_state.load_conversation_filename
-                loaded_conv, loaded_image = load_conversation(os.path.join('conversations', filename))
+                if OLLAMA_PRELOAD:
+                    # Start loading the model while the conversation is read
+                    get_model_manager().preload()
+                loaded_conv, loaded_images = load_conversation(os.path.join('conversations', filename))
                 st.session_state.messages = loaded_conv['messages']
                 st.session_state.context = loaded_conv.get('context', '')
                 st.session_state.title = loaded_conv.get('title', '')  # Store the title
                 st.session_state.is_loading_conversation = True
-                if loaded_image:
-                    st.session_state.current_image = loaded_image
-                    st.session_state.uploaded_file = None
+                if loaded_images:
+                    st.session_state.current_images = loaded_images
+                    st.session_state.uploaded_files = {}
                     # Reset file uploader key to reload the widget
                     st.session_state.file_uploader_key += 1
                 else:
                     clear_image_state()
                 # Set current conversation filename
                 st.session_state.current_conversation_filename = os.path.join('conversations', filename)
+                st.session_state.saved_message_count = len(st.session_state.messages)
                 # Clear the load_conversation_filename after loading
                 st.session_state.load_conversation_filename = None
                 st.rerun()
@@ -481,8 +1184,7 @@ def main():
                 col_confirm_all, col_cancel_all = st.columns([1, 1])
                 with col_confirm_all:
                     if st.button("Yes, Delete All", key="confirm_delete_all"):
-                        if os.path.exists('conversations'):
-                            shutil.rmtree('conversations')
+                        remove_all_conversations('conversations')
                         st.session_state.delete_all_confirm = False
                         # Also clear session state
                         clear_all_state()
@@ -491,68 +1193,216 @@ def main():
                     if st.button("Cancel", key="cancel_delete_all"):
                         st.session_state.delete_all_confirm = False
                         st.rerun()
+        st.session_state.show_debug_panel = st.checkbox(
+            "Show performance panel",
+            value=st.session_state.show_debug_panel
+        )
+        if st.session_state.show_debug_panel:
+            render_debug_panel()
+        if OLLAMA_PRELOAD:
+            render_model_status()
+        queue = get_scheduler().stats()
+        st.caption(
+            f"Requests: {queue['running']}/{queue['slots']} running, {queue['queued']} waiting · "
+            f"mean wait {queue['mean_wait']:.1f}s (max {queue['max_wait']:.1f}s)"
+        )
+        ollama_client = get_ollama_client()
+        if isinstance(ollama_client, BackendPool):
+            with st.expander("Ollama Backends", expanded=False):
+                for backend in ollama_client.status():
+                    state = "🟢" if backend['healthy'] else "🔴"
+                    latency = f"{backend['latency']:.2f}s" if backend['latency'] is not None else "n/a"
+                    st.markdown(f"{state} **{backend['host']}**")
+                    st.caption(
+                        f"{backend['in_flight']} in flight · latency {latency} · "
+                        f"loaded: {', '.join(backend['loaded_models']) or 'none'}"
+                    )
         st.markdown('</div>', unsafe_allow_html=True)
 
     col1, col2 = st.columns(2)
     
     with col1:
-        uploaded_file = st.file_uploader(
-            "Choose an image...",
+        uploaded_files = st.file_uploader(
+            "Choose images...",
             type=['png', 'jpg', 'jpeg'],
+            accept_multiple_files=True,
             key=f"file_uploader_{st.session_state.file_uploader_key}"
         )
         
-        # Display either uploaded image or loaded image
-        if uploaded_file is not None:
-            image = Image.open(uploaded_file)
-            # Ensure the image format is set
-            if not image.format:
-                image_format = uploaded_file.type.split('/')[-1].upper()
-                image.format = image_format
-            st.session_state.current_image = image
-            st.image(image, caption='Uploaded Image', use_container_width=True)
-        elif st.session_state.current_image is not None:
-            st.image(st.session_state.current_image, caption='Loaded Image', use_container_width=True)
+        # Uploads removed from the uploader leave the conversation
+        uploaded_files = uploaded_files or []
+        upload_ids = {uploaded_file.file_id for uploaded_file in uploaded_files}
+        for file_id in list(st.session_state.uploaded_files):
+            if file_id not in upload_ids:
+                removed_hash = st.session_state.uploaded_files.pop(file_id)
+                st.session_state.current_images = [
+                    image for image in st.session_state.current_images if image.content_hash != removed_hash
+                ]
+        # Only new uploads are opened, so reruns reuse the same images; an
+        # image that is already part of the conversation isn't added twice
+        new_files = [
+            uploaded_file for uploaded_file in uploaded_files
+            if uploaded_file.file_id not in st.session_state.uploaded_files
+        ]
+        new_images = map_images(
+            lambda uploaded_file: ImageSource.from_bytes(
+                uploaded_file.getvalue(),
+                uploaded_file.type.split('/')[-1].upper(),
+                get_image_payload_cache()
+            ),
+            new_files
+        )
+        for uploaded_file, image in zip(new_files, new_images):
+            if any(known.content_hash == image.content_hash for known in st.session_state.current_images):
+                st.session_state.uploaded_files[uploaded_file.file_id] = None
+            else:
+                st.session_state.current_images.append(image)
+                st.session_state.uploaded_files[uploaded_file.file_id] = image.content_hash
+
+        # Thumbnails of uploaded and loaded images, numbered the way prompts refer to them
+        images = st.session_state.current_images
+        if images:
+            thumbnails = map_images(get_thumbnail_cache().get, images)
+            columns = st.columns(min(3, len(images)))
+            for index, thumbnail in enumerate(thumbnails):
+                with columns[index % len(columns)]:
+                    st.image(thumbnail, caption=f"Image {index + 1}", use_container_width=True)
     
     for message in st.session_state.messages:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
+
+    # Let the user get a fresh answer when the last one came from the cache
+    last_message = st.session_state.messages[-1] if st.session_state.messages else None
+    if last_message and last_message.get('stats', {}).get('cache_hit') and len(st.session_state.messages) >= 2:
+        if st.button("🔄 Ask again without cache"):
+            st.session_state.regenerate_prompt = st.session_state.messages[-2]['content']
+            st.rerun()
     
-    if prompt := st.chat_input("Enter your prompt here"):
+    prompt = st.chat_input("Enter your prompt here")
+    bypass_cache = False
+    if not prompt and st.session_state.regenerate_prompt:
+        prompt = st.session_state.regenerate_prompt
+        st.session_state.regenerate_prompt = None
+        bypass_cache = True
+    if prompt:
+        # With routing on, "/vision ..." skips it for this prompt
+        routing = st.session_state.route_followups
+        if routing:
+            force_vision, stripped = split_force_vision(prompt)
+            # A bare "/vision" is sent as typed rather than as an empty prompt
+            prompt = stripped or prompt
+            routing = not force_vision
         with st.chat_message("user"):
             st.markdown(prompt)
         
         st.session_state.messages.append({"role": "user", "content": prompt})
         
-        if st.session_state.current_image is not None:
-            with st.spinner('Processing...'):
-                messages_history = [
-                    {"role": m["role"], "content": m["content"]}
-                    for m in st.session_state.messages[:-1]
-                ]
-                response = process_image_and_text(
-                    st.session_state.current_image,
-                    prompt,
-                    messages_history,
-                    st.session_state.context
-                )
+        images = st.session_state.current_images
+        if images:
+            # Full resolution is only opened by the request itself
+            messages_history = [
+                {"role": m["role"], "content": m["content"]}
+                for m in st.session_state.messages[:-1]
+            ]
+            stats = {}
+            preprocess = None
+            if st.session_state.preprocess_images:
+                preprocess = {
+                    'max_side': model_input_size(VISION_MODEL),
+                    'quality': st.session_state.recompress_quality if st.session_state.recompress_images else None
+                }
+            response_cache = None
+            if st.session_state.cache_responses and not bypass_cache:
+                response_cache = get_response_cache()
+            if st.session_state.stream_responses:
+                with st.chat_message("assistant"):
+                    placeholder = st.empty()
+                    placeholder.markdown("_Processing..._")
+                    response = ""
+                    # closing() stops the generation as soon as Streamlit abandons
+                    # this run (new prompt, another conversation, closed tab)
+                    with closing(stream_image_and_text(
+                        images,
+                        prompt,
+                        messages_history,
+                        st.session_state.context,
+                        preprocess,
+                        stats,
+                        response_cache,
+                        layout=st.session_state.prompt_layout,
+                        routing=routing
+                    )) as chunks:
+                        for chunk in chunks:
+                            # Empty chunks arrive while waiting; updating the
+                            # placeholder for them is what lets Streamlit stop
+                            # the run before the answer starts
+                            response += chunk
+                            placeholder.markdown(response + "▌" if response else "_Processing..._")
+                    placeholder.markdown(response)
+                    render_turn_stats(stats)
+            else:
+                with st.spinner('Processing...'):
+                    # Streamed underneath so the run stays interruptible; only a
+                    # progress line is shown until the answer is complete
+                    progress = st.empty()
+                    parts = []
+                    with closing(stream_image_and_text(
+                        images,
+                        prompt,
+                        messages_history,
+                        st.session_state.context,
+                        preprocess,
+                        stats,
+                        response_cache,
+                        layout=st.session_state.prompt_layout,
+                        routing=routing
+                    )) as chunks:
+                        for chunk in chunks:
+                            if chunk:
+                                parts.append(chunk)
+                            # Also on empty chunks, so the run can be stopped while waiting
+                            progress.caption(
+                                f"Receiving answer ({len(parts)} chunks)..." if parts else "Waiting for the model..."
+                            )
+                    progress.empty()
+                    response = ''.join(parts).strip()
                 
                 with st.chat_message("assistant"):
                     st.markdown(response)
-                
-                st.session_state.messages.append({"role": "assistant", "content": response})
-                
-                # Reset is_loading_conversation after new messages are added
-                st.session_state.is_loading_conversation = False
-                
-                # Auto-save the conversation with new timestamp
-                st.session_state.current_conversation_filename = save_conversation(
-                    st.session_state.messages,
-                    st.session_state.context,
-                    st.session_state.current_image,
-                    st.session_state.current_conversation_filename,
-                    title=st.session_state.title  # Pass the stored title
-                )
+                    render_turn_stats(stats)
+            
+            assistant_message = {"role": "assistant", "content": response}
+            if stats:
+                assistant_message['stats'] = stats
+            st.session_state.messages.append(assistant_message)
+            
+            if st.session_state.route_followups and stats.get('route') == 'vision':
+                for number in stats.get('images_sent', []):
+                    prefetch_image_description(images[number - 1])
+
+            # Reset is_loading_conversation after new messages are added
+            st.session_state.is_loading_conversation = False
+            
+            # Auto-save the conversation with new timestamp
+            save_start = time.perf_counter()
+            previous_filename = st.session_state.current_conversation_filename
+            st.session_state.current_conversation_filename = save_conversation(
+                st.session_state.messages,
+                st.session_state.context,
+                images,
+                previous_filename,
+                title=st.session_state.title,  # Pass the stored title
+                base_count=st.session_state.saved_message_count
+            )
+            st.session_state.saved_message_count = len(st.session_state.messages)
+            forked = (
+                previous_filename and os.path.exists(previous_filename)
+                and st.session_state.current_conversation_filename != previous_filename
+            )
+            if forked:
+                st.info("This conversation was continued in another tab, so this turn was saved as a new conversation.")
+            record_turn_metrics({**stats, 'save_time': time.perf_counter() - save_start})
         else:
             st.error("Please upload an image")
 
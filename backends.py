@@ -0,0 +1,254 @@
+import asyncio
+import os
+import threading
+import time
+
+from ollama_client import create_async_client, create_client
+
+# Routing across several Ollama servers.
+#
+# BackendPool takes a list of hosts, health-checks them in the background and
+# sends each chat request to the least-loaded healthy host. Hosts that already
+# have the requested model in memory are preferred, and a request that fails
+# on one host is retried on the next. With max_in_flight set, no host gets more
+# requests than that at once; a request waits for a free host instead, so a
+# host that is down or cold doesn't push its share onto the others. The pool
+# exposes the same chat() call as ollama.Client, so it can be used wherever a
+# client is expected.
+#
+# Hosts come from OLLAMA_HOSTS as a comma separated list, e.g.
+#   OLLAMA_HOSTS=http://gpu1:11434,http://gpu2:11434
+
+HEALTH_CHECK_INTERVAL = float(os.environ.get('OLLAMA_HEALTH_CHECK_INTERVAL', 15))
+# How many in-flight requests a warm host is worth compared to one that would
+# have to load the model first
+COLD_START_PENALTY = 2
+# Consecutive request failures before a host is taken out of rotation until
+# its next successful health check
+MAX_FAILURES = 2
+# Weight of the newest sample in the moving average of request latency
+LATENCY_SMOOTHING = 0.3
+# How often a request waiting for a free host looks again
+WAIT_INTERVAL = 0.05
+
+def configured_hosts():
+    return [host.strip() for host in os.environ.get('OLLAMA_HOSTS', '').split(',') if host.strip()]
+
+def model_names(name):
+    # "llama3.2-vision" and "llama3.2-vision:latest" refer to the same model
+    return {name, name if ':' in name else f"{name}:latest"}
+
+class Backend:
+    def __init__(self, host, client_factory=create_client, async_client_factory=create_async_client):
+        self.host = host
+        self.client = client_factory(host)
+        self._async_client_factory = async_client_factory
+        self._async_clients = {}
+        self.healthy = True
+        self.failures = 0
+        self.in_flight = 0
+        self.latency = None
+        self.loaded_models = set()
+        self.last_check = None
+        self.last_error = None
+
+    def async_client(self):
+        # AsyncClient is tied to an event loop, so keep one per loop
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = self._async_client_factory(self.host)
+            self._async_clients[loop] = client
+        return client
+
+    def has_model(self, model):
+        return bool(model_names(model) & self.loaded_models)
+
+    def status(self):
+        return {
+            'host': self.host,
+            'healthy': self.healthy,
+            'in_flight': self.in_flight,
+            'latency': self.latency,
+            'loaded_models': sorted(self.loaded_models),
+            'last_check': self.last_check,
+            'last_error': self.last_error,
+        }
+
+class BackendPool:
+    def __init__(self, hosts, check_interval=HEALTH_CHECK_INTERVAL, client_factory=create_client,
+                 async_client_factory=create_async_client, max_in_flight=None):
+        if not hosts:
+            raise ValueError("BackendPool needs at least one host")
+        self.backends = [Backend(host, client_factory, async_client_factory) for host in hosts]
+        self.check_interval = check_interval
+        # Requests per host at once; None means no limit
+        self.max_in_flight = max_in_flight
+        self._lock = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        # Check once up front so the first request already knows which hosts are up
+        self.check_health()
+        if self._thread is None and self.check_interval:
+            self._thread = threading.Thread(target=self._health_loop, name='ollama-health', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _health_loop(self):
+        while not self._stop.wait(self.check_interval):
+            self.check_health()
+
+    def check_health(self):
+        for backend in self.backends:
+            try:
+                running = backend.client.ps()
+                loaded = {model.model or model.name for model in running.models}
+                with self._lock:
+                    backend.loaded_models = loaded
+                    backend.healthy = True
+                    backend.failures = 0
+                    backend.last_error = None
+            except Exception as e:
+                with self._lock:
+                    backend.healthy = False
+                    backend.last_error = str(e)
+            backend.last_check = time.time()
+
+    def status(self):
+        with self._lock:
+            return [backend.status() for backend in self.backends]
+
+    def _try_begin(self, model, tried):
+        # Called with the lock held. Picks the host for the next attempt and
+        # counts the request against it: the healthy hosts not tried yet,
+        # ordered by load (warm hosts get a head start) and then by recent
+        # latency, or the unhealthy ones as a last resort. Returns the host,
+        # True if all of them are at max_in_flight, or None if none are left.
+        untried = [backend for backend in self.backends if backend not in tried]
+        candidates = [backend for backend in untried if backend.healthy] or untried
+        if not candidates:
+            return None
+
+        def score(backend):
+            penalty = 0 if backend.has_model(model) else COLD_START_PENALTY
+            latency = backend.latency if backend.latency is not None else 0
+            return (backend.in_flight + penalty, latency)
+        for backend in sorted(candidates, key=score):
+            if self.max_in_flight is None or backend.in_flight < self.max_in_flight:
+                backend.in_flight += 1
+                return backend
+        return True
+
+    def _begin(self, model, tried):
+        # Blocks while every candidate host is full; returns (host, start) or
+        # (None, None) once every host has been tried
+        with self._lock:
+            while True:
+                backend = self._try_begin(model, tried)
+                if backend is not True:
+                    break
+                self._lock.wait(WAIT_INTERVAL)
+        if backend is None:
+            return None, None
+        tried.add(backend)
+        return backend, time.perf_counter()
+
+    async def _begin_async(self, model, tried):
+        # Same as _begin, without blocking the event loop while waiting
+        while True:
+            with self._lock:
+                backend = self._try_begin(model, tried)
+            if backend is not True:
+                break
+            await asyncio.sleep(WAIT_INTERVAL)
+        if backend is None:
+            return None, None
+        tried.add(backend)
+        return backend, time.perf_counter()
+
+    def _finish(self, backend, start, model, error=None):
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            backend.in_flight -= 1
+            self._lock.notify_all()
+            if error is None:
+                backend.failures = 0
+                backend.latency = elapsed if backend.latency is None else (
+                    LATENCY_SMOOTHING * elapsed + (1 - LATENCY_SMOOTHING) * backend.latency
+                )
+                # A successful request leaves the model loaded on that host
+                backend.loaded_models |= model_names(model)
+            else:
+                backend.failures += 1
+                backend.last_error = str(error)
+                if backend.failures >= MAX_FAILURES:
+                    backend.healthy = False
+
+    def chat(self, model='', messages=None, stream=False, **kwargs):
+        if stream:
+            return self._chat_stream(model, messages, **kwargs)
+        last_error = None
+        tried = set()
+        while True:
+            backend, start = self._begin(model, tried)
+            if backend is None:
+                break
+            try:
+                response = backend.client.chat(model=model, messages=messages, **kwargs)
+            except Exception as e:
+                self._finish(backend, start, model, e)
+                last_error = e
+                continue
+            self._finish(backend, start, model)
+            return response
+        raise last_error
+
+    def _chat_stream(self, model, messages, **kwargs):
+        # A stream can move to another host only until its first chunk arrives;
+        # after that an error is passed on to the caller
+        last_error = None
+        tried = set()
+        while True:
+            backend, start = self._begin(model, tried)
+            if backend is None:
+                break
+            started = False
+            try:
+                for chunk in backend.client.chat(model=model, messages=messages, stream=True, **kwargs):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                self._finish(backend, start, model, e)
+                if started:
+                    raise
+                last_error = e
+                continue
+            except BaseException:
+                # Generator closed early by the caller
+                self._finish(backend, start, model)
+                raise
+            self._finish(backend, start, model)
+            return
+        raise last_error
+
+    async def achat(self, model='', messages=None, **kwargs):
+        last_error = None
+        tried = set()
+        while True:
+            backend, start = await self._begin_async(model, tried)
+            if backend is None:
+                break
+            try:
+                response = await backend.async_client().chat(model=model, messages=messages, **kwargs)
+            except Exception as e:
+                self._finish(backend, start, model, e)
+                last_error = e
+                continue
+            self._finish(backend, start, model)
+            return response
+        raise last_error
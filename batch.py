@@ -0,0 +1,218 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+from App import VISION_MODEL, build_chat_messages
+from image_utils import load_image_file, model_input_size
+from backends import BackendPool, configured_hosts
+from ollama_client import create_async_client, create_client
+
+# Headless batch mode: run one prompt over a directory (or manifest) of images
+# with the same system prompt, context injection and model as the chat UI.
+# Results are appended to a JSONL file as they finish; rerunning with the same
+# output file skips images that already succeeded with the same prompt and
+# context.
+#
+#   python batch.py photos/ --prompt "Describe the product" --output results.jsonl
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# App's shared caches work outside a Streamlit run, but warn once per worker thread
+logging.getLogger('streamlit.runtime.scriptrunner_utils.script_run_context').setLevel(logging.ERROR)
+
+def collect_jobs(source, prompt, context):
+    # A directory is walked recursively for images. A manifest is either a text
+    # file with one image path per line, or JSONL with an "image" field and
+    # optional per-image "prompt" and "context".
+    jobs = []
+    if os.path.isdir(source):
+        for root, _, files in os.walk(source):
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    jobs.append({'image': os.path.join(root, name), 'prompt': prompt, 'context': context})
+        jobs.sort(key=lambda job: job['image'])
+        return jobs
+
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('{'):
+                entry = json.loads(line)
+                job = {
+                    'image': entry['image'],
+                    'prompt': entry.get('prompt', prompt),
+                    'context': entry.get('context', context),
+                }
+            else:
+                job = {'image': line, 'prompt': prompt, 'context': context}
+            if not os.path.isabs(job['image']):
+                job['image'] = os.path.join(base, job['image'])
+            jobs.append(job)
+    return jobs
+
+def job_key(job):
+    return (job['image'], job['prompt'], job['context'])
+
+def load_checkpoint(output):
+    # (image, prompt, context) of the jobs that already have a successful
+    # result in the output file. Records written before the context was stored
+    # can't be matched to a job, so those images run again.
+    done = set()
+    if not os.path.exists(output):
+        return done
+    with open(output, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('status') == 'ok' and 'context' in record:
+                done.add(job_key(record))
+    return done
+
+async def analyze_image(client, job, model, preprocess, retries):
+    attempt = 0
+    while True:
+        attempt += 1
+        start = time.perf_counter()
+        try:
+            # Decoding and preprocessing are CPU work; run them off the event loop
+            image = await asyncio.to_thread(load_image_file, job['image'])
+            stats = {}
+            messages = await asyncio.to_thread(
+                build_chat_messages, image, job['prompt'], [], job['context'], preprocess, stats
+            )
+            chat = client.achat if isinstance(client, BackendPool) else client.chat
+            response = await chat(model=model, messages=messages)
+            return {
+                'image': job['image'],
+                'status': 'ok',
+                'prompt': job['prompt'],
+                'context': job['context'],
+                'response': response['message']['content'],
+                'attempts': attempt,
+                'seconds': time.perf_counter() - start,
+                'eval_count': response.get('eval_count') or 0,
+                'prompt_eval_count': response.get('prompt_eval_count') or 0,
+                'bytes_sent': stats['preprocess']['sent_bytes'] if 'preprocess' in stats else None,
+            }
+        except Exception as e:
+            if attempt > retries:
+                return {
+                    'image': job['image'],
+                    'status': 'error',
+                    'prompt': job['prompt'],
+                    'context': job['context'],
+                    'error': str(e),
+                    'attempts': attempt,
+                    'seconds': time.perf_counter() - start,
+                }
+            # Exponential backoff with jitter so failed requests do not retry in lockstep
+            await asyncio.sleep(min(30, 2 ** (attempt - 1)) * (0.5 + random.random()))
+
+async def _run_batch(pending_jobs, out, summary, model, concurrency, retries, preprocess, timeout, hosts, report):
+    # All requests share one event loop and pooled async clients; the number
+    # of in-flight requests is capped at `concurrency`
+    if hosts:
+        # Each host takes its share of `concurrency`, also while another is down
+        client = BackendPool(
+            hosts,
+            client_factory=lambda host: create_client(host, read_timeout=timeout),
+            async_client_factory=lambda host: create_async_client(host, read_timeout=timeout, max_connections=concurrency),
+            max_in_flight=-(-concurrency // len(hosts))
+        ).start()
+    else:
+        client = create_async_client(read_timeout=timeout, max_connections=concurrency)
+    jobs_iter = iter(pending_jobs)
+    in_flight = set()
+    while True:
+        # The next image is only started once a slot frees up
+        while len(in_flight) < concurrency:
+            job = next(jobs_iter, None)
+            if job is None:
+                break
+            in_flight.add(asyncio.create_task(analyze_image(client, job, model, preprocess, retries)))
+        if not in_flight:
+            break
+        finished, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+        for task in finished:
+            record = task.result()
+            out.write(json.dumps(record) + '\n')
+            out.flush()
+            summary[record['status']] += 1
+            summary['eval_count'] += record.get('eval_count', 0)
+            report(periodic=True)
+
+def run_batch(jobs, output, model=VISION_MODEL, concurrency=4, retries=2, preprocess=None,
+              timeout=300, hosts=None, report_every=10, log=sys.stderr):
+    done = load_checkpoint(output)
+    pending_jobs = [job for job in jobs if job_key(job) not in done]
+    if len(pending_jobs) < len(jobs):
+        print(f"Resuming: {len(jobs) - len(pending_jobs)} of {len(jobs)} images already done", file=log)
+
+    summary = {'ok': 0, 'error': 0, 'eval_count': 0}
+    start = time.perf_counter()
+
+    def report(periodic=False):
+        finished = summary['ok'] + summary['error']
+        if periodic and finished % report_every:
+            return
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        summary['images_per_second'] = finished / elapsed
+        summary['tokens_per_second'] = summary['eval_count'] / elapsed
+        summary['elapsed'] = elapsed
+        print(
+            f"{finished}/{len(pending_jobs)} images, {summary['error']} failed, "
+            f"{summary['images_per_second']:.2f} images/s, {summary['tokens_per_second']:.1f} tokens/s",
+            file=log
+        )
+
+    with open(output, 'a') as out:
+        asyncio.run(_run_batch(
+            pending_jobs, out, summary, model, concurrency, retries, preprocess, timeout, hosts, report
+        ))
+    report()
+    return summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a vision prompt over a directory of images")
+    parser.add_argument('source', help="Image directory, or a manifest file (one path per line or JSONL)")
+    parser.add_argument('--prompt', required=True, help="Prompt to send with every image")
+    parser.add_argument('--context', default='', help="Optional context, injected the same way as in the chat UI")
+    parser.add_argument('--output', default='batch_results.jsonl', help="JSONL file for results; also the resume checkpoint")
+    parser.add_argument('--model', default=VISION_MODEL)
+    parser.add_argument('--concurrency', type=int, default=4, help="Maximum number of requests in flight")
+    parser.add_argument('--retries', type=int, default=2, help="Retries per image before it is recorded as failed")
+    parser.add_argument('--timeout', type=float, default=300, help="Per-request timeout in seconds")
+    parser.add_argument('--hosts', default=None,
+                        help="Comma separated Ollama hosts to spread requests over (default: OLLAMA_HOSTS)")
+    parser.add_argument('--no-preprocess', action='store_true', help="Send images at full resolution")
+    parser.add_argument('--quality', type=int, default=None, help="Recompress images as JPEG at this quality")
+    args = parser.parse_args(argv)
+
+    preprocess = None
+    if not args.no_preprocess:
+        preprocess = {'max_side': model_input_size(args.model), 'quality': args.quality}
+
+    jobs = collect_jobs(args.source, args.prompt, args.context)
+    summary = run_batch(
+        jobs, args.output,
+        model=args.model,
+        concurrency=args.concurrency,
+        retries=args.retries,
+        preprocess=preprocess,
+        timeout=args.timeout,
+        hosts=[host.strip() for host in args.hosts.split(',')] if args.hosts else configured_hosts()
+    )
+    return 0 if summary['error'] == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,227 @@
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from backends import MAX_FAILURES, BackendPool
+from ollama_client import create_async_client, create_client
+from stub_ollama import FAULTS, StubOllama, serve
+
+# Checks BackendPool against several stub Ollama servers that fail on demand:
+#   dispatch   concurrent requests spread over the least-loaded hosts, hosts
+#              with the model loaded go first, and no host runs more than
+#              --per-host requests at once, even with another host down
+#   failover   a request to a host that answers 500, drops the connection or
+#              hangs is retried on another host, for chat, streamed chat and
+#              achat alike
+#   health     repeated failures and failed health checks take a host out of
+#              rotation, and a passing health check brings it back
+# Exits with status 1 if any check fails.
+#
+#   python benchmarks/failover_check.py --hosts 3
+
+MODEL = 'stub-model'
+MESSAGES = [{'role': 'user', 'content': 'hello'}]
+
+class Checker:
+    def __init__(self):
+        self.failed = 0
+
+    def check(self, name, condition, detail=''):
+        print(f"{'ok  ' if condition else 'FAIL'} {name}{f' ({detail})' if detail else ''}")
+        if not condition:
+            self.failed += 1
+
+def _reset(stubs, pool, warm=()):
+    # No faults, and MODEL loaded on the stubs at the indices in `warm`
+    for index, stub in enumerate(stubs):
+        stub.fault = None
+        stub.loaded.clear()
+        if index in warm:
+            stub.loaded[MODEL] = datetime.now(timezone.utc) + timedelta(minutes=5)
+    for backend in pool.backends:
+        backend.in_flight = 0
+        backend.latency = None
+    pool.check_health()
+
+def _requests(stubs):
+    return [stub.requests for stub in stubs]
+
+def _concurrent_chats(pool, count, stagger):
+    errors = []
+
+    def run():
+        try:
+            pool.chat(model=MODEL, messages=MESSAGES)
+        except Exception as e:
+            errors.append(e)
+
+    threads = []
+    for _ in range(count):
+        thread = threading.Thread(target=run)
+        thread.start()
+        threads.append(thread)
+        time.sleep(stagger)
+    for thread in threads:
+        thread.join()
+    return errors
+
+def check_dispatch(checker, stubs, pool, args):
+    count = len(stubs)
+    _reset(stubs, pool, warm=range(count))
+    before = _requests(stubs)
+    errors = _concurrent_chats(pool, 2 * count, args.stagger)
+    spread = [after - start for after, start in zip(_requests(stubs), before)]
+    checker.check("concurrent requests spread evenly over warm hosts",
+                  not errors and spread == [2] * count, f"per host {spread}")
+
+    # Only the first two hosts have the model; four requests at once fill
+    # them before the cold host is worth a model load
+    _reset(stubs, pool, warm=(0, 1))
+    before = _requests(stubs)
+    errors = _concurrent_chats(pool, 4, args.stagger)
+    spread = [after - start for after, start in zip(_requests(stubs), before)]
+    checker.check("warm hosts are preferred over a cold one",
+                  not errors and spread[:2] == [2, 2] and sum(spread[2:]) == 0, f"per host {spread}")
+
+    # More requests than the healthy hosts may run at once: the rest wait
+    # instead of piling onto them
+    for name, warm, down in (("another host is down", range(count), (0,)), ("only one host is warm", (0,), ())):
+        _reset(stubs, pool, warm=warm)
+        for index in down:
+            stubs[index].fault = 'error'
+        pool.check_health()
+        for stub in stubs:
+            stub.max_active = 0
+        errors = _concurrent_chats(pool, 3 * args.per_host * count, args.stagger)
+        peaks = [stub.max_active for stub in stubs]
+        checker.check(f"no host runs more than {args.per_host} requests when {name}",
+                      not errors and max(peaks) <= args.per_host, f"most at once per host {peaks}")
+
+def check_failover(checker, stubs, pool, args):
+    for fault in FAULTS:
+        # Every host but the last fails this way
+        _reset(stubs, pool, warm=range(len(stubs)))
+        for stub in stubs[:-1]:
+            stub.fault = fault
+        before = stubs[-1].requests
+        start = time.perf_counter()
+        try:
+            response = pool.chat(model=MODEL, messages=MESSAGES)
+            error = None
+        except Exception as e:
+            response, error = None, e
+        elapsed = time.perf_counter() - start
+        checker.check(f"chat fails over from '{fault}' hosts",
+                      error is None and bool(response['message']['content']) and stubs[-1].requests == before + 1,
+                      f"{elapsed:.2f}s" if error is None else repr(error))
+        failures = [backend.failures for backend in pool.backends]
+        checker.check(f"'{fault}' failures are counted against the failing hosts",
+                      failures == [1] * (len(stubs) - 1) + [0], f"failures {failures}")
+
+    _reset(stubs, pool, warm=range(len(stubs)))
+    for stub in stubs[:-1]:
+        stub.fault = 'drop'
+    before = stubs[-1].requests
+    try:
+        text = ''.join(chunk['message']['content'] for chunk in pool.chat(model=MODEL, messages=MESSAGES, stream=True))
+        error = None
+    except Exception as e:
+        text, error = '', e
+    checker.check("streamed chat fails over before its first chunk",
+                  error is None and bool(text) and stubs[-1].requests == before + 1,
+                  '' if error is None else repr(error))
+
+    _reset(stubs, pool, warm=range(len(stubs)))
+    for stub in stubs[:-1]:
+        stub.fault = 'error'
+    try:
+        response = asyncio.run(pool.achat(model=MODEL, messages=MESSAGES))
+        error = None
+    except Exception as e:
+        response, error = None, e
+    checker.check("achat fails over", error is None and bool(response['message']['content']),
+                  '' if error is None else repr(error))
+
+    _reset(stubs, pool, warm=range(len(stubs)))
+    for stub in stubs:
+        stub.fault = 'error'
+    try:
+        pool.chat(model=MODEL, messages=MESSAGES)
+        error = None
+    except Exception as e:
+        error = e
+    checker.check("chat raises once every host has failed", error is not None)
+
+def check_health(checker, stubs, pool, args):
+    _reset(stubs, pool, warm=range(len(stubs)))
+    stubs[0].fault = 'error'
+    for attempt in range(MAX_FAILURES):
+        # Nothing else in flight, so the first host is always tried first
+        pool.chat(model=MODEL, messages=MESSAGES)
+        checker.check(f"host healthy until {MAX_FAILURES} failures (after {attempt + 1})",
+                      pool.backends[0].healthy == (attempt + 1 < MAX_FAILURES))
+    faults = stubs[0].faults
+    for _ in range(3):
+        pool.chat(model=MODEL, messages=MESSAGES)
+    checker.check("an unhealthy host gets no requests", stubs[0].faults == faults,
+                  f"{stubs[0].faults - faults} more")
+
+    stubs[0].fault = None
+    pool.check_health()
+    checker.check("a passing health check brings the host back", pool.backends[0].healthy)
+
+    for fault in FAULTS:
+        _reset(stubs, pool, warm=range(len(stubs)))
+        stubs[0].fault = fault
+        start = time.perf_counter()
+        pool.check_health()
+        elapsed = time.perf_counter() - start
+        status = pool.backends[0].status()
+        checker.check(f"a health check marks a '{fault}' host unhealthy",
+                      not status['healthy'] and status['last_error'] and all(b.healthy for b in pool.backends[1:]),
+                      f"{elapsed:.2f}s")
+    _reset(stubs, pool)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check BackendPool failover against failing stub Ollama servers")
+    parser.add_argument('--hosts', type=int, default=3, help="Stub servers to start (at least 2)")
+    parser.add_argument('--latency', type=float, default=0.3, help="Stub: seconds before the first token")
+    parser.add_argument('--timeout', type=float, default=1.0, help="Client read timeout, so hung hosts give up")
+    parser.add_argument('--stagger', type=float, default=0.02, help="Seconds between concurrent requests")
+    parser.add_argument('--per-host', type=int, default=2, help="Requests each host may run at once")
+    args = parser.parse_args(argv)
+    if args.hosts < 2:
+        parser.error("--hosts must be at least 2")
+
+    stubs = [StubOllama(latency=args.latency, token_rate=0, tokens=4, hang_seconds=args.timeout * 5)
+             for _ in range(args.hosts)]
+    servers = [serve(stub) for stub in stubs]
+    hosts = [f"http://127.0.0.1:{server.server_port}" for server in servers]
+    pool = BackendPool(
+        hosts, check_interval=0,
+        client_factory=lambda host: create_client(host, read_timeout=args.timeout),
+        async_client_factory=lambda host: create_async_client(host, read_timeout=args.timeout),
+        max_in_flight=args.per_host,
+    ).start()
+
+    checker = Checker()
+    try:
+        for check in (check_dispatch, check_failover, check_health):
+            check(checker, stubs, pool, args)
+    finally:
+        pool.stop()
+        for server in servers:
+            server.shutdown()
+    print(f"{checker.failed} failed" if checker.failed else "all checks passed")
+    return 1 if checker.failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
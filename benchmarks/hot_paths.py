@@ -0,0 +1,381 @@
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+# Benchmarks for the app's hot paths, run against the stub Ollama server in
+# benchmarks/stub_ollama.py (or a real server with --host):
+#   generation  throughput and time to first token of process_image_and_text,
+#               at each --concurrency level
+#   storage     save_conversation / load_conversation as conversations grow
+#   listing     get_saved_conversations as the store grows to --store-sizes
+#   encode      image encoding and preprocessing across image sizes, and a
+#               request with --images images prepared one after another vs.
+#               side by side
+# Everything runs in a scratch directory. Results are written as JSON; pass
+# --compare with an earlier result file to see what changed.
+#
+#   python benchmarks/hot_paths.py --output before.json
+#   python benchmarks/hot_paths.py --output after.json --compare before.json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SUITES = ('generation', 'storage', 'listing', 'encode')
+
+logging.getLogger('streamlit.runtime.scriptrunner_utils.script_run_context').setLevel(logging.ERROR)
+logging.getLogger('streamlit.runtime.state.session_state_proxy').setLevel(logging.ERROR)
+logging.getLogger('streamlit.runtime.caching.cache_data_api').setLevel(logging.ERROR)
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else None
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+def _summary(values):
+    # p50 / p95 / mean of a list of seconds, in milliseconds
+    return {
+        'p50_ms': _ms(_percentile(values, 0.5)),
+        'p95_ms': _ms(_percentile(values, 0.95)),
+        'mean_ms': _ms(sum(values) / len(values)) if values else None,
+    }
+
+def _timed(fn, repeat, budget=10.0):
+    # Runs fn up to `repeat` times, fewer if the runs so far took over `budget` seconds
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+        if sum(times) > budget:
+            break
+    return times
+
+def _test_image(side, image_format='JPEG'):
+    # A photo-like test image: gradients plus noise, so it compresses like a
+    # real picture rather than a flat color
+    from PIL import Image
+    width, height = side, side * 3 // 4
+    gradient = Image.linear_gradient('L').resize((width, height))
+    noise = Image.effect_noise((width, height), 40)
+    image = Image.merge('RGB', (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, quality=90)
+    return buffer.getvalue()
+
+def _start_stub(args):
+    command = [
+        sys.executable, os.path.join(ROOT, 'benchmarks', 'stub_ollama.py'), '--port', '0',
+        '--latency', str(args.latency), '--token-rate', str(args.token_rate), '--tokens', str(args.tokens),
+        '--parallel', str(args.stub_parallel),
+    ]
+    # A separate process, so the server doesn't compete with the app code for the GIL
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    return process, process.stdout.readline().strip()
+
+def bench_generation(App, args):
+    from image_utils import ImageSource
+    image = ImageSource.from_bytes(_test_image(1024)).open(App.get_image_payload_cache())
+    history = [
+        {'role': 'user', 'content': "Describe this image."},
+        {'role': 'assistant', 'content': "A gradient with some noise on top. " * 10},
+    ]
+    preprocess = {'max_side': App.model_input_size(App.VISION_MODEL)}
+    # Warm up connections, the payload cache and the model
+    App.process_image_and_text(image, "Warm up", history, '', preprocess)
+
+    results = []
+    for streamed in (False, True):
+        for concurrency in args.concurrency:
+            turns = []
+            lock = threading.Lock()
+
+            def worker(count):
+                for _ in range(count):
+                    stats = {}
+                    start = time.perf_counter()
+                    # With a cancel event the reply is streamed, which records
+                    # the time to the first token
+                    App.process_image_and_text(
+                        image, "What stands out?", history, '', preprocess, stats,
+                        cancel=threading.Event() if streamed else None
+                    )
+                    stats['latency'] = time.perf_counter() - start
+                    with lock:
+                        turns.append(stats)
+
+            per_worker = max(1, args.requests // concurrency)
+            threads = [threading.Thread(target=worker, args=(per_worker,)) for _ in range(concurrency)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+
+            tokens = sum(turn.get('ollama', {}).get('eval_count', 0) for turn in turns)
+            errors = sum(1 for turn in turns if 'ollama' not in turn)
+            result = {
+                'key': f"generation/{'stream' if streamed else 'blocking'}/c{concurrency}",
+                'streamed': streamed,
+                'concurrency': concurrency,
+                'requests': len(turns),
+                'errors': errors,
+                'requests_per_second': round(len(turns) / elapsed, 3),
+                'tokens_per_second': round(tokens / elapsed, 1),
+                'latency': _summary([turn['latency'] for turn in turns]),
+                'queue_wait': _summary([turn['queue_wait'] for turn in turns if 'queue_wait' in turn]),
+                'encode': _summary([turn['encode_time'] for turn in turns if 'encode_time' in turn]),
+            }
+            if streamed:
+                result['time_to_first_token'] = _summary(
+                    [turn['time_to_first_token'] for turn in turns if 'time_to_first_token' in turn]
+                )
+            results.append(result)
+    return results
+
+def _messages(count):
+    return [
+        {'role': 'user' if index % 2 == 0 else 'assistant',
+         'content': f"Message {index}: " + "some words about the picture " * 8}
+        for index in range(count)
+    ]
+
+def bench_storage(App, args):
+    results = []
+    for length in args.lengths:
+        messages = _messages(length)
+        created = []
+
+        def create():
+            created.append(App.save_conversation(messages, 'context', title=f"bench {length}"))
+
+        create_times = _timed(create, args.repeat)
+        filename = created[-1]
+
+        # The usual case: one more turn on an existing conversation
+        history = list(messages)
+
+        def append_turn():
+            base_count = len(history)
+            history.extend(_messages(2))
+            App.save_conversation(
+                history, 'context', filename=filename, title=f"bench {length}", base_count=base_count
+            )
+
+        append_times = _timed(append_turn, args.repeat)
+        load_times = _timed(lambda: App.load_conversation(filename), args.repeat)
+        results.append({
+            'key': f"storage/{length}",
+            'messages': length,
+            'file_bytes': os.path.getsize(filename),
+            'save_new': _summary(create_times),
+            'save_turn': _summary(append_times),
+            'load': _summary(load_times),
+        })
+    return results
+
+def _seed_conversations(directory, start, count, base):
+    # Written directly rather than through save_conversation, so 50k
+    # conversations take seconds; the catalog picks them up on the next listing
+    for index in range(start, start + count):
+        conversation_id = (base - timedelta(seconds=index)).strftime("%Y%m%d_%H%M%S")
+        data = {
+            'timestamp': conversation_id,
+            'messages': _messages(4),
+            'context': '',
+            'title': f"Seeded conversation {index} about sunsets" if index % 10 == 0 else f"Seeded {index}",
+            'updated': conversation_id,
+        }
+        with open(os.path.join(directory, f"conversation_{conversation_id}.json"), 'w') as f:
+            json.dump(data, f)
+
+def bench_listing(App, args):
+    directory = 'conversations'
+    os.makedirs(directory, exist_ok=True)
+    base = datetime.now() - timedelta(days=1)
+    results = []
+    seeded = 0
+    for size in sorted(args.store_sizes):
+        _seed_conversations(directory, seeded, size - seeded, base)
+        seeded = size
+        # The first listing after the store grew also indexes the new files
+        start = time.perf_counter()
+        _, total = App.get_saved_conversations()
+        cold = time.perf_counter() - start
+        last_page = max(0, (total - 1) // App.SIDEBAR_PAGE_SIZE)
+        results.append({
+            'key': f"listing/{size}",
+            'conversations': total,
+            'first_listing_ms': _ms(cold),
+            'first_page': _summary(_timed(lambda: App.get_saved_conversations(), args.repeat)),
+            'last_page': _summary(_timed(lambda: App.get_saved_conversations(page=last_page), args.repeat)),
+            'search': _summary(_timed(lambda: App.get_saved_conversations(query='sunsets'), args.repeat)),
+        })
+    return results
+
+def bench_encode(App, args):
+    from image_utils import (
+        DECODE_WORKERS, ImagePayloadCache, ImageSource, encode_image, model_input_size, prepare_payloads,
+        preprocess_image
+    )
+    results = []
+    max_side = model_input_size(App.VISION_MODEL)
+    for image_format in ('JPEG', 'PNG'):
+        for side in args.image_sizes:
+            data = _test_image(side, image_format)
+
+            def payload():
+                # A new upload sent as is: hashing, header parsing and the cache
+                cache = ImagePayloadCache()
+                encode_image(ImageSource.from_bytes(data, cache=cache).open(cache), cache)
+
+            def reencode():
+                # What formats that can't be sent as they are cost every time
+                encode_image(ImageSource.from_bytes(data).open())
+
+            def preprocess():
+                # A new upload resized to the model's input size
+                cache = ImagePayloadCache()
+                preprocess_image(ImageSource.from_bytes(data, cache=cache).open(cache), max_side=max_side, cache=cache)
+
+            cache = ImagePayloadCache()
+            cached_image = ImageSource.from_bytes(data, cache=cache).open(cache)
+            preprocess_image(cached_image, max_side=max_side, cache=cache)
+            results.append({
+                'key': f"encode/{image_format.lower()}/{side}",
+                'format': image_format,
+                'side': side,
+                'input_bytes': len(data),
+                'payload': _summary(_timed(payload, args.repeat)),
+                'reencode': _summary(_timed(reencode, args.repeat)),
+                'preprocess': _summary(_timed(preprocess, args.repeat)),
+                'preprocess_cached': _summary(_timed(
+                    lambda: preprocess_image(cached_image, max_side=max_side, cache=cache), args.repeat
+                )),
+            })
+
+    for side in args.image_sizes:
+        # Different images (the noise differs), as several shots of one item are
+        batch = [_test_image(side) for _ in range(args.images)]
+
+        def prepare(workers):
+            # New uploads resized to the model's input size, as one request sends them
+            cache = ImagePayloadCache()
+            sources = [ImageSource.from_bytes(data, cache=cache) for data in batch]
+            prepare_payloads(sources, max_side=max_side, cache=cache, workers=workers)
+
+        results.append({
+            'key': f"encode/multi/{args.images}x{side}",
+            'images': args.images,
+            'side': side,
+            'workers': DECODE_WORKERS,
+            'sequential': _summary(_timed(lambda: prepare(1), args.repeat)),
+            'parallel': _summary(_timed(lambda: prepare(DECODE_WORKERS), args.repeat)),
+        })
+    return results
+
+def _numbers(value, prefix=''):
+    # Flattens a result into {'path': number} for comparison
+    if isinstance(value, dict):
+        flat = {}
+        for name, item in value.items():
+            flat.update(_numbers(item, f"{prefix}.{name}" if prefix else name))
+        return flat
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {prefix: value}
+    return {}
+
+def compare(baseline, report):
+    # Prints the change of every timing and throughput figure present in both reports
+    before = {result['key']: _numbers(result) for results in baseline['results'].values() for result in results}
+    print(f"{'benchmark':<48} {'before':>12} {'after':>12} {'change':>8}")
+    for results in report['results'].values():
+        for result in results:
+            old = before.get(result['key'], {})
+            for name, value in _numbers(result).items():
+                if not (name.endswith('_ms') or name.endswith('_per_second')) or not old.get(name):
+                    continue
+                change = (value - old[name]) / old[name] * 100
+                print(f"{result['key'] + ' ' + name:<48} {old[name]:>12.3f} {value:>12.3f} {change:>+7.1f}%")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the app's hot paths against a stub Ollama server")
+    parser.add_argument('--suites', nargs='+', choices=SUITES, default=list(SUITES))
+    parser.add_argument('--host', default=None, help="Use this Ollama server instead of starting the stub")
+    parser.add_argument('--latency', type=float, default=0.05, help="Stub: seconds before the first token")
+    parser.add_argument('--token-rate', type=float, default=200.0, help="Stub: tokens per second")
+    parser.add_argument('--tokens', type=int, default=32, help="Stub: tokens per reply")
+    parser.add_argument('--stub-parallel', type=int, default=0, help="Stub: concurrent generations (0: no limit)")
+    parser.add_argument('--parallel', type=int, default=None, help="Sets OLLAMA_PARALLEL_PER_HOST for the app")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--requests', type=int, default=32, help="Requests per concurrency level")
+    parser.add_argument('--lengths', type=int, nargs='+', default=[10, 100, 1000], help="Messages per conversation")
+    parser.add_argument('--store-sizes', type=int, nargs='+', default=[10, 100, 1000, 10000, 50000])
+    parser.add_argument('--image-sizes', type=int, nargs='+', default=[512, 1024, 2048, 4096])
+    parser.add_argument('--images', type=int, default=4, help="Images per request in the multi-image encode case")
+    parser.add_argument('--repeat', type=int, default=10, help="Repetitions per timing")
+    parser.add_argument('--output', default=None, help="Write the JSON report to this file")
+    parser.add_argument('--compare', default=None, help="Earlier JSON report to compare against")
+    args = parser.parse_args(argv)
+
+    stub = None
+    host = args.host
+    if host is None and 'generation' in args.suites:
+        stub, host = _start_stub(args)
+    if host:
+        os.environ['OLLAMA_HOST'] = host
+    if args.parallel is not None:
+        os.environ['OLLAMA_PARALLEL_PER_HOST'] = str(args.parallel)
+    os.environ.setdefault('OLLAMA_PRELOAD', '0')
+
+    # App keeps its conversations directory relative to the working directory
+    workdir = tempfile.mkdtemp(prefix='hot_paths_')
+    cwd = os.getcwd()
+    try:
+        # Imported only now, so the environment above is what App and its
+        # modules read at import time
+        import App
+        report = {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': {name: value for name, value in vars(args).items() if name not in ('output', 'compare')},
+            'slots': App.get_scheduler().slots,
+            'results': {},
+        }
+        for suite in args.suites:
+            # Each suite gets its own conversations directory
+            os.makedirs(os.path.join(workdir, suite))
+            os.chdir(os.path.join(workdir, suite))
+            start = time.perf_counter()
+            report['results'][suite] = globals()[f"bench_{suite}"](App, args)
+            print(f"{suite}: {time.perf_counter() - start:.1f}s", file=sys.stderr)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+        if stub is not None:
+            stub.terminate()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from App import VISION_MODEL, build_chat_messages, keep_alive_for
+from image_utils import load_image_file, model_input_size
+from ollama_client import create_client
+
+# Compares prompt evaluation per turn for the 'window' and 'prefix' prompt
+# layouts. The same scripted conversation is played against a running Ollama
+# server once per layout, and Ollama's prompt_eval_count / prompt_eval_duration
+# are recorded for every turn. With the prefix layout, follow-up turns should
+# only evaluate the new messages instead of the image and the whole history.
+#
+#   python benchmarks/prompt_cache.py photo.jpg --turns 8 --output prompt_cache.json
+
+logging.getLogger('streamlit.runtime.scriptrunner_utils.script_run_context').setLevel(logging.ERROR)
+
+QUESTIONS = [
+    "Describe this image in detail.",
+    "What colors stand out the most?",
+    "Is there any text visible? Quote it.",
+    "What is in the background?",
+    "Summarize that in one sentence.",
+    "What would you change to improve the composition?",
+    "Which objects are closest to the camera?",
+    "What time of day does it look like?",
+]
+
+def run_conversation(client, image, layout, turns, model, preprocess):
+    history = []
+    results = []
+    for turn in range(turns):
+        question = QUESTIONS[turn % len(QUESTIONS)]
+        messages = build_chat_messages(image, question, history, '', preprocess, None, layout)
+        start = time.perf_counter()
+        response = client.chat(model=model, messages=messages, keep_alive=keep_alive_for(layout))
+        elapsed = time.perf_counter() - start
+        results.append({
+            'layout': layout,
+            'turn': turn + 1,
+            'prompt_eval_count': response.get('prompt_eval_count') or 0,
+            'prompt_eval_ms': (response.get('prompt_eval_duration') or 0) / 1e6,
+            'load_ms': (response.get('load_duration') or 0) / 1e6,
+            'total_ms': elapsed * 1000,
+        })
+        history += [
+            {'role': 'user', 'content': question},
+            {'role': 'assistant', 'content': response['message']['content']},
+        ]
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark prompt-eval time per turn for each prompt layout")
+    parser.add_argument('image', help="Image to ask about")
+    parser.add_argument('--turns', type=int, default=6)
+    parser.add_argument('--model', default=VISION_MODEL)
+    parser.add_argument('--output', default=None, help="Write all per-turn results to this JSON file")
+    args = parser.parse_args(argv)
+
+    client = create_client()
+    image = load_image_file(args.image)
+    preprocess = {'max_side': model_input_size(args.model)}
+    # Load the model first so the first measured turn is not a cold start
+    client.chat(model=args.model, messages=[], keep_alive=keep_alive_for('prefix'))
+
+    results = []
+    for layout in ('window', 'prefix'):
+        results += run_conversation(client, image, layout, args.turns, args.model, preprocess)
+
+    print(f"{'turn':>4} | {'window tokens':>13} {'window ms':>10} | {'prefix tokens':>13} {'prefix ms':>10}")
+    by_layout = {layout: [r for r in results if r['layout'] == layout] for layout in ('window', 'prefix')}
+    for window, prefix in zip(by_layout['window'], by_layout['prefix']):
+        print(
+            f"{window['turn']:>4} | {window['prompt_eval_count']:>13} {window['prompt_eval_ms']:>10.1f} | "
+            f"{prefix['prompt_eval_count']:>13} {prefix['prompt_eval_ms']:>10.1f}"
+        )
+    for layout, rows in by_layout.items():
+        follow_ups = rows[1:] or rows
+        mean = sum(r['prompt_eval_ms'] for r in follow_ups) / len(follow_ups)
+        print(f"{layout}: mean prompt eval on follow-up turns {mean:.1f} ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,307 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import closing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import maintenance
+import storage
+from blob_store import (
+    BLOB_DIRNAME, blob_path, conversation_blobs, put_blob, release_blob, remove_conversation_with_image
+)
+from catalog import list_catalog, refresh_catalog, remove_catalog_entry, update_catalog_entry
+from locking import conversation_lock_path, file_lock
+from storage import (
+    ConversationConflict, append_to_conversation, conversation_state, create_conversation, read_conversation,
+    read_recovery, snapshot_path, write_recovery
+)
+
+# Stress test for the conversation store: several processes with several
+# threads each create, extend, re-image, read and delete conversations in one
+# directory at the same time, the way concurrent app sessions do, while
+# maintenance passes run alongside them. Afterwards
+# the directory is checked for consistency:
+#   - every conversation parses and its messages are contiguous; a turn built
+#     on an outdated copy is forked into a new conversation, never dropped
+#   - the catalog matches the files on disk
+#   - blob reference counts match the conversations using each image, and no
+#     blob is missing or orphaned
+#   - no temporary files are left behind
+# Prints throughput and per-operation latency as JSON; exits with status 1 if
+# anything is inconsistent.
+#
+#   python benchmarks/storage_stress.py --processes 4 --threads 4 --seconds 20
+
+# Seconds a new file is safe from the garbage collector during the test
+MAINTENANCE_GRACE = 1
+
+# Small images shared between conversations, so blobs get several references
+IMAGES = [bytes([i]) * (1024 * (i + 1)) for i in range(6)]
+
+def _message(index):
+    return {'role': 'user' if index % 2 == 0 else 'assistant', 'content': f"m{index}:{random.random()}"}
+
+def _conversation_ids(directory):
+    return [
+        storage.conversation_id_from_filename(name)
+        for name in os.listdir(directory)
+        if name.startswith('conversation_') and name.endswith('.json')
+    ]
+
+def _random_images():
+    # One to three distinct images, the way a multi-image upload arrives
+    return random.sample(IMAGES, random.randint(1, 3))
+
+def _put_images(directory, images, previous=()):
+    # Stores the images not already among previous, taking a reference on each
+    hashes = [hashlib.sha256(data).hexdigest() for data in images]
+    keys = [f"{image_hash}.png" for image_hash in hashes]
+    for data, key in zip(images, keys):
+        if key not in previous:
+            put_blob(directory, data, 'png', key=key)
+    return keys, hashes
+
+def _set_images(directory, conversation_id, messages, images):
+    # Mirrors App.save_conversation for an existing conversation
+    with file_lock(conversation_lock_path(directory, conversation_id)):
+        if not os.path.exists(snapshot_path(directory, conversation_id)):
+            return False
+        previous = conversation_blobs(conversation_state(directory, conversation_id))
+        keys, hashes = _put_images(directory, images, previous)
+        fields = {}
+        if keys != previous:
+            fields = {'image_blobs': keys, 'image_hashes': hashes, 'image_blob': None, 'image_hash': None}
+            for key in set(previous) - set(keys):
+                release_blob(directory, key)
+        append_to_conversation(directory, conversation_id, messages, **fields)
+        return True
+
+def _catalog_update(directory, conversation_id):
+    update_catalog_entry(directory, os.path.basename(snapshot_path(directory, conversation_id)))
+
+def _worker(directory, seconds, threads, seed, results):
+    import threading
+    random.seed(seed)
+    session_id = f"stress{seed:04d}"
+    latencies = {}
+    errors = []
+    deadline = time.perf_counter() + seconds
+    lock = threading.Lock()
+
+    def record(op, elapsed):
+        with lock:
+            latencies.setdefault(op, []).append(elapsed)
+
+    def run():
+        while time.perf_counter() < deadline:
+            ids = _conversation_ids(directory)
+            op = random.choices(
+                ['create', 'append', 'image', 'read', 'delete', 'list', 'recover', 'maintain'],
+                weights=[2, 6, 1, 6, 1, 1, 2, 0.2]
+            )[0]
+            start = time.perf_counter()
+            try:
+                if op == 'create' or not ids:
+                    op = 'create'
+                    keys, hashes = _put_images(directory, _random_images())
+                    conversation_id = create_conversation(
+                        directory, [_message(0), _message(1)], '', f"stress {seed}",
+                        image_blobs=keys, image_hashes=hashes
+                    )
+                    _catalog_update(directory, conversation_id)
+                    write_recovery(directory, session_id, conversation_id)
+                elif op == 'append':
+                    # Like a session: the turn is built from the copy it read
+                    # earlier, so other writers may have added messages since
+                    conversation_id = random.choice(ids)
+                    try:
+                        messages = read_conversation(directory, conversation_id)['messages']
+                    except FileNotFoundError:
+                        continue
+                    base_count = len(messages)
+                    messages += [_message(base_count), _message(base_count + 1)]
+                    # The reply is being generated
+                    time.sleep(random.random() * 0.01)
+                    with file_lock(conversation_lock_path(directory, conversation_id)):
+                        if not os.path.exists(snapshot_path(directory, conversation_id)):
+                            continue
+                        try:
+                            append_to_conversation(
+                                directory, conversation_id, messages, base_count, title=f"stress {seed}"
+                            )
+                        except ConversationConflict:
+                            conversation_id = None
+                    if conversation_id is None:
+                        # Forked as App.save_conversation does; nothing is lost
+                        op = 'fork'
+                        conversation_id = create_conversation(directory, messages, '', f"stress {seed}")
+                    _catalog_update(directory, conversation_id)
+                elif op == 'image':
+                    conversation_id = random.choice(ids)
+                    try:
+                        messages = read_conversation(directory, conversation_id)['messages']
+                    except FileNotFoundError:
+                        continue
+                    _set_images(directory, conversation_id, messages, _random_images())
+                elif op == 'read':
+                    try:
+                        data = read_conversation(directory, random.choice(ids))
+                    except FileNotFoundError:
+                        continue
+                    for index, message in enumerate(data['messages']):
+                        if not message['content'].startswith(f"m{index}:"):
+                            raise AssertionError(f"message {index} of {data['timestamp']} is out of place")
+                elif op == 'delete':
+                    conversation_id = random.choice(ids)
+                    if remove_conversation_with_image(directory, conversation_id):
+                        remove_catalog_entry(directory, os.path.basename(snapshot_path(directory, conversation_id)))
+                elif op == 'list':
+                    refresh_catalog(directory)
+                    list_catalog(directory, 20)
+                elif op == 'recover':
+                    read_recovery(directory, session_id)
+                elif op == 'maintain':
+                    # Several at once on purpose; a short grace period makes
+                    # the collector race with saves still taking references
+                    maintenance.StorageMaintenance(directory, grace=MAINTENANCE_GRACE).run_once()
+            except Exception as e:
+                errors.append(f"{op}: {type(e).__name__}: {e}")
+                continue
+            record(op, time.perf_counter() - start)
+
+    pool = [threading.Thread(target=run) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    results.put({'latencies': latencies, 'errors': errors})
+
+def check_consistency(directory):
+    problems = []
+    ids = _conversation_ids(directory)
+    references = {}
+    for conversation_id in ids:
+        try:
+            data = read_conversation(directory, conversation_id)
+        except (OSError, ValueError) as e:
+            problems.append(f"{conversation_id} unreadable: {e}")
+            continue
+        for index, message in enumerate(data['messages']):
+            if not message['content'].startswith(f"m{index}:"):
+                problems.append(f"{conversation_id} message {index} out of place")
+                break
+        for key in conversation_blobs(data):
+            references[key] = references.get(key, 0) + 1
+            if not os.path.exists(blob_path(directory, key)):
+                problems.append(f"{conversation_id} image {key} missing")
+
+    with closing(sqlite3.connect(os.path.join(directory, BLOB_DIRNAME, 'refs.db'))) as conn:
+        refcounts = dict(conn.execute("SELECT key, refcount FROM blobs"))
+    if refcounts != references:
+        problems.append(f"blob refcounts {refcounts} != references {references}")
+    for root, _, names in os.walk(os.path.join(directory, BLOB_DIRNAME)):
+        for name in names:
+            if name.endswith('.png') and name not in references:
+                problems.append(f"orphaned blob {name}")
+
+    # The catalog kept up by the writers must already match the disk
+    catalog = {entry['filename']: entry['message_count'] for entry in list_catalog(directory)}
+    on_disk = {
+        os.path.basename(snapshot_path(directory, conversation_id)):
+            len(read_conversation(directory, conversation_id)['messages'])
+        for conversation_id in ids
+    }
+    if catalog != on_disk:
+        stale = {name for name in set(catalog) | set(on_disk) if catalog.get(name) != on_disk.get(name)}
+        problems.append(f"catalog differs from disk for {len(stale)} conversations")
+
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if name.startswith('.tmp_'):
+                problems.append(f"leftover temporary file {os.path.join(root, name)}")
+    return problems, len(ids)
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Concurrent writers against the conversation store")
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--directory', default=None, help="Directory to use (default: a new temporary one)")
+    parser.add_argument('--compact-bytes', type=int, default=4096,
+                        help="Log size that triggers compaction; small values exercise it often")
+    parser.add_argument('--output', default=None, help="Also write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    directory = args.directory or tempfile.mkdtemp(prefix='storage_stress_')
+    os.makedirs(directory, exist_ok=True)
+    storage.COMPACT_LOG_BYTES = args.compact_bytes
+    # Lets maintenance compact logs while they are still being appended to
+    maintenance.COMPACT_IDLE = 0
+
+    # fork keeps the patched compaction threshold in the workers
+    context = multiprocessing.get_context('fork' if hasattr(os, 'fork') else 'spawn')
+    results = context.Queue()
+    start = time.perf_counter()
+    workers = [
+        context.Process(target=_worker, args=(directory, args.seconds, args.threads, seed, results))
+        for seed in range(args.processes)
+    ]
+    for worker in workers:
+        worker.start()
+    outcomes = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = {}
+    errors = []
+    for outcome in outcomes:
+        errors += outcome['errors']
+        for op, values in outcome['latencies'].items():
+            latencies.setdefault(op, []).extend(values)
+    problems, conversations = check_consistency(directory)
+    total_ops = sum(len(values) for values in latencies.values())
+    report = {
+        'processes': args.processes,
+        'threads': args.threads,
+        'seconds': elapsed,
+        'operations': total_ops,
+        'ops_per_second': total_ops / elapsed,
+        'conversations_left': conversations,
+        'latency_ms': {
+            op: {
+                'count': len(values),
+                'p50': _percentile(values, 0.5) * 1000,
+                'p95': _percentile(values, 0.95) * 1000,
+                'max': max(values) * 1000,
+            }
+            for op, values in sorted(latencies.items())
+        },
+        'errors': errors[:20],
+        'error_count': len(errors),
+        'problems': problems[:20],
+        'consistent': not problems and not errors,
+    }
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    if not args.directory:
+        shutil.rmtree(directory, ignore_errors=True)
+    return 0 if report['consistent'] else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
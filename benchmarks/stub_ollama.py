@@ -0,0 +1,257 @@
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A stand-in for the Ollama server, so the app's hot paths can be benchmarked
+# without a GPU and with repeatable timings. It implements the parts of the API
+# the app uses (/api/chat, /api/generate, /api/ps, /api/tags, /api/version):
+#   - every reply starts after --latency seconds (prompt evaluation)
+#   - a model that isn't loaded adds --load-seconds first
+#   - the reply is --tokens tokens long, generated at --token-rate tokens/s
+#   - at most --parallel requests generate at once, like OLLAMA_NUM_PARALLEL;
+#     the rest wait (0 means no limit)
+# Replies carry the usual counters (prompt_eval_count, eval_count, durations).
+#
+# To exercise failover, --fault makes a share (--fault-rate) of API requests,
+# health checks included, fail like a broken server would:
+#   error   answer with HTTP 500
+#   drop    close the connection without answering
+#   hang    answer only after --hang-seconds
+# StubOllama.fault can also be changed while the server runs.
+#
+#   python benchmarks/stub_ollama.py --port 11435 --latency 0.2 --token-rate 40
+#   python benchmarks/stub_ollama.py --port 11436 --fault drop --fault-rate 0.5
+
+FAULTS = ('error', 'drop', 'hang')
+
+class StubOllama:
+    def __init__(self, latency=0.05, token_rate=200.0, tokens=32, load_seconds=0.0, parallel=0,
+                 fault=None, fault_rate=1.0, hang_seconds=3600.0):
+        if fault is not None and fault not in FAULTS:
+            raise ValueError(f"Unknown fault {fault!r}, expected one of {', '.join(FAULTS)}")
+        self.latency = latency
+        self.token_rate = token_rate
+        self.tokens = tokens
+        self.load_seconds = load_seconds
+        self.fault = fault
+        self.fault_rate = fault_rate
+        self.hang_seconds = hang_seconds
+        self.loaded = {}
+        self.requests = 0
+        self.faults = 0
+        # Generations running now, and the most at once so far
+        self.active = 0
+        self.max_active = 0
+        self._slots = threading.Semaphore(parallel) if parallel else None
+        self._lock = threading.Lock()
+
+    def next_fault(self):
+        # The fault to inject into the next API request, or None
+        fault = self.fault
+        if fault is None or random.random() >= self.fault_rate:
+            return None
+        with self._lock:
+            self.faults += 1
+        return fault
+
+    def _load(self, model, keep_alive):
+        # Returns the seconds spent loading the model for this request
+        with self._lock:
+            self.requests += 1
+            if keep_alive in (0, '0', '0s'):
+                self.loaded.pop(model, None)
+                return 0.0
+            cold = model not in self.loaded
+            self.loaded[model] = datetime.now(timezone.utc) + timedelta(minutes=5)
+        return self.load_seconds if cold else 0.0
+
+    def generate(self, request):
+        # Yields (text, final counters or None) pairs with the configured timing
+        model = request.get('model', '')
+        load = self._load(model, request.get('keep_alive'))
+        if not request.get('messages') and not request.get('prompt'):
+            # A request without input only loads or unloads the model
+            time.sleep(load)
+            yield '', {'load_duration': int(load * 1e9), 'total_duration': int(load * 1e9)}
+            return
+        if self._slots is not None:
+            self._slots.acquire()
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            start = time.perf_counter()
+            time.sleep(load + self.latency)
+            prompt_tokens = sum(len(m.get('content') or '') for m in request.get('messages', [])) // 4
+            prompt_tokens += len(request.get('prompt') or '') // 4
+            eval_start = time.perf_counter()
+            for index in range(self.tokens):
+                if self.token_rate:
+                    # Sleep until this token is due, so slow writes don't add up
+                    delay = eval_start + index / self.token_rate - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                yield f"token{index} ", None
+            end = time.perf_counter()
+            yield '', {
+                'prompt_eval_count': prompt_tokens,
+                'prompt_eval_duration': int(self.latency * 1e9),
+                'eval_count': self.tokens,
+                'eval_duration': int((end - eval_start) * 1e9),
+                'load_duration': int(load * 1e9),
+                'total_duration': int((end - start) * 1e9),
+            }
+        finally:
+            with self._lock:
+                self.active -= 1
+            if self._slots is not None:
+                self._slots.release()
+
+    def running(self):
+        with self._lock:
+            return [
+                {'name': model, 'model': model, 'size': 0, 'digest': '', 'details': {},
+                 'expires_at': expires.isoformat(), 'size_vram': 0}
+                for model, expires in self.loaded.items()
+            ]
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    stub = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, body, status=200):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _write_chunk(self, body):
+        data = (json.dumps(body) + '\n').encode('utf-8')
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def _inject_fault(self):
+        # Returns True if the request was answered (or dropped) by a fault
+        fault = self.stub.next_fault()
+        if fault == 'error':
+            self._send_json({'error': 'stub failure'}, 500)
+            return True
+        if fault == 'drop':
+            self.close_connection = True
+            return True
+        if fault == 'hang':
+            time.sleep(self.stub.hang_seconds)
+        return False
+
+    def do_GET(self):
+        if self.path.startswith('/api/') and self._inject_fault():
+            return
+        try:
+            if self.path == '/api/ps':
+                self._send_json({'models': self.stub.running()})
+            elif self.path == '/api/tags':
+                self._send_json({'models': self.stub.running()})
+            elif self.path == '/api/version':
+                self._send_json({'version': 'stub'})
+            else:
+                self._send_json({'error': 'not found'}, 404)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        request = json.loads(self.rfile.read(length) or b'{}')
+        if self._inject_fault():
+            return
+        if self.path not in ('/api/chat', '/api/generate'):
+            self._send_json({'status': 'success'})
+            return
+        chat = self.path == '/api/chat'
+
+        def frame(text, counters):
+            body = {'model': request.get('model', ''), 'created_at': _now(), 'done': counters is not None}
+            if chat:
+                body['message'] = {'role': 'assistant', 'content': text}
+            else:
+                body['response'] = text
+            if counters is not None:
+                body.update(counters, done_reason='stop')
+            return body
+
+        if request.get('stream', True):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            try:
+                for text, counters in self.stub.generate(request):
+                    self._write_chunk(frame(text, counters))
+                self.wfile.write(b'0\r\n\r\n')
+            except (BrokenPipeError, ConnectionResetError):
+                # The client went away mid-reply, as a cancelled generation does
+                self.close_connection = True
+        else:
+            parts = []
+            counters = None
+            for text, counters in self.stub.generate(request):
+                parts.append(text)
+            try:
+                self._send_json(frame(''.join(parts), counters))
+            except (BrokenPipeError, ConnectionResetError):
+                # The client gave up waiting, as it does on a hung server
+                self.close_connection = True
+
+def serve(stub, host='127.0.0.1', port=0):
+    # Starts the server on a background thread and returns it; server.server_port
+    # is the port actually bound when port is 0
+    handler = type('Handler', (_Handler,), {'stub': stub})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='stub-ollama', daemon=True).start()
+    return server
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stub Ollama server with configurable latency and token rate")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11435, help="0 picks a free port")
+    parser.add_argument('--latency', type=float, default=0.05, help="Seconds before the first token")
+    parser.add_argument('--token-rate', type=float, default=200.0, help="Tokens per second (0: no delay)")
+    parser.add_argument('--tokens', type=int, default=32, help="Tokens per reply")
+    parser.add_argument('--load-seconds', type=float, default=0.0, help="Extra delay when a model is not loaded")
+    parser.add_argument('--parallel', type=int, default=0, help="Concurrent generations (0: no limit)")
+    parser.add_argument('--fault', choices=FAULTS, default=None, help="Make API requests fail this way")
+    parser.add_argument('--fault-rate', type=float, default=1.0, help="Share of API requests that fail")
+    parser.add_argument('--hang-seconds', type=float, default=3600.0, help="How long a hung request waits")
+    args = parser.parse_args(argv)
+
+    stub = StubOllama(args.latency, args.token_rate, args.tokens, args.load_seconds, args.parallel,
+                      args.fault, args.fault_rate, args.hang_seconds)
+    server = serve(stub, args.host, args.port)
+    # The first line tells a parent process where to connect
+    print(f"http://{args.host}:{server.server_port}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    sys.exit(main())
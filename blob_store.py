@@ -0,0 +1,226 @@
+import hashlib
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+from locking import conversation_lock_path, file_lock, lock_path
+from storage import (
+    append_to_conversation, atomic_write_bytes, conversation_id_from_filename, conversation_state, read_conversation,
+    remove_conversation, snapshot_path
+)
+
+# Content-addressed store for conversation images. A blob is keyed by the
+# SHA-256 of its bytes plus its extension and lives at
+# blobs/<first two hex chars>/<key>, so a lookup is a single stat and the same
+# image saved by several conversations is stored once. Reference counts are
+# kept in blobs/refs.db; a blob is removed when its last reference goes away.
+#
+# A conversation lists its images in image_blobs / image_hashes and holds one
+# reference per distinct image. Conversations saved before several images
+# were supported have a single image_blob / image_hash instead.
+
+BLOB_DIRNAME = 'blobs'
+MIGRATED_MARKER = '.migrated'
+
+def _blob_root(directory):
+    return os.path.join(directory, BLOB_DIRNAME)
+
+def _connect(directory):
+    root = _blob_root(directory)
+    # Several processes may get here at once
+    os.makedirs(root, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(root, 'refs.db'), timeout=10, isolation_level=None)
+    conn.execute("CREATE TABLE IF NOT EXISTS blobs (key TEXT PRIMARY KEY, refcount INTEGER NOT NULL)")
+    return conn
+
+def conversation_blobs(data):
+    # Blob keys of a conversation's images, given its data or state
+    if data.get('image_blobs'):
+        return list(data['image_blobs'])
+    return [data['image_blob']] if data.get('image_blob') else []
+
+def conversation_image_hashes(data):
+    # Content hashes of a conversation's images, in the order of conversation_blobs
+    if data.get('image_blobs'):
+        return list(data.get('image_hashes') or [os.path.splitext(key)[0] for key in data['image_blobs']])
+    if data.get('image_blob'):
+        return [data.get('image_hash') or os.path.splitext(data['image_blob'])[0]]
+    return []
+
+def blob_key(data, ext):
+    return f"{hashlib.sha256(data).hexdigest()}.{ext}"
+
+def blob_path(directory, key):
+    return os.path.join(_blob_root(directory), key[:2], key)
+
+def put_blob(directory, data, ext, key=None):
+    # Store the bytes (if not already present) and take a reference on them
+    key = key or blob_key(data, ext)
+    path = blob_path(directory, key)
+    with closing(_connect(directory)) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                atomic_write_bytes(path, data)
+            else:
+                # Marks the blob as in use for collect_garbage until the
+                # conversation that takes this reference has been written
+                os.utime(path)
+            conn.execute(
+                "INSERT INTO blobs (key, refcount) VALUES (?, 1) "
+                "ON CONFLICT(key) DO UPDATE SET refcount = refcount + 1",
+                (key,)
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    return key
+
+def release_blob(directory, key):
+    # Drop one reference; the file is deleted together with the last one
+    if not key or not os.path.exists(_blob_root(directory)):
+        return
+    with closing(_connect(directory)) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT refcount FROM blobs WHERE key = ?", (key,)).fetchone()
+            if row is None or row[0] <= 1:
+                conn.execute("DELETE FROM blobs WHERE key = ?", (key,))
+                path = blob_path(directory, key)
+                if os.path.exists(path):
+                    os.remove(path)
+            else:
+                conn.execute("UPDATE blobs SET refcount = refcount - 1 WHERE key = ?", (key,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+def collect_garbage(directory, references, grace):
+    # Bring the stored reference counts in line with `references` (blob key ->
+    # number of conversations using it): blobs nobody uses are deleted, and
+    # counts left too high or too low by an interrupted save are corrected.
+    # Blobs touched within the last `grace` seconds are left alone, since a
+    # save may have taken its reference without having written the
+    # conversation yet.
+    report = {'removed': 0, 'repaired': 0, 'missing': 0, 'freed_bytes': 0}
+    root = _blob_root(directory)
+    if not os.path.exists(root):
+        return report
+    on_disk = set()
+    for prefix in os.listdir(root):
+        if len(prefix) == 2 and os.path.isdir(os.path.join(root, prefix)):
+            on_disk.update(name for name in os.listdir(os.path.join(root, prefix)) if not name.startswith('.tmp_'))
+    cutoff = time.time() - grace
+    with closing(_connect(directory)) as conn:
+        stored = dict(conn.execute("SELECT key, refcount FROM blobs"))
+        for key in on_disk | set(stored) | set(references):
+            expected = references.get(key, 0)
+            if stored.get(key) == expected and (key in on_disk) == (expected > 0):
+                continue
+            # Checked again inside the transaction, which put_blob and
+            # release_blob also take
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                path = blob_path(directory, key)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    stat = None
+                if stat is not None and stat.st_mtime > cutoff:
+                    conn.execute("COMMIT")
+                    continue
+                if expected == 0:
+                    conn.execute("DELETE FROM blobs WHERE key = ?", (key,))
+                    if stat is not None:
+                        os.remove(path)
+                        report['removed'] += 1
+                        report['freed_bytes'] += stat.st_size
+                elif stat is None:
+                    # Nothing to repair from; the conversation shows no image
+                    report['missing'] += 1
+                else:
+                    conn.execute(
+                        "INSERT INTO blobs (key, refcount) VALUES (?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET refcount = excluded.refcount",
+                        (key, expected)
+                    )
+                    report['repaired'] += 1
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+    return report
+
+def blob_refcount(directory, key):
+    if not key or not os.path.exists(_blob_root(directory)):
+        return 0
+    with closing(_connect(directory)) as conn:
+        row = conn.execute("SELECT refcount FROM blobs WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else 0
+
+def remove_conversation_with_image(directory, conversation_id):
+    # Delete a conversation and drop its references on its images. Both happen
+    # under the conversation's lock, so two sessions deleting the same
+    # conversation release the images only once.
+    with file_lock(conversation_lock_path(directory, conversation_id)):
+        if not os.path.exists(snapshot_path(directory, conversation_id)):
+            return False
+        for key in conversation_blobs(conversation_state(directory, conversation_id)):
+            release_blob(directory, key)
+        remove_conversation(directory, conversation_id)
+        return True
+
+def migrate_images(directory):
+    # Move images saved next to conversations (image_<id>.<ext>) into the blob
+    # store and record the blob key on the conversation. Safe to run repeatedly:
+    # conversations that already have a blob key are skipped, and once a full
+    # pass has completed a marker file short-circuits later calls.
+    if not os.path.exists(directory):
+        return 0
+    marker = os.path.join(_blob_root(directory), MIGRATED_MARKER)
+    if os.path.exists(marker):
+        return 0
+    # Another process may be migrating at the same time; let it finish first
+    with file_lock(lock_path(directory, 'migrate-images')):
+        if os.path.exists(marker):
+            return 0
+        return _migrate_images(directory, marker)
+
+def _migrate_images(directory, marker):
+    migrated = 0
+    for name in os.listdir(directory):
+        if not (name.startswith('conversation_') and name.endswith('.json')):
+            continue
+        conversation_id = conversation_id_from_filename(name)
+        try:
+            data = read_conversation(directory, conversation_id)
+        except (OSError, ValueError) as e:
+            print(f"Error migrating {name}: {e}")
+            continue
+        if data.get('image_blob'):
+            continue
+        candidates = [data['image']] if data.get('image') else [
+            f'image_{conversation_id}.{ext}' for ext in ['png', 'jpg', 'jpeg']
+        ]
+        for image_filename in candidates:
+            image_path = os.path.join(directory, image_filename)
+            if not os.path.exists(image_path):
+                continue
+            with open(image_path, 'rb') as f:
+                image_bytes = f.read()
+            ext = os.path.splitext(image_filename)[1].lstrip('.').lower()
+            key = put_blob(directory, image_bytes, ext)
+            append_to_conversation(
+                directory, conversation_id, data['messages'],
+                image_blob=key, image_hash=hashlib.sha256(image_bytes).hexdigest(), image=None
+            )
+            os.remove(image_path)
+            migrated += 1
+            break
+    os.makedirs(_blob_root(directory), exist_ok=True)
+    atomic_write_bytes(marker, b'')
+    return migrated
@@ -0,0 +1,323 @@
+import os
+import sqlite3
+from contextlib import closing
+
+from locking import conversation_lock_path, file_lock, lock_path
+from storage import conversation_id_from_filename, conversation_state, log_path, read_conversation
+
+# Index of saved conversations so the sidebar does not have to parse every
+# conversation file on each rerun. Rows are refreshed from disk by mtime and
+# updated in place whenever the app itself saves, renames or deletes.
+#
+# Titles and message text also go into an SQLite FTS5 full-text index that is
+# updated together with each row, so search does not read any conversation
+# files. SQLite builds without FTS5 fall back to a (slower) LIKE scan.
+#
+# The index has one row for a conversation's title and one per message. Their
+# rowids are the catalog row's id shifted left by SEARCH_ROWID_BITS, plus 0
+# for the title and 1 + index for each message, so a saved turn only inserts
+# its new messages and a conversation's rows are found by rowid range.
+
+CATALOG_FILENAME = 'catalog.db'
+# Bumped when the tables change; older catalogs are re-indexed from disk
+SCHEMA_VERSION = 2
+SEARCH_ROWID_BITS = 24
+
+# Directory mtime at the last refresh in this process; refreshing is skipped
+# while nothing in the directory was added, removed or replaced
+_refreshed = {}
+
+def _fts_available():
+    try:
+        with closing(sqlite3.connect(':memory:')) as conn:
+            conn.execute("CREATE VIRTUAL TABLE probe USING fts5(x)")
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+FTS5 = _fts_available()
+
+def _connect(directory):
+    conn = sqlite3.connect(os.path.join(directory, CATALOG_FILENAME), timeout=10)
+    if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+        # Catalog with an older layout: start over and parse every file once more
+        with conn:
+            conn.execute("DROP TABLE IF EXISTS conversations")
+            conn.execute("DROP TABLE IF EXISTS conversation_search")
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY,  -- a rowid alias, so VACUUM keeps it
+            filename TEXT UNIQUE NOT NULL,
+            timestamp TEXT NOT NULL,
+            title TEXT,
+            preview TEXT,
+            message_count INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            size INTEGER NOT NULL
+        )
+    """)
+    if FTS5:
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS conversation_search USING fts5("
+            "filename UNINDEXED, title, content, tokenize='unicode61 remove_diacritics 2')"
+        )
+    else:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS conversation_search (
+                rowid INTEGER PRIMARY KEY,
+                filename TEXT,
+                title TEXT,
+                content TEXT
+            )
+        """)
+    return conn
+
+def _is_conversation_file(name):
+    return name.startswith('conversation_') and name.endswith('.json')
+
+def _disk_key(directory, filename):
+    # A conversation is its snapshot plus its append log; a change to either
+    # one marks the row as stale
+    stat = os.stat(os.path.join(directory, filename))
+    mtime, size = stat.st_mtime, stat.st_size
+    path = log_path(directory, conversation_id_from_filename(filename))
+    if os.path.exists(path):
+        log_stat = os.stat(path)
+        mtime, size = max(mtime, log_stat.st_mtime), size + log_stat.st_size
+    return mtime, size
+
+def _row(filename, updated, title, preview, message_count, key):
+    return (
+        filename,
+        # Last update time, falling back to the creation time for older files
+        updated or conversation_id_from_filename(filename)[:15],
+        title,
+        preview if message_count else 'Empty conversation',
+        message_count,
+        *key,
+    )
+
+def _row_from_data(filename, data, key):
+    messages = data.get('messages', [])
+    return _row(
+        filename, data.get('updated'), data.get('title'), messages[0]['content'] if messages else None,
+        len(messages), key
+    )
+
+def _search_range(rowid, first=0):
+    # Rowids of a conversation's search rows, from its title (first=0) or
+    # from message first - 1 on
+    base = rowid << SEARCH_ROWID_BITS
+    return base + first, base + (1 << SEARCH_ROWID_BITS) - 1
+
+def _indexed_count(conn, filename, message_count):
+    # Messages of the conversation already in the text index; 0 when there is
+    # no row yet or it describes more messages than the conversation has
+    row = conn.execute("SELECT message_count FROM conversations WHERE filename = ?", (filename,)).fetchone()
+    return row[0] if row and row[0] <= message_count else 0
+
+def _upsert(conn, row, messages, first_index=0):
+    # `messages` are the conversation's messages from first_index on; their
+    # search rows are (re)written and earlier ones are left as they are. The
+    # title row is only rewritten when the title changed.
+    filename, title = row[0], row[2]
+    previous = conn.execute("SELECT id, title FROM conversations WHERE filename = ?", (filename,)).fetchone()
+    # An upsert keeps the id, and with it the rowids of the search rows
+    conn.execute(
+        "INSERT INTO conversations (filename, timestamp, title, preview, message_count, mtime, size) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(filename) DO UPDATE SET "
+        "timestamp = excluded.timestamp, title = excluded.title, preview = excluded.preview, "
+        "message_count = excluded.message_count, mtime = excluded.mtime, size = excluded.size",
+        row
+    )
+    rowid = previous[0] if previous else conn.execute(
+        "SELECT id FROM conversations WHERE filename = ?", (filename,)
+    ).fetchone()[0]
+    start = _search_range(rowid)[0]
+    if previous is None or previous[1] != title:
+        conn.execute("DELETE FROM conversation_search WHERE rowid = ?", (start,))
+        conn.execute(
+            "INSERT INTO conversation_search (rowid, filename, title, content) VALUES (?, ?, ?, '')",
+            (start, filename, title)
+        )
+    conn.execute(
+        "DELETE FROM conversation_search WHERE rowid BETWEEN ? AND ?", _search_range(rowid, first_index + 1)
+    )
+    conn.executemany(
+        "INSERT INTO conversation_search (rowid, filename, title, content) VALUES (?, ?, '', ?)",
+        [
+            (start + first_index + 1 + offset, filename, message['content'])
+            for offset, message in enumerate(messages)
+        ]
+    )
+
+def _delete(conn, filenames):
+    for filename in filenames:
+        row = conn.execute("SELECT id FROM conversations WHERE filename = ?", (filename,)).fetchone()
+        if row:
+            conn.execute("DELETE FROM conversation_search WHERE rowid BETWEEN ? AND ?", _search_range(row[0]))
+        conn.execute("DELETE FROM conversations WHERE filename = ?", (filename,))
+
+def refresh_catalog(directory, force=False):
+    # Only files whose mtime or size changed since the last refresh are parsed;
+    # rows for files that disappeared are dropped
+    if not os.path.exists(directory):
+        return
+    if not force and _refreshed.get(directory) == os.stat(directory).st_mtime_ns:
+        return
+    with file_lock(lock_path(directory, 'catalog')), closing(_connect(directory)) as conn, conn:
+        known = {
+            filename: (mtime, size)
+            for filename, mtime, size in conn.execute("SELECT filename, mtime, size FROM conversations")
+        }
+        seen = set()
+        for entry in os.scandir(directory):
+            if not _is_conversation_file(entry.name):
+                continue
+            try:
+                key = _disk_key(directory, entry.name)
+                if known.get(entry.name) == key:
+                    seen.add(entry.name)
+                    continue
+                data = read_conversation(directory, conversation_id_from_filename(entry.name))
+            except FileNotFoundError:
+                # Deleted by another session since the directory was listed
+                continue
+            except (OSError, ValueError) as e:
+                print(f"Error indexing {entry.name}: {e}")
+                seen.add(entry.name)
+                continue
+            seen.add(entry.name)
+            indexed = _indexed_count(conn, entry.name, len(data['messages']))
+            _upsert(conn, _row_from_data(entry.name, data, key), data['messages'][indexed:], indexed)
+        removed = [filename for filename in known if filename not in seen]
+        if removed:
+            _delete(conn, removed)
+    # Taken after the catalog is written, since SQLite's journal file changes it too
+    _refreshed[directory] = os.stat(directory).st_mtime_ns
+
+def update_catalog_entry(directory, filename, messages=None):
+    # Called right after the app writes a conversation file. The row is built
+    # from the conversation's state as it is on disk, taken under the
+    # conversation's lock together with its mtime and size, so a slower writer
+    # can't replace a newer row with older data. Only messages not yet in the
+    # text index are added; they are taken from `messages` (the list just
+    # saved) when it matches what is on disk, and read back otherwise.
+    conversation_id = conversation_id_from_filename(filename)
+    with file_lock(lock_path(directory, 'catalog')), closing(_connect(directory)) as conn, conn:
+        with file_lock(conversation_lock_path(directory, conversation_id), shared=True):
+            try:
+                state = conversation_state(directory, conversation_id)
+                key = _disk_key(directory, filename)
+                count = state['message_count']
+                indexed = _indexed_count(conn, filename, count)
+                if indexed == count:
+                    new_messages = []
+                elif messages is not None and len(messages) == count:
+                    new_messages = messages[indexed:]
+                else:
+                    new_messages = read_conversation(directory, conversation_id)['messages'][indexed:count]
+            except FileNotFoundError:
+                # Deleted by another session in the meantime
+                _delete(conn, [filename])
+                return
+        row = _row(filename, state['updated'], state['title'], state['preview'], count, key)
+        _upsert(conn, row, new_messages, indexed)
+
+def remove_catalog_entry(directory, filename):
+    if not os.path.exists(os.path.join(directory, CATALOG_FILENAME)):
+        return
+    with file_lock(lock_path(directory, 'catalog')), closing(_connect(directory)) as conn, conn:
+        _delete(conn, [filename])
+
+def optimize_catalog(directory, merge_pages=500):
+    # Merges some of the text index's segments, which every save adds to, so
+    # searches read fewer of them. The work per call is bounded by
+    # merge_pages, so saves waiting for the catalog lock are only held up
+    # briefly; call it repeatedly from background maintenance.
+    if not os.path.exists(os.path.join(directory, CATALOG_FILENAME)):
+        return
+    with file_lock(lock_path(directory, 'catalog')), closing(_connect(directory)) as conn:
+        if FTS5:
+            with conn:
+                conn.execute(
+                    "INSERT INTO conversation_search(conversation_search, rank) VALUES ('merge', ?)",
+                    (merge_pages,)
+                )
+        conn.execute("PRAGMA optimize")
+
+def _entries(rows):
+    return [
+        {
+            'filename': filename,
+            'timestamp': timestamp,
+            'title': title,
+            'preview': preview,
+            'message_count': message_count,
+        }
+        for filename, timestamp, title, preview, message_count in rows
+    ]
+
+def count_catalog(directory):
+    if not os.path.exists(directory):
+        return 0
+    with closing(_connect(directory)) as conn:
+        return conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+
+def list_catalog(directory, limit=None, offset=0):
+    # Newest first; pass limit/offset to read a single page
+    if not os.path.exists(directory):
+        return []
+    with closing(_connect(directory)) as conn:
+        rows = conn.execute(
+            "SELECT filename, timestamp, title, preview, message_count "
+            "FROM conversations ORDER BY timestamp DESC LIMIT ? OFFSET ?",
+            (-1 if limit is None else limit, offset)
+        ).fetchall()
+    return _entries(rows)
+
+def _fts_terms(query):
+    # Each word as a prefix query; quoting keeps FTS5 operators and
+    # punctuation in the user's text from being interpreted
+    terms = [term.replace('"', '""') for term in query.split()]
+    return [f'"{term}"*' for term in terms]
+
+def search_catalog(directory, query, limit=None, offset=0):
+    # Conversations whose title or messages contain every word of `query`
+    # (not necessarily in the same message), best matches first. Returns
+    # (entries, total number of matches).
+    if not os.path.exists(directory) or not query.split():
+        return [], 0
+    shift = SEARCH_ROWID_BITS
+    with closing(_connect(directory)) as conn:
+        if FTS5:
+            terms = _fts_terms(query)
+            matching = ' INTERSECT '.join(
+                [f"SELECT rowid >> {shift} FROM conversation_search WHERE conversation_search MATCH ?"] * len(terms)
+            )
+            total = conn.execute(f"SELECT COUNT(*) FROM ({matching})", terms).fetchone()[0]
+            # Ranked by the best matching row of each conversation
+            rows = conn.execute(
+                "SELECT c.filename, c.timestamp, c.title, c.preview, c.message_count FROM conversations c "
+                f"JOIN (SELECT rowid >> {shift} AS id, MIN(rank) AS score FROM conversation_search "
+                "      WHERE conversation_search MATCH ? AND rank MATCH 'bm25(0, 10.0, 1.0)' GROUP BY id"
+                ") s ON c.id = s.id "
+                f"WHERE c.id IN ({matching}) "
+                "ORDER BY s.score, c.timestamp DESC LIMIT ? OFFSET ?",
+                (' OR '.join(terms), *terms, -1 if limit is None else limit, offset)
+            ).fetchall()
+        else:
+            words = query.split()
+            matching = ' INTERSECT '.join(
+                [f"SELECT rowid >> {shift} FROM conversation_search WHERE title LIKE ? OR content LIKE ?"] * len(words)
+            )
+            params = [value for word in words for value in (f"%{word}%", f"%{word}%")]
+            total = conn.execute(f"SELECT COUNT(*) FROM ({matching})", params).fetchone()[0]
+            rows = conn.execute(
+                "SELECT filename, timestamp, title, preview, message_count "
+                f"FROM conversations WHERE id IN ({matching}) "
+                "ORDER BY timestamp DESC LIMIT ? OFFSET ?",
+                (*params, -1 if limit is None else limit, offset)
+            ).fetchall()
+    return _entries(rows), total
@@ -0,0 +1,154 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Chooses which earlier messages go into a request. Instead of a fixed number
+# of messages, the most recent ones are packed into a token budget; everything
+# older is folded into a rolling summary. The summary is cached by the exact
+# messages it covers, so when more messages fall out of the window only those
+# new messages are summarized on top of the previous summary. Messages are
+# folded in chunks of a bounded size, so a long conversation loaded into a
+# fresh process never produces one huge summary prompt. Requests don't wait
+# for the summary: they use the newest one already made, and refresh() brings
+# it up to date in the background for the next turn.
+
+# Rough token estimate: about four characters per token, plus a few tokens of
+# per-message overhead for the role and separators
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PROMPT = """You maintain a running summary of a conversation about an image.
+Update the summary with the new messages below. Keep every fact, answer and
+user preference that later questions might depend on, drop small talk, and
+stay under {max_words} words.
+
+Current summary:
+{summary}
+
+New messages:
+{messages}
+
+Updated summary:"""
+
+def estimate_tokens(message):
+    return len(message['content']) // CHARS_PER_TOKEN + MESSAGE_OVERHEAD_TOKENS
+
+def split_history(messages_history, token_budget):
+    # Returns (older, recent): `recent` is the longest run of newest messages
+    # that fits the budget, `older` is everything before it
+    used = 0
+    cut = len(messages_history)
+    while cut > 0:
+        cost = estimate_tokens(messages_history[cut - 1])
+        if used + cost > token_budget:
+            break
+        used += cost
+        cut -= 1
+    return messages_history[:cut], messages_history[cut:]
+
+def split_history_stable(messages_history, token_budget, step=8):
+    # Like split_history, but the cut only moves in steps of `step` messages.
+    # Between moves every request starts with the same messages, which lets
+    # the server reuse its cached prompt prefix.
+    older, _ = split_history(messages_history, token_budget)
+    cut = -(-len(older) // step) * step if older else 0
+    cut = min(cut, len(messages_history))
+    return messages_history[:cut], messages_history[cut:]
+
+def _chain_hashes(messages):
+    # hashes[i] identifies messages[:i + 1]; computed incrementally so every
+    # prefix can be looked up in the cache
+    hashes = []
+    digest = b''
+    for message in messages:
+        digest = hashlib.sha256(digest + f"{message['role']}\0{message['content']}\0".encode('utf-8')).digest()
+        hashes.append(digest.hex())
+    return hashes
+
+class RollingSummarizer:
+    def __init__(self, summarize, max_words=200, max_entries=256, chunk_tokens=2048):
+        # `summarize(prompt)` returns the model's text for a summary prompt;
+        # each prompt carries at most about `chunk_tokens` of messages
+        self.summarize = summarize
+        self.max_words = max_words
+        self.chunk_tokens = chunk_tokens
+        self.max_entries = max_entries
+        self.calls = 0
+        self._summaries = OrderedDict()
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def _cached(self, key):
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is not None:
+                self._summaries.move_to_end(key)
+            return summary
+
+    def _store(self, key, summary):
+        with self._lock:
+            self._summaries[key] = summary
+            self._summaries.move_to_end(key)
+            while len(self._summaries) > self.max_entries:
+                self._summaries.popitem(last=False)
+
+    def _longest_cached(self, hashes):
+        # (length of the longest summarized prefix, its summary)
+        for i in range(len(hashes), 0, -1):
+            cached = self._cached(hashes[i - 1])
+            if cached is not None:
+                return i, cached
+        return 0, ''
+
+    def cached_summary(self, messages):
+        # (how many of `messages` the newest cached summary covers, that
+        # summary); never calls the model
+        return self._longest_cached(_chain_hashes(messages))
+
+    def refresh(self, messages):
+        # Runs summary_for(messages) on a background thread unless its summary
+        # is cached or already being made; returns immediately
+        if not messages:
+            return
+        key = _chain_hashes(messages)[-1]
+        with self._lock:
+            if key in self._summaries or key in self._pending:
+                return
+            self._pending.add(key)
+
+        def run():
+            try:
+                self.summary_for(messages)
+            except Exception as e:
+                print(f"Error summarizing conversation history: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+
+        threading.Thread(target=run, name='summarize-history', daemon=True).start()
+
+    def summary_for(self, messages):
+        if not messages:
+            return ''
+        hashes = _chain_hashes(messages)
+        # Start from the longest prefix that is already summarized
+        covered, summary = self._longest_cached(hashes)
+        # Every chunk's summary is cached, so a fold that fails part way
+        # resumes after the last chunk that made it
+        max_chars = self.chunk_tokens * CHARS_PER_TOKEN
+        while covered < len(messages):
+            end, used = covered + 1, estimate_tokens(messages[covered])
+            while end < len(messages) and used + estimate_tokens(messages[end]) <= self.chunk_tokens:
+                used += estimate_tokens(messages[end])
+                end += 1
+            # A single message larger than a chunk is cut down to one
+            new_messages = '\n'.join(f"{m['role']}: {m['content'][:max_chars]}" for m in messages[covered:end])
+            self.calls += 1
+            summary = self.summarize(SUMMARY_PROMPT.format(
+                max_words=self.max_words,
+                summary=summary or '(none yet)',
+                messages=new_messages
+            )).strip()
+            self._store(hashes[end - 1], summary)
+            covered = end
+        return summary
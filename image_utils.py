@@ -0,0 +1,301 @@
+import hashlib
+import io
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+from storage import atomic_write_bytes
+
+# Formats Ollama accepts directly; uploads in these formats are sent byte-for-byte
+PASSTHROUGH_FORMATS = {'PNG', 'JPEG'}
+
+# Longest side the vision encoder of each model actually looks at; anything
+# bigger is downscaled by the model anyway, so we do it before sending
+MODEL_INPUT_SIZES = {
+    'llama3.2-vision': 1120,
+    'llava': 672,
+    'minicpm-v': 1344,
+}
+DEFAULT_INPUT_SIZE = 1120
+
+# Longest side of the thumbnails shown in the UI
+THUMBNAIL_SIZE = 768
+
+# JPEG quality for uploads that must be re-encoded (rotated or downscaled) while
+# recompression is off; high enough that the resize is the only visible change
+REENCODE_JPEG_QUALITY = 95
+
+# Used to estimate how much transfer time the saved bytes are worth
+ESTIMATED_LINK_BYTES_PER_SECOND = 12.5 * 1024 * 1024
+
+# Threads that decode, resize and encode the images of one request (or the
+# thumbnails of several uploads) side by side; Pillow releases the GIL while
+# doing so, so a request with several images takes about as long as its
+# slowest image rather than the sum of them
+DECODE_WORKERS = int(os.environ.get('IMAGE_DECODE_WORKERS', min(4, os.cpu_count() or 1)))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+class ImagePayloadCache:
+    # LRU cache of ready-to-send image bytes keyed by content hash, bounded by total size
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = data
+            self._size += len(data)
+            # Evict least recently used payloads until we fit again
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    @property
+    def size(self):
+        return self._size
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def open_image(data, cache=None):
+    # Open image bytes and tag the image with the hash of those bytes.
+    # If the bytes can be sent as they are, they go straight into the cache.
+    image = Image.open(io.BytesIO(data))
+    image.content_hash = content_hash(data)
+    if cache is not None and image.format in PASSTHROUGH_FORMATS:
+        cache.put(image.content_hash, data)
+    return image
+
+def load_image_file(path, cache=None):
+    with open(path, 'rb') as f:
+        return open_image(f.read(), cache)
+
+class ImageSource:
+    # An uploaded or stored image whose pixels are only read when it is opened.
+    # Keeps what requests and saves need to find cached bytes (hash, format)
+    # without decoding anything; uploads keep their bytes, stored images a path.
+    def __init__(self, content_hash, format, path=None, data=None):
+        self.content_hash = content_hash
+        self.format = format
+        self.path = path
+        self.data = data
+
+    @classmethod
+    def from_bytes(cls, data, format=None, cache=None):
+        # Only the header is parsed here, to learn the format
+        image_format = Image.open(io.BytesIO(data)).format or format
+        source = cls(content_hash(data), image_format, data=data)
+        if cache is not None and image_format in PASSTHROUGH_FORMATS:
+            cache.put(source.content_hash, data)
+        return source
+
+    def read(self):
+        if self.data is not None:
+            return self.data
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def open(self, cache=None):
+        # Full-resolution image, tagged like open_image but without hashing again
+        data = self.read()
+        image = Image.open(io.BytesIO(data))
+        image.content_hash = self.content_hash
+        if not image.format:
+            image.format = self.format
+        if cache is not None and image.format in PASSTHROUGH_FORMATS:
+            cache.put(self.content_hash, data)
+        return image
+
+class ThumbnailCache:
+    # Display-sized copies of images, made once per image hash and kept on
+    # disk, with the most recently shown ones also in memory
+    def __init__(self, directory, max_side=THUMBNAIL_SIZE, memory_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_side = max_side
+        self.memory = ImagePayloadCache(memory_bytes)
+
+    def _path(self, image_hash, ext):
+        return os.path.join(self.directory, image_hash[:2], f"{image_hash}_{self.max_side}.{ext}")
+
+    def get(self, source):
+        # `source` is an ImageSource; returns encoded thumbnail bytes
+        data = self.memory.get(source.content_hash)
+        if data is not None:
+            return data
+        for ext in ('jpg', 'png'):
+            try:
+                with open(self._path(source.content_hash, ext), 'rb') as f:
+                    data = f.read()
+                break
+            except OSError:
+                continue
+        if data is None:
+            data, ext = self._make(source)
+            path = self._path(source.content_hash, ext)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            atomic_write_bytes(path, data)
+        self.memory.put(source.content_hash, data)
+        return data
+
+    def _make(self, source):
+        image = Image.open(io.BytesIO(source.read()))
+        # Lets the JPEG decoder skip straight to a smaller scale
+        image.draft('RGB', (self.max_side, self.max_side))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+        buf = io.BytesIO()
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image.save(buf, format='PNG', optimize=True)
+            return buf.getvalue(), 'png'
+        image.convert('RGB').save(buf, format='JPEG', quality=85)
+        return buf.getvalue(), 'jpg'
+
+def encode_image(image, cache=None):
+    key = getattr(image, 'content_hash', None)
+    if cache is not None and key:
+        data = cache.get(key)
+        if data is not None:
+            return data
+
+    img_byte_arr = io.BytesIO()
+    # Ensure the image format is set
+    image_format = image.format if image.format else 'PNG'
+    image.save(img_byte_arr, format=image_format)
+    data = img_byte_arr.getvalue()
+
+    if not key:
+        key = content_hash(data)
+        image.content_hash = key
+    if cache is not None:
+        cache.put(key, data)
+    return data
+
+def model_input_size(model):
+    return MODEL_INPUT_SIZES.get(model.split(':')[0], DEFAULT_INPUT_SIZE)
+
+def preprocess_image(image, max_side=DEFAULT_INPUT_SIZE, quality=None, cache=None):
+    # Fix EXIF orientation, downscale to max_side and optionally recompress as
+    # JPEG at the given quality (without one, a JPEG that has to be re-encoded
+    # keeps REENCODE_JPEG_QUALITY). Returns the bytes to send and a report of what
+    # it saved; results are cached per image hash and settings.
+    original = encode_image(image, cache)
+    key = f"{image.content_hash}:{max_side}:{quality}"
+    report = {
+        'original_bytes': len(original),
+        'original_size': image.size,
+        'cache_hit': False,
+    }
+
+    start = time.perf_counter()
+    data = cache.get(key) if cache is not None else None
+    if data is not None:
+        report['cache_hit'] = True
+    else:
+        # 0x0112 is the EXIF orientation tag; 1 means already upright
+        rotated = image.getexif().get(0x0112, 1) != 1
+        processed = ImageOps.exif_transpose(image) if rotated else image
+        resized = max(processed.size) > max_side
+        if resized:
+            if not rotated:
+                processed = processed.copy()
+            processed.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        if not (rotated or resized or quality):
+            data = original
+        else:
+            buf = io.BytesIO()
+            if quality:
+                processed.convert('RGB').save(buf, format='JPEG', quality=quality, optimize=True)
+            else:
+                image_format = image.format if image.format in PASSTHROUGH_FORMATS else 'PNG'
+                options = {}
+                if image_format == 'JPEG':
+                    if processed.mode not in ('RGB', 'L'):
+                        processed = processed.convert('RGB')
+                    # Pillow's default of 75 would visibly degrade the upload
+                    options['quality'] = REENCODE_JPEG_QUALITY
+                processed.save(buf, format=image_format, **options)
+            data = buf.getvalue()
+            # Recompressing can occasionally grow a small image; only keep the
+            # original bytes if they are also correctly oriented
+            if len(data) > len(original) and not rotated:
+                data = original
+        if cache is not None:
+            cache.put(key, data)
+    report['preprocess_ms'] = (time.perf_counter() - start) * 1000
+
+    report['sent_bytes'] = len(data)
+    report['bytes_saved'] = report['original_bytes'] - report['sent_bytes']
+    # Images travel base64 encoded, which inflates them by a third
+    transfer_saved_ms = report['bytes_saved'] * 4 / 3 / ESTIMATED_LINK_BYTES_PER_SECOND * 1000
+    report['latency_saved_ms'] = transfer_saved_ms - report['preprocess_ms']
+    return data, report
+
+def image_list(images):
+    # Requests take one image or a list of them
+    if images is None:
+        return []
+    return list(images) if isinstance(images, (list, tuple)) else [images]
+
+def map_images(fn, images, workers=None):
+    # fn applied to every image on the decode threads, results in input order
+    global _executor
+    workers = DECODE_WORKERS if workers is None else workers
+    if len(images) <= 1 or workers <= 1:
+        return [fn(image) for image in images]
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(DECODE_WORKERS, thread_name_prefix='image-decode')
+    return list(_executor.map(fn, images))
+
+def prepare_payloads(images, max_side=None, quality=None, cache=None, workers=None):
+    # The bytes to send for each image (an ImageSource or an opened image),
+    # preprocessed to max_side when it is given. Returns (bytes, report) pairs;
+    # each report has the seconds spent on that image in 'encode_time'.
+    def prepare(image):
+        start = time.perf_counter()
+        if isinstance(image, ImageSource):
+            image = image.open(cache)
+        if max_side:
+            data, report = preprocess_image(image, max_side, quality, cache)
+        else:
+            cache_hit = cache is not None and getattr(image, 'content_hash', None) in cache
+            data = encode_image(image, cache)
+            report = {'cache_hit': cache_hit, 'sent_bytes': len(data)}
+        report['encode_time'] = time.perf_counter() - start
+        return data, report
+
+    return map_images(prepare, images, workers)
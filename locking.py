@@ -0,0 +1,74 @@
+import os
+import threading
+import zlib
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Advisory file locks shared by every process that uses the conversations
+# directory (several Streamlit servers, batch runs, maintenance scripts).
+#
+# Locks are reentrant per thread, so code that already holds a lock can call
+# helpers that take it again. POSIX uses flock; Windows uses msvcrt.locking,
+# which has no shared mode, so shared locks are exclusive there.
+
+LOCK_DIRNAME = '.locks'
+# Conversations are spread over this many lock files instead of one each
+CONVERSATION_LOCK_STRIPES = 64
+
+_held = threading.local()
+
+def lock_path(directory, name):
+    return os.path.join(directory, LOCK_DIRNAME, f"{name}.lock")
+
+def conversation_lock_path(directory, conversation_id):
+    stripe = zlib.crc32(conversation_id.encode('utf-8')) % CONVERSATION_LOCK_STRIPES
+    return lock_path(directory, f"conversation-{stripe}")
+
+def _acquire(f, shared):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+    else:
+        f.seek(0)
+        # LK_LOCK retries for about ten seconds before giving up; keep waiting
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                continue
+
+def _release(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+@contextmanager
+def file_lock(path, shared=False):
+    held = getattr(_held, 'locks', None)
+    if held is None:
+        held = _held.locks = {}
+    if path in held:
+        # Already held by this thread (shared or exclusive); don't lock again
+        held[path] += 1
+        try:
+            yield
+        finally:
+            held[path] -= 1
+        return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a+b') as f:
+        _acquire(f, shared)
+        held[path] = 1
+        try:
+            yield
+        finally:
+            del held[path]
+            _release(f)
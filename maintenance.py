@@ -0,0 +1,420 @@
+import json
+import os
+import threading
+import time
+
+from blob_store import (
+    BLOB_DIRNAME, MIGRATED_MARKER, blob_path, blob_refcount, collect_garbage, conversation_blobs,
+    conversation_image_hashes, remove_conversation_with_image
+)
+from catalog import optimize_catalog, remove_catalog_entry, update_catalog_entry
+from locking import LOCK_DIRNAME, file_lock, lock_path
+from storage import (
+    SESSION_ID_PATTERN, SESSIONS_DIRNAME, atomic_write_json, compact_conversation, conversation_id_from_filename,
+    conversation_state, last_updated, log_path, read_recovery, recovery_path, snapshot_path
+)
+
+# Background upkeep of the conversations directory.
+#
+# A maintenance pass runs every STORAGE_MAINTENANCE_INTERVAL seconds on a
+# background thread. Only one process does the work at a time; the others see
+# from .maintenance.json that a pass ran recently. A pass:
+#   - folds the append logs of conversations nobody is writing into their
+#     snapshots, and merges the catalog's text index
+#   - corrects image reference counts and deletes images, thumbnails and
+#     descriptions no conversation uses any more
+#   - deletes expired cached answers, stale recovery pointers and temporary
+#     files left behind by crashes
+#   - evicts conversations last updated more than STORAGE_MAX_AGE_DAYS ago;
+#     while the directory is over STORAGE_QUOTA_MB it then trims the caches
+#     (thumbnails, descriptions, cached answers), oldest first, and only if
+#     conversations alone are still over the quota evicts the least recently
+#     updated ones (conversations a session saved within the last day are
+#     never evicted)
+# Files changed within the last ORPHAN_GRACE seconds are never treated as
+# orphans, since a save may still be writing the conversation that uses them.
+# Between items the pass waits while the app has requests running, so it stays
+# off the request path.
+
+STORAGE_QUOTA_MB = float(os.environ.get('STORAGE_QUOTA_MB', 0))
+STORAGE_MAX_AGE_DAYS = float(os.environ.get('STORAGE_MAX_AGE_DAYS', 0))
+# 0 turns background maintenance off
+MAINTENANCE_INTERVAL = float(os.environ.get('STORAGE_MAINTENANCE_INTERVAL', 3600))
+
+ORPHAN_GRACE = 3600
+# Logs untouched for this long are folded into their snapshots
+COMPACT_IDLE = 600
+STALE_SESSION_DAYS = 30
+ACTIVE_SESSION_SECONDS = 24 * 3600
+RESPONSE_CACHE_TTL = 7 * 24 * 3600
+# The first pass waits a little so it doesn't compete with the app starting up
+STARTUP_DELAY = 60
+# Longest a pass waits for the app to go idle before doing the next item anyway
+MAX_DEFER = 30
+
+MARKER_FILENAME = '.maintenance.json'
+LEGACY_RECOVERY_FILENAME = 'current_conversation.json'
+# Caches named by image hash: thumbnails/<xx>/<hash>_<side>.<ext> and descriptions/<xx>/<hash>.json
+IMAGE_CACHE_DIRNAMES = ('thumbnails', 'descriptions')
+RESPONSE_CACHE_DIRNAME = 'response_cache'
+# Everything in these is rebuilt on demand, so it goes before any conversation
+CACHE_DIRNAMES = IMAGE_CACHE_DIRNAMES + (RESPONSE_CACHE_DIRNAME,)
+
+def _remove(path, report):
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+    except FileNotFoundError:
+        return
+    report['removed_files'] += 1
+    report['freed_bytes'] += size
+
+def disk_usage(directory):
+    # Bytes used by everything under the directory except the lock files
+    total = 0
+    for root, dirs, names in os.walk(directory):
+        if LOCK_DIRNAME in dirs:
+            dirs.remove(LOCK_DIRNAME)
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+    return total
+
+def remove_all_conversations(directory):
+    # "Delete all" through the store, so sessions and processes still using the
+    # directory keep consistent locks, catalog and image references; unused
+    # thumbnails and descriptions go with the next maintenance pass
+    removed = 0
+    if not os.path.exists(directory):
+        return removed
+    for name in os.listdir(directory):
+        if not (name.startswith('conversation_') and name.endswith('.json')):
+            continue
+        if remove_conversation_with_image(directory, conversation_id_from_filename(name)):
+            remove_catalog_entry(directory, name)
+            removed += 1
+    return removed
+
+class StorageMaintenance:
+    def __init__(self, directory, quota_mb=STORAGE_QUOTA_MB, max_age_days=STORAGE_MAX_AGE_DAYS,
+                 interval=MAINTENANCE_INTERVAL, busy=None, grace=ORPHAN_GRACE):
+        # `busy` returns True while the app has interactive work in flight
+        self.directory = directory
+        self.quota_bytes = int(quota_mb * 1024 * 1024)
+        self.max_age = max_age_days * 24 * 3600
+        self.interval = interval
+        self.busy = busy
+        self.grace = grace
+        self.last_report = None
+        self.running = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None and self.interval:
+            self._thread = threading.Thread(target=self._loop, name='storage-maintenance', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        delay = min(STARTUP_DELAY, self.interval)
+        while not self._stop.wait(delay):
+            try:
+                self.run_if_due()
+            except Exception as e:
+                print(f"Error in storage maintenance: {e}")
+            delay = self.interval
+
+    def _marker_path(self):
+        return os.path.join(self.directory, MARKER_FILENAME)
+
+    def last_run(self):
+        # The last pass by any process, as written to the marker file
+        try:
+            with open(self._marker_path(), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def run_if_due(self):
+        if not os.path.exists(self.directory):
+            return None
+        with file_lock(lock_path(self.directory, 'maintenance')):
+            last = self.last_run()
+            # A little slack, so processes started together don't take turns skipping
+            if last and time.time() - last.get('finished', 0) < self.interval * 0.9:
+                return None
+            report = self.run_once()
+            atomic_write_json(self._marker_path(), report)
+        return report
+
+    def _pause(self):
+        # Lets interactive requests go first; gives up waiting after MAX_DEFER
+        if self.busy is None:
+            time.sleep(0)
+            return
+        deadline = time.monotonic() + MAX_DEFER
+        while self.busy() and time.monotonic() < deadline and not self._stop.is_set():
+            time.sleep(0.1)
+
+    def run_once(self):
+        start = time.time()
+        self.running = True
+        report = {
+            'started': start, 'conversations': 0, 'compacted': 0, 'evicted': 0, 'caches_trimmed': 0, 'removed_files': 0,
+            'freed_bytes': 0, 'blobs_repaired': 0, 'blobs_missing': 0,
+        }
+        try:
+            conversations, complete = self._scan()
+            report['conversations'] = len(conversations)
+            self._compact(conversations, report)
+            # With a conversation that couldn't be read, its images may look unused
+            if complete:
+                self._collect_images(conversations, report)
+                self._collect_caches(conversations, report)
+            self._collect_sessions(conversations, report)
+            self._collect_temporary_files(report)
+            optimize_catalog(self.directory)
+            # Last, so the quota only costs conversations once garbage is gone
+            self._evict(conversations, report)
+            report['usage_bytes'] = disk_usage(self.directory)
+            report['quota_bytes'] = self.quota_bytes
+        finally:
+            self.running = False
+        report['finished'] = time.time()
+        report['seconds'] = report['finished'] - start
+        self.last_report = report
+        return report
+
+    def _scan(self):
+        # conversation id -> what the later steps need; complete is False if
+        # some conversation couldn't be read
+        conversations = {}
+        complete = True
+        for name in os.listdir(self.directory):
+            if not (name.startswith('conversation_') and name.endswith('.json')):
+                continue
+            conversation_id = conversation_id_from_filename(name)
+            self._pause()
+            try:
+                state = conversation_state(self.directory, conversation_id)
+                updated = last_updated(state, conversation_id)
+                snapshot = os.stat(snapshot_path(self.directory, conversation_id))
+                try:
+                    log = os.stat(log_path(self.directory, conversation_id))
+                except FileNotFoundError:
+                    log = None
+            except FileNotFoundError:
+                # Deleted since the directory was listed
+                continue
+            except (OSError, ValueError) as e:
+                print(f"Error reading {name} during maintenance: {e}")
+                complete = False
+                continue
+            conversations[conversation_id] = {
+                'filename': name,
+                'image_blobs': conversation_blobs(state),
+                'image_hashes': conversation_image_hashes(state),
+                'image': state.get('image'),
+                'updated': updated,
+                'log_mtime': log.st_mtime if log else None,
+                'bytes': snapshot.st_size + (log.st_size if log else 0),
+            }
+        return conversations, complete
+
+    def _compact(self, conversations, report):
+        idle_before = time.time() - COMPACT_IDLE
+        for conversation_id, conversation in conversations.items():
+            if conversation['log_mtime'] is None or conversation['log_mtime'] > idle_before:
+                continue
+            self._pause()
+            try:
+                if compact_conversation(self.directory, conversation_id):
+                    update_catalog_entry(self.directory, conversation['filename'])
+                    report['compacted'] += 1
+            except FileNotFoundError:
+                continue
+
+    def _session_ids(self):
+        sessions = os.path.join(self.directory, SESSIONS_DIRNAME)
+        if not os.path.exists(sessions):
+            return []
+        return [
+            name[:-len('.json')] for name in os.listdir(sessions)
+            if name.endswith('.json') and SESSION_ID_PATTERN.fullmatch(name[:-len('.json')])
+        ]
+
+    def _active_conversations(self):
+        # Conversations that a session saved recently; they are never evicted
+        active = set()
+        recent = time.time() - ACTIVE_SESSION_SECONDS
+        for session_id in self._session_ids():
+            try:
+                if os.path.getmtime(recovery_path(self.directory, session_id)) < recent:
+                    continue
+            except FileNotFoundError:
+                continue
+            conversation_id = read_recovery(self.directory, session_id)
+            if conversation_id:
+                active.add(conversation_id)
+        return active
+
+    def _cache_files(self):
+        # (mtime, size, path) of every cache file, oldest first
+        files = []
+        for dirname in CACHE_DIRNAMES:
+            for root, _, names in os.walk(os.path.join(self.directory, dirname)):
+                for name in names:
+                    if name.startswith('.tmp_'):
+                        continue
+                    try:
+                        stat = os.stat(os.path.join(root, name))
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+        return sorted(files)
+
+    def _trim_caches(self, usage, report):
+        # Removes cache files, oldest first, until usage fits the quota;
+        # returns (usage, bytes still held by caches)
+        files = self._cache_files()
+        cached = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if usage <= self.quota_bytes:
+                break
+            freed = report['freed_bytes']
+            _remove(path, report)
+            if report['freed_bytes'] != freed:
+                report['caches_trimmed'] += 1
+            usage -= size
+            cached -= size
+        return usage, cached
+
+    def _evict(self, conversations, report):
+        if not self.quota_bytes and not self.max_age:
+            return
+        usage = disk_usage(self.directory) if self.quota_bytes else 0
+        cached = 0
+        if self.quota_bytes and usage > self.quota_bytes:
+            self._pause()
+            usage, cached = self._trim_caches(usage, report)
+        too_old = time.time() - self.max_age if self.max_age else None
+        active = self._active_conversations()
+        # Oldest first; once neither limit applies, newer ones can't need evicting either
+        for conversation_id, conversation in sorted(conversations.items(), key=lambda item: item[1]['updated']):
+            expired = too_old is not None and conversation['updated'] < too_old
+            # Caches left over are not worth a conversation
+            over_quota = self.quota_bytes and usage - cached > self.quota_bytes
+            if not expired and not over_quota:
+                break
+            if conversation_id in active:
+                continue
+            self._pause()
+            freed = conversation['bytes']
+            for key in conversation['image_blobs']:
+                if blob_refcount(self.directory, key) == 1 and os.path.exists(blob_path(self.directory, key)):
+                    freed += os.path.getsize(blob_path(self.directory, key))
+            if remove_conversation_with_image(self.directory, conversation_id):
+                remove_catalog_entry(self.directory, conversation['filename'])
+                report['evicted'] += 1
+                report['freed_bytes'] += freed
+                usage -= freed
+            del conversations[conversation_id]
+
+    def _collect_images(self, conversations, report):
+        references = {}
+        for conversation in conversations.values():
+            for key in set(conversation['image_blobs']):
+                references[key] = references.get(key, 0) + 1
+        self._pause()
+        blobs = collect_garbage(self.directory, references, self.grace)
+        report['removed_files'] += blobs['removed']
+        report['freed_bytes'] += blobs['freed_bytes']
+        report['blobs_repaired'] = blobs['repaired']
+        report['blobs_missing'] = blobs['missing']
+
+        # Images saved next to conversations by older versions are moved into
+        # the blob store on startup; any still there afterwards belong to no one
+        if os.path.exists(os.path.join(self.directory, BLOB_DIRNAME, MIGRATED_MARKER)):
+            in_use = {conversation['image'] for conversation in conversations.values() if conversation['image']}
+            cutoff = time.time() - self.grace
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if name.startswith('image_') and name not in in_use and os.path.getmtime(path) < cutoff:
+                    _remove(path, report)
+
+    def _collect_caches(self, conversations, report):
+        # Thumbnails and descriptions of images that no conversation uses; the
+        # grace period keeps those of images just uploaded and not yet saved.
+        # Both are rebuilt on demand if an image comes back.
+        hashes = set()
+        for conversation in conversations.values():
+            hashes.update(conversation['image_hashes'])
+            hashes.update(os.path.splitext(key)[0] for key in conversation['image_blobs'])
+        cutoff = time.time() - self.grace
+        for dirname in IMAGE_CACHE_DIRNAMES:
+            for root, _, names in os.walk(os.path.join(self.directory, dirname)):
+                self._pause()
+                for name in names:
+                    image_hash = os.path.splitext(name)[0].split('_')[0]
+                    path = os.path.join(root, name)
+                    if image_hash not in hashes and not name.startswith('.tmp_') and os.path.getmtime(path) < cutoff:
+                        _remove(path, report)
+
+        expired = time.time() - RESPONSE_CACHE_TTL
+        for root, _, names in os.walk(os.path.join(self.directory, RESPONSE_CACHE_DIRNAME)):
+            self._pause()
+            for name in names:
+                path = os.path.join(root, name)
+                if name.endswith('.json') and os.path.getmtime(path) < expired:
+                    _remove(path, report)
+
+    def _collect_sessions(self, conversations, report):
+        # Recovery pointers of sessions not seen for STALE_SESSION_DAYS, or
+        # naming a conversation that no longer exists
+        stale = time.time() - STALE_SESSION_DAYS * 24 * 3600
+        cutoff = time.time() - self.grace
+        for session_id in self._session_ids():
+            path = recovery_path(self.directory, session_id)
+            try:
+                mtime = os.path.getmtime(path)
+            except FileNotFoundError:
+                continue
+            conversation_id = read_recovery(self.directory, session_id)
+            deleted = conversation_id not in conversations and not (
+                conversation_id and os.path.exists(snapshot_path(self.directory, conversation_id))
+            )
+            if mtime < stale or (deleted and mtime < cutoff):
+                _remove(path, report)
+        # Shared recovery file of older versions; sessions have their own now
+        legacy = os.path.join(self.directory, LEGACY_RECOVERY_FILENAME)
+        if os.path.exists(legacy):
+            _remove(legacy, report)
+
+    def _collect_temporary_files(self, report):
+        # Left by writes interrupted before their rename
+        cutoff = time.time() - self.grace
+        for root, dirs, names in os.walk(self.directory):
+            if LOCK_DIRNAME in dirs:
+                dirs.remove(LOCK_DIRNAME)
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    if name.startswith('.tmp_') and os.path.getmtime(path) < cutoff:
+                        _remove(path, report)
+                except FileNotFoundError:
+                    continue
+
+    def status(self):
+        return {
+            'running': self.running,
+            'interval': self.interval,
+            'quota_bytes': self.quota_bytes,
+            'max_age_days': self.max_age / (24 * 3600),
+            'last_run': self.last_run(),
+        }
@@ -0,0 +1,135 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# Per-process performance metrics. Stage timings are collected as histograms
+# and can be exported in the Prometheus text format; every chat turn can also
+# be appended to a JSONL log so individual slow turns can be looked at later.
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Ollama reports these on the final chat response; durations are in nanoseconds
+OLLAMA_COUNTERS = (
+    'prompt_eval_count', 'prompt_eval_duration', 'eval_count', 'eval_duration',
+    'load_duration', 'total_duration',
+)
+
+# Keys of a turn's stats dict and the stage they are reported as
+TURN_STAGES = {
+    'encode_time': 'image_encode',
+    'queue_wait': 'queue_wait',
+    'time_to_first_token': 'first_token',
+    'total_time': 'generation',
+}
+
+def ollama_counters(response):
+    counters = {}
+    for name in OLLAMA_COUNTERS:
+        value = response.get(name) if hasattr(response, 'get') else getattr(response, name, None)
+        if value is not None:
+            counters[name] = value
+    return counters
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+
+class Metrics:
+    def __init__(self, log_path=None, recent_turns=50):
+        self.log_path = log_path
+        self.recent = deque(maxlen=recent_turns)
+        self._stages = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def record_turn(self, stats):
+        # Fold one turn's stats into the histograms and append it to the log
+        for name, stage in TURN_STAGES.items():
+            if name in stats:
+                self.observe(stage, stats[name])
+        # encode_time covers all of a turn's images, prepared side by side;
+        # this is what each one took
+        for image in stats.get('images', []):
+            self.observe('image_encode_each', image['encode_ms'] / 1000)
+        counters = stats.get('ollama', {})
+        if 'load_duration' in counters:
+            self.observe('model_load', counters['load_duration'] / 1e9)
+        if 'prompt_eval_duration' in counters:
+            self.observe('prompt_eval', counters['prompt_eval_duration'] / 1e9)
+        if 'eval_duration' in counters:
+            self.observe('eval', counters['eval_duration'] / 1e9)
+        self.increment('turns')
+        self.increment('prompt_tokens', counters.get('prompt_eval_count', 0))
+        self.increment('eval_tokens', counters.get('eval_count', 0))
+        if stats.get('error'):
+            self.increment('errors')
+        if stats.get('route'):
+            # Turns answered by the vision model vs. routed to the text model
+            self.increment(f"{stats['route']}_turns")
+
+        record = {'time': time.time(), **stats}
+        self.recent.append(record)
+        if self.log_path:
+            directory = os.path.dirname(self.log_path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            with self._lock, open(self.log_path, 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+
+    def summary(self):
+        with self._lock:
+            return {
+                stage: {
+                    'count': histogram.count,
+                    'mean': histogram.sum / histogram.count if histogram.count else 0.0,
+                    'total': histogram.sum,
+                }
+                for stage, histogram in sorted(self._stages.items())
+            }
+
+    def prometheus_text(self, prefix='vision_app'):
+        lines = [
+            f"# HELP {prefix}_stage_seconds Time spent per stage of a chat turn",
+            f"# TYPE {prefix}_stage_seconds histogram",
+        ]
+        with self._lock:
+            for stage, histogram in sorted(self._stages.items()):
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+            for name, value in sorted(self._counters.items()):
+                lines.append(f"# TYPE {prefix}_{name}_total counter")
+                lines.append(f"{prefix}_{name}_total {value}")
+            for name, value in sorted(self._gauges.items()):
+                lines.append(f"# TYPE {prefix}_{name} gauge")
+                lines.append(f"{prefix}_{name} {value}")
+        return '\n'.join(lines) + '\n'
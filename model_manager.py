@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+
+from backends import model_names
+
+# Keeps the vision model loaded while the app is in use.
+#
+# Ollama unloads a model a few minutes after its last request, and the next
+# request then waits several seconds for it to load again. ModelManager loads
+# the model when the app starts (and again when a conversation is opened),
+# renews its keep_alive in the background while any session has been active
+# recently, and asks Ollama to unload it once the app has been idle for
+# OLLAMA_IDLE_UNLOAD seconds (0 keeps it loaded for good).
+
+IDLE_UNLOAD = float(os.environ.get('OLLAMA_IDLE_UNLOAD', 900))
+# How often the background thread renews keep_alive and checks the load state
+REFRESH_INTERVAL = float(os.environ.get('OLLAMA_KEEPALIVE_INTERVAL', 60))
+
+class ModelManager:
+    def __init__(self, clients, model, idle_timeout=IDLE_UNLOAD, refresh_interval=REFRESH_INTERVAL):
+        # `clients` maps a host name to the ollama client for that host
+        self.clients = clients
+        self.model = model
+        self.idle_timeout = idle_timeout
+        self.refresh_interval = refresh_interval
+        # While active the model is kept for at least the idle period, so it
+        # stays loaded even if a refresh is late
+        self.keep_alive = f"{int(idle_timeout)}s" if idle_timeout else -1
+        self.last_activity = time.time()
+        self.unloaded = False
+        self._hosts = {
+            host: {'state': 'unknown', 'expires_at': None, 'load_seconds': None, 'error': None}
+            for host in clients
+        }
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.preload()
+        if self._thread is None and self.refresh_interval:
+            self._thread = threading.Thread(target=self._refresh_loop, name='ollama-keep-alive', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def touch(self):
+        # Called on every interaction; brings the model back after an idle unload
+        self.last_activity = time.time()
+        if self.unloaded:
+            self.unloaded = False
+            self.preload()
+
+    def preload(self):
+        # Load the model in the background on every host that doesn't have it yet
+        for host, client in self.clients.items():
+            with self._lock:
+                if self._hosts[host]['state'] in ('loading', 'loaded'):
+                    continue
+                self._hosts[host]['state'] = 'loading'
+            threading.Thread(target=self._load, args=(host, client), name='ollama-preload', daemon=True).start()
+
+    def _load(self, host, client):
+        start = time.perf_counter()
+        try:
+            # A chat request without messages only loads the model
+            client.chat(model=self.model, messages=[], keep_alive=self.keep_alive)
+        except Exception as e:
+            with self._lock:
+                self._hosts[host].update(state='error', error=str(e))
+            return
+        with self._lock:
+            self._hosts[host].update(state='loaded', load_seconds=time.perf_counter() - start, error=None)
+        self._check(host, client)
+
+    def _check(self, host, client):
+        try:
+            running = client.ps()
+        except Exception as e:
+            with self._lock:
+                self._hosts[host].update(state='error', error=str(e))
+            return
+        names = model_names(self.model)
+        entry = next((m for m in running.models if (m.model or m.name) in names), None)
+        with self._lock:
+            status = self._hosts[host]
+            if status['state'] == 'loading':
+                return
+            if entry is None:
+                status.update(state='unloaded', expires_at=None, error=None)
+            else:
+                expires_at = entry.expires_at.timestamp() if entry.expires_at else None
+                status.update(state='loaded', expires_at=expires_at, error=None)
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self.refresh_interval):
+            idle = time.time() - self.last_activity
+            if self.idle_timeout and idle >= self.idle_timeout:
+                if not self.unloaded:
+                    self.unload()
+            else:
+                # Renewing keep_alive also reloads the model if Ollama dropped it
+                for host, client in self.clients.items():
+                    self._load(host, client)
+            for host, client in self.clients.items():
+                self._check(host, client)
+
+    def unload(self):
+        self.unloaded = True
+        for host, client in self.clients.items():
+            try:
+                client.chat(model=self.model, messages=[], keep_alive=0)
+            except Exception as e:
+                with self._lock:
+                    self._hosts[host].update(state='error', error=str(e))
+                continue
+            with self._lock:
+                self._hosts[host].update(state='unloaded', expires_at=None)
+
+    def status(self):
+        with self._lock:
+            return {
+                'model': self.model,
+                'idle_seconds': time.time() - self.last_activity,
+                'hosts': [{'host': host, **status} for host, status in self._hosts.items()],
+            }
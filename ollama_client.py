@@ -0,0 +1,41 @@
+import os
+
+import httpx
+import ollama
+
+# Client construction for talking to Ollama. Clients keep a pool of HTTP
+# connections, so create one per process (or per event loop for AsyncClient)
+# and reuse it rather than going through the module-level ollama.chat.
+#
+# Settings can be overridden from the environment:
+#   OLLAMA_HOST                 server URL (default: the ollama library default)
+#   OLLAMA_CONNECT_TIMEOUT      seconds to establish a connection
+#   OLLAMA_READ_TIMEOUT         seconds to wait for the next chunk of a response
+#   OLLAMA_MAX_CONNECTIONS      upper bound on open connections per client
+
+CONNECT_TIMEOUT = float(os.environ.get('OLLAMA_CONNECT_TIMEOUT', 10))
+READ_TIMEOUT = float(os.environ.get('OLLAMA_READ_TIMEOUT', 300))
+MAX_CONNECTIONS = int(os.environ.get('OLLAMA_MAX_CONNECTIONS', 32))
+
+def client_options(host=None, read_timeout=None, connect_timeout=None, max_connections=None):
+    # httpx applies these limits to each request, not to the client as a whole:
+    # a streamed reply only times out if no chunk arrives for read_timeout seconds
+    read_timeout = READ_TIMEOUT if read_timeout is None else read_timeout
+    connect_timeout = CONNECT_TIMEOUT if connect_timeout is None else connect_timeout
+    max_connections = max_connections or MAX_CONNECTIONS
+    return {
+        'host': host or os.environ.get('OLLAMA_HOST'),
+        'timeout': httpx.Timeout(read_timeout, connect=connect_timeout),
+        'limits': httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=60
+        ),
+    }
+
+def create_client(host=None, **options):
+    return ollama.Client(**client_options(host, **options))
+
+def create_async_client(host=None, **options):
+    # AsyncClient is bound to the event loop it is first used on; create one per loop
+    return ollama.AsyncClient(**client_options(host, **options))
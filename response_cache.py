@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from storage import atomic_write_json
+
+# Memoizes model answers for requests that are exactly the same: same image,
+# model, options, system prompt, history window, context and prompt. Entries
+# live in an in-memory LRU and in a directory on disk, both with a TTL; the
+# disk tier is also bounded in total size, dropping the oldest entries first.
+
+def response_cache_key(model, messages, image_hash, options=None):
+    # `messages` is the full request; image bytes are replaced by the image
+    # hash (plus anything that changes the bytes sent, via `options`)
+    request = {
+        'model': model,
+        'options': options or {},
+        'image': image_hash,
+        'messages': [
+            {name: value for name, value in message.items() if name != 'images'}
+            for message in messages
+        ],
+    }
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    def __init__(self, directory, max_entries=512, max_disk_bytes=64 * 1024 * 1024, ttl=7 * 24 * 3600):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = None
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if now - entry['created'] < self.ttl:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return entry['response']
+                del self._memory[key]
+
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+        if entry is not None and now - entry['created'] >= self.ttl:
+            # Another session or the maintenance pass may have removed it already
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            entry = None
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, entry)
+        return entry['response']
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def put(self, key, response):
+        entry = {'created': time.time(), 'response': response}
+        with self._lock:
+            self._remember(key, entry)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomic_write_json(path, entry)
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan()[1]
+            else:
+                self._disk_bytes += os.path.getsize(path)
+            over_quota = self._disk_bytes > self.max_disk_bytes
+        if over_quota:
+            self._evict()
+
+    def _scan(self):
+        files = []
+        total = 0
+        if os.path.exists(self.directory):
+            for root, _, names in os.walk(self.directory):
+                for name in names:
+                    if name.endswith('.json'):
+                        path = os.path.join(root, name)
+                        stat = os.stat(path)
+                        files.append((stat.st_mtime, stat.st_size, path))
+                        total += stat.st_size
+        return files, total
+
+    def _evict(self):
+        # Drop expired entries, then the oldest ones, until the disk tier is
+        # back under 80% of its budget
+        files, total = self._scan()
+        files.sort()
+        target = self.max_disk_bytes * 0.8
+        expired_before = time.time() - self.ttl
+        for mtime, size, path in files:
+            if total <= target and mtime >= expired_before:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        with self._lock:
+            self._disk_bytes = total
+
+    def stats(self):
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'memory_entries': len(self._memory),
+            }
@@ -0,0 +1,189 @@
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from storage import atomic_write_json
+
+# Routing of follow-up questions that don't need the image.
+#
+# After the first answer about an image, the vision model writes a detailed
+# description of it once, stored per image hash. Later prompts that only work
+# on the conversation so far ("summarize that", "translate it to French") are
+# answered by a smaller text model from that description; anything that asks
+# about what is in the picture still goes to the vision model. Starting a
+# prompt with /vision always sends it to the vision model.
+#
+# In conversations with several images, a prompt that names some of them
+# ("image 2", "photos 1 and 3", "the first and last picture") is sent with
+# only those; any other prompt, or one whose references can't be read
+# unambiguously, gets all of them.
+
+FORCE_VISION_PREFIX = '/vision'
+# The prefix on its own, not the start of a longer word ("/visionary")
+FORCE_VISION_PATTERN = re.compile(rf"\s*{re.escape(FORCE_VISION_PREFIX)}(?:\s+|$)", re.IGNORECASE)
+
+DESCRIPTION_PROMPT = """Describe this image in as much detail as possible, so that someone who
+cannot see it could answer questions about it. Cover every object and person with
+their position, colors, sizes and counts, any visible text quoted exactly, the
+background, lighting and overall scene. Use plain factual sentences."""
+
+# Prompts that mention any of these are about the pixels and keep the image
+VISUAL_PATTERN = re.compile(
+    r"\b(image|picture|photo|pic|see|seen|look|looks|looking|visible|show|shown|shows|"
+    r"colou?rs?|shape|size|left|right|top|bottom|corner|background|foreground|behind|"
+    r"front|next to|near|count|how many|where|zoom|detail|details|pixel|read|text|"
+    r"written|sign|label|logo|face|wearing|position|describe|identify|spot|find|"
+    r"objects?|things?|items?|people|persons?|animals?)\b",
+    re.IGNORECASE
+)
+# Prompts that only rework earlier answers can be answered from text
+TEXT_ONLY_PATTERN = re.compile(
+    r"\b(summari[sz]e|summary|shorter|shorten|rephrase|reword|rewrite|translate|"
+    r"simplify|simpler|explain|elaborate|expand|bullet|bullets|one line|one sentence|"
+    r"tl;?dr|format|tone|thanks|thank you|what do you mean|clarify|previous answer)\b",
+    re.IGNORECASE
+)
+
+_IMAGE_WORDS = r"(?:images?|pictures?|photos?|pics?|shots?|screenshots?)"
+_LIST_SEPARATOR = r"\s*(?:,\s*(?:and\s+)?|and|&|-|to)\s*"
+# A number ends at a word boundary, so "image 2x bigger" names no image
+_NUMBER = r"#?\d+(?![\w.]\w)\b"
+# "image 2", "photos 1 and 3", "pictures #2-4"
+NUMBERED_IMAGES_PATTERN = re.compile(
+    rf"\b{_IMAGE_WORDS}\s*({_NUMBER}(?:{_LIST_SEPARATOR}{_NUMBER})*)",
+    re.IGNORECASE
+)
+# Any number right after an image word, readable or not
+IMAGE_NUMBER_PATTERN = re.compile(rf"\b{_IMAGE_WORDS}\s*#?\s*\d", re.IGNORECASE)
+# A list that carries on past what NUMBERED_IMAGES_PATTERN could read
+LIST_CONTINUES_PATTERN = re.compile(rf"{_LIST_SEPARATOR}#?\d", re.IGNORECASE)
+ORDINALS = {
+    'first': 1, 'second': 2, 'third': 3, 'fourth': 4, 'fifth': 5,
+    'sixth': 6, 'seventh': 7, 'eighth': 8, 'ninth': 9, 'tenth': 10,
+}
+_ORDINAL = rf"(?:{'|'.join(ORDINALS)}|last|latest|newest)"
+# "the second photo", "the first and the last picture", "first, third and
+# last images"; not "the last one", which may well mean an answer
+ORDINAL_IMAGES_PATTERN = re.compile(
+    rf"\b({_ORDINAL}(?:\s*(?:,\s*(?:and\s+)?|and|&|or)\s*(?:the\s+)?{_ORDINAL})*)\s+{_IMAGE_WORDS}\b",
+    re.IGNORECASE
+)
+ORDINAL_PATTERN = re.compile(rf"\b{_ORDINAL}\b", re.IGNORECASE)
+
+def split_force_vision(prompt):
+    # Returns (forced, prompt without the prefix)
+    match = FORCE_VISION_PATTERN.match(prompt)
+    if match:
+        return True, prompt[match.end():]
+    return False, prompt
+
+def needs_vision(prompt):
+    # Anything that isn't clearly text-only keeps the image, so a wrong guess
+    # costs latency rather than answer quality
+    if VISUAL_PATTERN.search(prompt):
+        return True
+    return not TEXT_ONLY_PATTERN.search(prompt)
+
+def select_images(prompt, count):
+    # Indices of the images a prompt is about, out of `count`: the ones it
+    # names, or all of them if it names none (or only ones that don't exist).
+    # Sending an extra image only costs time, leaving one out costs the
+    # answer, so anything not fully understood selects every image.
+    everything = list(range(count))
+    if count <= 1:
+        return everything
+    named = set()
+    numbered = list(NUMBERED_IMAGES_PATTERN.finditer(prompt))
+    if len(numbered) != len(IMAGE_NUMBER_PATTERN.findall(prompt)):
+        return everything
+    for match in numbered:
+        if LIST_CONTINUES_PATTERN.match(prompt, match.end()):
+            return everything
+        numbers = re.split(r"\s*(-|to|,\s*and|,|and|&)\s*", match.group(1).replace('#', ''))
+        # re.split keeps the separators at odd positions
+        for index in range(0, len(numbers), 2):
+            number = int(numbers[index])
+            if index >= 2 and numbers[index - 1] in ('-', 'to'):
+                named.update(range(int(numbers[index - 2]), number + 1))
+            else:
+                named.add(number)
+    ordinal_words = 0
+    for match in ORDINAL_IMAGES_PATTERN.finditer(prompt):
+        for word in ORDINAL_PATTERN.findall(match.group(1)):
+            named.add(ORDINALS.get(word.lower(), count))
+            ordinal_words += 1
+    # An ordinal outside those lists ("the second photo and the last one")
+    # may or may not be another image
+    if named and ordinal_words != len(ORDINAL_PATTERN.findall(prompt)):
+        return everything
+    selected = sorted(number - 1 for number in named if 1 <= number <= count)
+    return selected or everything
+
+class DescriptionStore:
+    def __init__(self, directory, max_entries=256):
+        self.directory = directory
+        self.max_entries = max_entries
+        self._memory = OrderedDict()
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def _path(self, image_hash):
+        return os.path.join(self.directory, image_hash[:2], f"{image_hash}.json")
+
+    def get(self, image_hash):
+        with self._lock:
+            description = self._memory.get(image_hash)
+            if description is not None:
+                self._memory.move_to_end(image_hash)
+                return description
+        try:
+            with open(self._path(image_hash), 'r') as f:
+                description = json.load(f)['description']
+        except (OSError, ValueError, KeyError):
+            return None
+        with self._lock:
+            self._remember(image_hash, description)
+        return description
+
+    def _remember(self, image_hash, description):
+        self._memory[image_hash] = description
+        self._memory.move_to_end(image_hash)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def put(self, image_hash, description):
+        path = self._path(image_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomic_write_json(path, {'description': description})
+        with self._lock:
+            self._remember(image_hash, description)
+
+    def prefetch(self, image_hash, describe, after=None):
+        # Runs describe() in the background unless the description exists or
+        # is already being written; returns immediately. `after()` runs once
+        # the description is stored, and its errors don't affect it
+        if self.get(image_hash) is not None:
+            return
+        with self._lock:
+            if image_hash in self._pending:
+                return
+            self._pending.add(image_hash)
+
+        def run():
+            try:
+                self.put(image_hash, describe())
+            except Exception as e:
+                print(f"Error describing image {image_hash}: {e}")
+                return
+            finally:
+                with self._lock:
+                    self._pending.discard(image_hash)
+            if after is not None:
+                try:
+                    after()
+                except Exception as e:
+                    print(f"Error after describing image {image_hash}: {e}")
+
+        threading.Thread(target=run, name='describe-image', daemon=True).start()
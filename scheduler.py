@@ -0,0 +1,162 @@
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+# Admission control for model requests within one process.
+#
+# Every generation takes a slot before it is sent to Ollama. There are
+# OLLAMA_PARALLEL_PER_HOST slots per configured host; when they are all taken,
+# requests wait in a priority queue, interactive turns ahead of batch and
+# background work, first come first served within a priority. A request that
+# is cancelled while waiting leaves the queue without ever reaching Ollama.
+
+PARALLEL_PER_HOST = int(os.environ.get('OLLAMA_PARALLEL_PER_HOST', 2))
+
+INTERACTIVE = 0
+BATCH = 1
+
+# How often a waiting request checks its cancel event
+POLL_INTERVAL = 0.05
+
+class Cancelled(Exception):
+    pass
+
+class RequestScheduler:
+    def __init__(self, slots, recent_waits=100):
+        self.slots = slots
+        self.running = 0
+        self.completed = 0
+        self.cancelled = 0
+        self._queue = []
+        self._sequence = itertools.count()
+        self._waits = deque(maxlen=recent_waits)
+        self._condition = threading.Condition()
+
+    def _try_acquire(self, entry):
+        # Called with the lock held: the head of the queue gets the next free slot
+        if self.running < self.slots and self._queue and self._queue[0] is entry:
+            heapq.heappop(self._queue)
+            self.running += 1
+            return True
+        return False
+
+    def _enqueue(self, priority):
+        entry = [priority, next(self._sequence), time.perf_counter()]
+        heapq.heappush(self._queue, entry)
+        return entry
+
+    def _withdraw(self, entry):
+        self._queue.remove(entry)
+        heapq.heapify(self._queue)
+        self.cancelled += 1
+        self._condition.notify_all()
+
+    def _granted(self, entry):
+        wait = time.perf_counter() - entry[2]
+        self._waits.append(wait)
+        return wait
+
+    def acquire(self, priority=INTERACTIVE, cancel=None):
+        # Blocks until a slot is free and returns the seconds spent waiting.
+        # Raises Cancelled if `cancel` (a threading.Event) is set first,
+        # including when it is already set and a slot is free.
+        entry = self.enqueue(priority)
+        try:
+            return self.wait(entry, cancel)
+        except BaseException:
+            self.withdraw(entry)
+            raise
+
+    def enqueue(self, priority=INTERACTIVE):
+        # Takes a place in the queue without waiting; hand the returned entry
+        # to wait(), and to withdraw() if the slot is no longer wanted
+        with self._condition:
+            return self._enqueue(priority)
+
+    def wait(self, entry, cancel=None, timeout=None):
+        # Waits up to `timeout` seconds (None: until granted) for the entry's
+        # slot. Returns the seconds spent queued once it is granted, or None if
+        # it is still queued, keeping its place; raises Cancelled if `cancel`
+        # is set first.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                if cancel is not None and cancel.is_set():
+                    raise Cancelled()
+                if self._try_acquire(entry):
+                    return self._granted(entry)
+                delay = POLL_INTERVAL
+                if deadline is not None:
+                    delay = min(delay, deadline - time.monotonic())
+                    if delay <= 0:
+                        return None
+                self._condition.wait(delay)
+
+    def withdraw(self, entry):
+        # Leaves the queue; a no-op once the slot was granted
+        with self._condition:
+            if entry in self._queue:
+                self._withdraw(entry)
+
+    async def acquire_async(self, priority=BATCH, cancel=None):
+        # Same as acquire, without holding a thread while waiting
+        with self._condition:
+            entry = self._enqueue(priority)
+        try:
+            while True:
+                with self._condition:
+                    if cancel is not None and cancel.is_set():
+                        raise Cancelled()
+                    if self._try_acquire(entry):
+                        return self._granted(entry)
+                await asyncio.sleep(POLL_INTERVAL)
+        except BaseException:
+            with self._condition:
+                if entry in self._queue:
+                    self._withdraw(entry)
+            raise
+
+    def release(self):
+        with self._condition:
+            self.running -= 1
+            self.completed += 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, priority=INTERACTIVE, cancel=None):
+        wait = self.acquire(priority, cancel)
+        try:
+            yield wait
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def slot_async(self, priority=BATCH, cancel=None):
+        wait = await self.acquire_async(priority, cancel)
+        try:
+            yield wait
+        finally:
+            self.release()
+
+    def stats(self):
+        with self._condition:
+            waits = list(self._waits)
+            queued = {INTERACTIVE: 0, BATCH: 0}
+            for entry in self._queue:
+                queued[entry[0]] = queued.get(entry[0], 0) + 1
+            return {
+                'slots': self.slots,
+                'running': self.running,
+                'queued': len(self._queue),
+                'queued_interactive': queued[INTERACTIVE],
+                'queued_batch': queued[BATCH],
+                'completed': self.completed,
+                'cancelled': self.cancelled,
+                'mean_wait': sum(waits) / len(waits) if waits else 0.0,
+                'max_wait': max(waits) if waits else 0.0,
+            }
@@ -0,0 +1,247 @@
+import json
+import os
+import re
+import tempfile
+import threading
+from datetime import datetime
+
+from locking import conversation_lock_path, file_lock, lock_path
+
+# Conversation storage engine.
+#
+# Each conversation has a stable id and is stored as two files:
+#   conversation_{id}.json  snapshot in the original format (timestamp, messages,
+#                           context, title), so conversations saved by older
+#                           versions load unchanged
+#   conversation_{id}.log   append-only JSON lines, one record per new message
+#                           or metadata change since the last snapshot
+# A turn only appends its new records to the log. Once the log grows past
+# COMPACT_LOG_BYTES it is folded back into the snapshot, which is replaced
+# atomically via rename.
+#
+# Several processes may share the directory, so every change to a conversation
+# holds its advisory lock (see locking.py) and reads hold it shared; a reader
+# therefore never sees a snapshot and log from different moments. File locks
+# are always taken before the in-process _lock, never after it.
+#
+# Each browser session also has its own recovery pointer under sessions/,
+# naming the conversation it had open, so users don't restore each other's work.
+
+COMPACT_LOG_BYTES = 256 * 1024
+SESSIONS_DIRNAME = 'sessions'
+# Session ids end up in file names, so only simple tokens are accepted
+SESSION_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{8,64}')
+
+class ConversationConflict(Exception):
+    # The conversation gained messages the saving session has not seen
+    pass
+
+_lock = threading.RLock()
+# Per-conversation summary of what is on disk, so appending a turn does not
+# require reading the conversation back. Validated against the file sizes.
+_states = {}
+
+def snapshot_path(directory, conversation_id):
+    return os.path.join(directory, f'conversation_{conversation_id}.json')
+
+def log_path(directory, conversation_id):
+    return os.path.join(directory, f'conversation_{conversation_id}.log')
+
+def conversation_id_from_filename(filename):
+    return os.path.basename(filename).replace('conversation_', '').replace('.json', '')
+
+def _now():
+    return datetime.now().strftime("%Y%m%d_%H%M%S")
+
+def atomic_write_bytes(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def atomic_write_json(path, data):
+    atomic_write_bytes(path, json.dumps(data, indent=4).encode('utf-8'))
+
+def _apply_record(data, record):
+    if record['type'] == 'message':
+        # Records already folded into the snapshot are skipped, which makes
+        # replay safe even if compaction stopped before removing the log
+        if record['index'] == len(data['messages']):
+            data['messages'].append(record['message'])
+        data['updated'] = record['time']
+    elif record['type'] == 'meta':
+        # Renames and image migration don't count as activity, so they leave
+        # the conversation's place in the sidebar and its age alone
+        data.update(record['fields'])
+
+def last_updated(state, conversation_id):
+    # When the conversation last gained messages, in seconds since the epoch;
+    # files from before 'updated' was recorded use their creation time
+    value = state.get('updated') or conversation_id[:15]
+    return datetime.strptime(value, "%Y%m%d_%H%M%S").timestamp()
+
+def read_conversation(directory, conversation_id):
+    with file_lock(conversation_lock_path(directory, conversation_id), shared=True):
+        with open(snapshot_path(directory, conversation_id), 'r') as f:
+            data = json.load(f)
+        data['timestamp'] = conversation_id
+        data.setdefault('messages', [])
+        path = log_path(directory, conversation_id)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn last line from an interrupted append
+                        break
+                    _apply_record(data, record)
+    return data
+
+def _disk_key(directory, conversation_id):
+    path = log_path(directory, conversation_id)
+    log_size = os.path.getsize(path) if os.path.exists(path) else 0
+    return os.stat(snapshot_path(directory, conversation_id)).st_mtime_ns, log_size
+
+def _state_from_data(data):
+    return {
+        'message_count': len(data['messages']),
+        'preview': data['messages'][0]['content'] if data['messages'] else None,
+        'updated': data.get('updated'),
+        'context': data.get('context', ''),
+        'title': data.get('title'),
+        'image': data.get('image'),
+        'image_blob': data.get('image_blob'),
+        'image_hash': data.get('image_hash'),
+        'image_blobs': data.get('image_blobs'),
+        'image_hashes': data.get('image_hashes'),
+    }
+
+def conversation_state(directory, conversation_id):
+    with file_lock(conversation_lock_path(directory, conversation_id), shared=True), _lock:
+        key = _disk_key(directory, conversation_id)
+        cached = _states.get(conversation_id)
+        if cached is None or cached[0] != key:
+            cached = (key, _state_from_data(read_conversation(directory, conversation_id)))
+            _states[conversation_id] = cached
+        return dict(cached[1])
+
+def create_conversation(directory, messages, context, title, **fields):
+    os.makedirs(directory, exist_ok=True)
+    # The id is picked and claimed under one lock so two processes saving in
+    # the same second still get different ids
+    with file_lock(lock_path(directory, 'create')), _lock:
+        conversation_id = _now()
+        suffix = 1
+        while os.path.exists(snapshot_path(directory, conversation_id)):
+            conversation_id = f"{_now()}_{suffix}"
+            suffix += 1
+        data = {
+            'timestamp': conversation_id,
+            'messages': list(messages),
+            'context': context,
+            'title': title,
+            'updated': _now(),
+            **fields
+        }
+        atomic_write_json(snapshot_path(directory, conversation_id), data)
+        _states[conversation_id] = (_disk_key(directory, conversation_id), _state_from_data(data))
+    return conversation_id
+
+def append_to_conversation(directory, conversation_id, messages, base_count=None, **fields):
+    # Write only what changed since the last save: messages past the stored
+    # count, plus any metadata fields whose value differs. `base_count` is the
+    # number of messages the caller's copy started from; if another session
+    # has saved messages since, ConversationConflict is raised and nothing is
+    # written, instead of the caller's new messages being dropped.
+    with file_lock(conversation_lock_path(directory, conversation_id)), _lock:
+        state = conversation_state(directory, conversation_id)
+        if base_count is not None and state['message_count'] != base_count:
+            raise ConversationConflict(
+                f"{conversation_id} has {state['message_count']} messages, expected {base_count}"
+            )
+        now = _now()
+        records = [
+            {'type': 'message', 'index': index, 'message': messages[index], 'time': now}
+            for index in range(state['message_count'], len(messages))
+        ]
+        changed = {name: value for name, value in fields.items() if state.get(name) != value}
+        if changed:
+            records.append({'type': 'meta', 'fields': changed, 'time': now})
+        if not records:
+            return False
+
+        # One write per turn; a crash can at most leave a torn last line, which
+        # read_conversation ignores
+        path = log_path(directory, conversation_id)
+        with open(path, 'a') as f:
+            f.write(''.join(json.dumps(record) + '\n' for record in records))
+
+        if len(messages) > state['message_count']:
+            if state['message_count'] == 0:
+                state['preview'] = messages[0]['content']
+            state['message_count'] = len(messages)
+            state['updated'] = now
+        state.update(changed)
+        _states[conversation_id] = (_disk_key(directory, conversation_id), state)
+
+        if os.path.getsize(path) > COMPACT_LOG_BYTES:
+            compact_conversation(directory, conversation_id)
+        return True
+
+def compact_conversation(directory, conversation_id):
+    # Fold the log into a fresh snapshot; the snapshot is replaced before the
+    # log is removed, so a crash in between only leaves records that replay
+    # skips
+    with file_lock(conversation_lock_path(directory, conversation_id)), _lock:
+        path = log_path(directory, conversation_id)
+        if not os.path.exists(path):
+            return False
+        data = read_conversation(directory, conversation_id)
+        atomic_write_json(snapshot_path(directory, conversation_id), data)
+        os.remove(path)
+        _states[conversation_id] = (_disk_key(directory, conversation_id), _state_from_data(data))
+        return True
+
+def remove_conversation(directory, conversation_id):
+    with file_lock(conversation_lock_path(directory, conversation_id)), _lock:
+        _states.pop(conversation_id, None)
+        for path in (snapshot_path(directory, conversation_id), log_path(directory, conversation_id)):
+            if os.path.exists(path):
+                os.remove(path)
+
+def recovery_path(directory, session_id):
+    if not SESSION_ID_PATTERN.fullmatch(session_id):
+        raise ValueError(f"Invalid session id: {session_id!r}")
+    return os.path.join(directory, SESSIONS_DIRNAME, f"{session_id}.json")
+
+def write_recovery(directory, session_id, conversation_id):
+    # Remember which conversation this session has open
+    path = recovery_path(directory, session_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    atomic_write_json(path, {'timestamp': conversation_id, 'updated': _now()})
+
+def read_recovery(directory, session_id):
+    # The conversation id this session last had open, or None
+    try:
+        with open(recovery_path(directory, session_id), 'r') as f:
+            return json.load(f).get('timestamp')
+    except (OSError, ValueError):
+        return None
+
+def clear_recovery(directory, session_id, conversation_id=None):
+    # With conversation_id, only clear the pointer if it still names that conversation
+    path = recovery_path(directory, session_id)
+    if conversation_id is not None and read_recovery(directory, session_id) != conversation_id:
+        return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass